@@ -0,0 +1,155 @@
+import asyncio
+import re
+import time
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Tuple, List, Any, Optional, AsyncIterator, Dict
+
+import asyncpg
+
+from faexport_db import serializer
+from faexport_db.change_feed import FEED_CHANNEL, FEED_ENTITIES
+from faexport_db.db import API_APPLICATION_NAME
+from faexport_db.metrics import QUERY_LATENCY, QUERIES_IN_PROGRESS, POOL_SIZE, POOL_IDLE, query_template
+from faexport_db.profiler import QueryProfiler, process_profiler
+
+# Placeholders, and escaped percent signs, such as the pg_trgm similarity operator
+_placeholder = re.compile(r"(\bIN\s+)?%s|%%", re.IGNORECASE)
+
+
+@lru_cache(maxsize=1024)
+def convert_query(query: str) -> Tuple[str, Tuple[bool, ...]]:
+    """Converts a psycopg2 style query to asyncpg's, and returns which parameters are "IN %s" lists"""
+    list_params = []
+
+    def replace(match: re.Match) -> str:
+        if match.group(0) == "%%":
+            return "%"
+        list_params.append(match.group(1) is not None)
+        param_num = len(list_params)
+        if match.group(1):
+            return f"= ANY(${param_num})"
+        return f"${param_num}"
+
+    return _placeholder.sub(replace, query), tuple(list_params)
+
+
+def convert_args(list_params: Tuple[bool, ...], args: Tuple) -> List[Any]:
+    return [list(arg) if is_list else arg for is_list, arg in zip(list_params, args)]
+
+
+async def _init_connection(conn: asyncpg.Connection) -> None:
+    # Match psycopg2, which decodes json columns into python objects
+    await conn.set_type_codec("json", encoder=serializer.dumps, decoder=serializer.loads, schema="pg_catalog")
+
+
+class AsyncDatabase:
+    def __init__(self, pool: asyncpg.Pool, *, profiler: Optional[QueryProfiler] = None) -> None:
+        self.pool = pool
+        self.profiler = profiler or process_profiler()
+
+    @classmethod
+    async def connect(cls, dsn: str, *, min_size: int = 2, max_size: int = 20) -> "AsyncDatabase":
+        pool = await asyncpg.create_pool(
+            dsn,
+            min_size=min_size,
+            max_size=max_size,
+            init=_init_connection,
+            server_settings={"application_name": API_APPLICATION_NAME},
+        )
+        return cls(pool)
+
+    async def close(self) -> None:
+        await self.pool.close()
+
+    def update_pool_metrics(self) -> None:
+        POOL_SIZE.set(self.pool.get_size())
+        POOL_IDLE.set(self.pool.get_idle_size())
+
+    @asynccontextmanager
+    async def _timed(self, operation: str, query: str) -> AsyncIterator[None]:
+        QUERIES_IN_PROGRESS.inc()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start_time
+            QUERY_LATENCY.labels(operation, query_template(query)).observe(duration)
+            QUERIES_IN_PROGRESS.dec()
+        # Explain sampling is left to the sync Database, which can re-run a query on the same connection
+        self.profiler.record(operation, query, duration)
+
+    async def select(self, query: str, args: Tuple) -> List[Any]:
+        pg_query, list_params = convert_query(query)
+        async with self._timed("select", query):
+            return await self.pool.fetch(pg_query, *convert_args(list_params, args))
+
+    async def select_iter(self, query: str, args: Tuple) -> AsyncIterator[Any]:
+        pg_query, list_params = convert_query(query)
+        async with self.pool.acquire() as conn:
+            # asyncpg cursors must be used within a transaction
+            async with conn.transaction():
+                async with self._timed("select_iter", query):
+                    cursor = await conn.cursor(pg_query, *convert_args(list_params, args))
+                while True:
+                    rows = await cursor.fetch(5000)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row
+
+    async def insert(self, query: str, args: Tuple) -> List[Any]:
+        pg_query, list_params = convert_query(query)
+        async with self._timed("insert", query):
+            return await self.pool.fetch(pg_query, *convert_args(list_params, args))
+
+    async def update(self, query: str, args: Tuple) -> None:
+        pg_query, list_params = convert_query(query)
+        async with self._timed("update", query):
+            await self.pool.execute(pg_query, *convert_args(list_params, args))
+
+
+class AsyncChangeFeedListener:
+    """
+    Listens for new snapshot notifications on its own connection, and wakes feed readers, as ChangeFeedListener does
+    for the sync API. If the connection is lost, readers fall back to re-reading the feed once their wait times out.
+    """
+
+    def __init__(self, conn: asyncpg.Connection) -> None:
+        self.conn = conn
+        self._sequences: Dict[str, int] = {entity: 0 for entity in FEED_ENTITIES.values()}
+        # Before python 3.10, events bind to the event loop which is current when they are created, so the listener is
+        # created by connect() in the loop which serves requests
+        self._events: Dict[str, asyncio.Event] = {entity: asyncio.Event() for entity in FEED_ENTITIES.values()}
+
+    @classmethod
+    async def connect(cls, dsn: str) -> "AsyncChangeFeedListener":
+        conn = await asyncpg.connect(dsn, server_settings={"application_name": API_APPLICATION_NAME})
+        listener = cls(conn)
+        await conn.add_listener(FEED_CHANNEL, listener._on_notification)
+        return listener
+
+    async def close(self) -> None:
+        await self.conn.close()
+
+    def sequence(self, entity: str) -> int:
+        return self._sequences[entity]
+
+    async def wait(self, entity: str, sequence: int, timeout: float) -> bool:
+        """Waits for new snapshots of an entity type after the given sequence number. Returns False on timeout"""
+        if self._sequences[entity] > sequence:
+            return True
+        try:
+            await asyncio.wait_for(self._events[entity].wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def _on_notification(self, _conn: asyncpg.Connection, _pid: int, _channel: str, entity: str) -> None:
+        if entity not in self._sequences:
+            return
+        self._sequences[entity] += 1
+        # Each event is only set once, and replaced for the next wait
+        event = self._events[entity]
+        self._events[entity] = asyncio.Event()
+        event.set()
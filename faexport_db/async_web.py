@@ -0,0 +1,415 @@
+import asyncio
+import base64
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Any, Union
+
+import psycopg2
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from quart import Quart, request, g, Response
+from quart.json.provider import JSONProvider
+
+from faexport_db import serializer
+from faexport_db.async_db import AsyncDatabase, AsyncChangeFeedListener
+from faexport_db.cache import response_cache, ENTITY_SUBMISSION, ENTITY_USER
+from faexport_db.change_feed import FEED_ENTITIES, FeedEntry
+from faexport_db.db import Database, API_APPLICATION_NAME
+from faexport_db.ingest_formats.base import BaseFormat, FormatResponse
+from faexport_db.metrics import REQUEST_LATENCY, REQUESTS_IN_PROGRESS
+from faexport_db.models.archive_contributor import ArchiveContributor
+from faexport_db.models.file import HashAlgo
+from faexport_db.models.submission import SUBMISSION_DATE_COLUMNS, Submission, SubmissionSnapshot, SubmissionHashMatch
+from faexport_db.models.user import USER_DATE_COLUMNS, User, UserSnapshot, DisplayNameMatch
+from faexport_db.models.website import Website
+from faexport_db.web_common import IngestionFormatConverter, WELCOME_MESSAGE, load_dsn, error_resp, ingest_resp
+from faexport_db.web_common import is_not_modified, not_modified_resp, versioned_resp, page_args, page_data
+from faexport_db.web_common import display_name_args, date_range_args, date_range_data, date_page_data
+from faexport_db.web_common import feed_args, feed_data
+
+
+class SerializerJSONProvider(JSONProvider):
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return serializer.dumps(obj)
+
+    def loads(self, s: Union[str, bytes], **kwargs: Any) -> Any:
+        return serializer.loads(s)
+
+
+app = Quart(__name__)
+app.url_map.converters["ingest_format"] = IngestionFormatConverter
+app.json = SerializerJSONProvider(app)
+
+dsn = load_dsn()
+db: Optional[AsyncDatabase] = None
+# Ingestion reuses the sync save_batch code, on a single connection in a worker thread, so saves stay serialised
+ingest_db: Optional[Database] = None
+ingest_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest")
+# Change feed readers are woken by notifications, which are listened for on a separate connection
+feed_listener: Optional[AsyncChangeFeedListener] = None
+
+
+@app.before_serving
+async def connect_db() -> None:
+    global db, ingest_db, feed_listener
+    db = await AsyncDatabase.connect(
+        dsn,
+        min_size=int(os.getenv("DB_POOL_MIN_SIZE", "2")),
+        max_size=int(os.getenv("DB_POOL_SIZE", "20")),
+    )
+    ingest_db = Database(psycopg2.connect(dsn, application_name=API_APPLICATION_NAME))
+    feed_listener = await AsyncChangeFeedListener.connect(dsn)
+
+
+@app.after_serving
+async def close_db() -> None:
+    await feed_listener.close()
+    await db.close()
+    ingest_executor.shutdown(wait=True)
+    ingest_db.conn.close()
+
+
+def _route_label() -> str:
+    if request.url_rule is None:
+        return "unmatched"
+    return request.url_rule.rule
+
+
+@app.before_request
+async def start_request_timer() -> None:
+    g.request_start_time = time.perf_counter()
+    g.request_route = _route_label()
+    REQUESTS_IN_PROGRESS.labels(request.method, g.request_route).inc()
+
+
+@app.after_request
+async def record_request_latency(response: Response) -> Response:
+    REQUEST_LATENCY.labels(request.method, g.request_route, response.status_code).observe(
+        time.perf_counter() - g.request_start_time
+    )
+    return response
+
+
+@app.teardown_request
+async def finish_request_timer(_exc) -> None:
+    if "request_route" in g:
+        REQUESTS_IN_PROGRESS.labels(request.method, g.request_route).dec()
+
+
+@app.route('/')
+async def hello():
+    return WELCOME_MESSAGE
+
+
+@app.route("/metrics")
+async def metrics() -> Response:
+    db.update_pool_metrics()
+    return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
+
+
+@app.route("/api/view/submissions/<website_id>/<submission_id>.json")
+async def view_submission(website_id: str, submission_id: str):
+    website = await Website.from_database_async(db, website_id)
+    if not website:
+        return error_resp(404, f"Website does not exist by ID: {website_id}")
+    version = await Submission.version_from_database_async(db, website.website_id, submission_id)
+    if version is None:
+        return error_resp(404, f"There is no entry for a submission with the ID {submission_id} on {website.full_name}")
+    if is_not_modified(request, version):
+        return not_modified_resp(version)
+    cache_key = (ENTITY_SUBMISSION, website.website_id, submission_id)
+    data = response_cache().get(cache_key, "view", version.etag)
+    if data is None:
+        submission = await Submission.from_database_async(db, website.website_id, submission_id)
+        if not submission:
+            return error_resp(
+                404,
+                f"There is no entry for a submission with the ID {submission_id} on {website.full_name}"
+            )
+        data = submission.to_web_json()
+        response_cache().set(cache_key, "view", version.etag, data)
+    return versioned_resp(data, version)
+
+
+@app.route("/api/view/submissions/<website_id>/<submission_id>/snapshots.json")
+async def view_submission_snapshots(website_id: str, submission_id: str):
+    website = await Website.from_database_async(db, website_id)
+    if not website:
+        return error_resp(404, f"Website does not exist by ID: {website_id}")
+    version = await Submission.version_from_database_async(db, website.website_id, submission_id)
+    if version is None:
+        return error_resp(
+            404,
+            f"There are no snapshots for a submission with the ID {submission_id} on {website.full_name}"
+        )
+    if is_not_modified(request, version):
+        return not_modified_resp(version)
+    cache_key = (ENTITY_SUBMISSION, website.website_id, submission_id)
+    data = response_cache().get(cache_key, "snapshots", version.etag)
+    if data is None:
+        submission = await Submission.from_database_async(db, website.website_id, submission_id)
+        if not submission:
+            return error_resp(
+                404,
+                f"There are no snapshots for a submission with the ID {submission_id} on {website.full_name}"
+            )
+        data = submission.to_web_snapshots_json()
+        response_cache().set(cache_key, "snapshots", version.etag, data)
+    return versioned_resp(data, version)
+
+
+@app.route("/api/view/submissions/<website_id>.json")
+async def list_submissions(website_id: str):
+    website = await Website.from_database_async(db, website_id)
+    if not website:
+        return error_resp(404, f"Website does not exist by ID: {website_id}")
+    submission_ids = [site_id async for site_id in Submission.list_unique_site_ids_async(db, website.website_id)]
+    return {
+        "data": {
+            "submission_count": len(submission_ids),
+            "submission_ids": submission_ids
+        }
+    }
+
+
+@app.route("/api/date_range/submissions/<website_id>.json")
+async def list_submissions_by_date(website_id: str):
+    website = await Website.from_database_async(db, website_id)
+    if not website:
+        return error_resp(404, f"Website does not exist by ID: {website_id}")
+    try:
+        date_name, start, end, after, limit = date_range_args(request.args, SUBMISSION_DATE_COLUMNS)
+    except ValueError as e:
+        return error_resp(400, str(e))
+    snapshot_rows = await Submission.list_snapshots_by_date_async(
+        db, website.website_id, date_name, start, end, after=after, limit=limit
+    )
+    return {
+        "data": {
+            "website_id": website.website_id,
+            **date_range_data(date_name, start, end),
+            **date_page_data(("submission_snapshot_id", "site_submission_id"), snapshot_rows, limit),
+        }
+    }
+
+
+@app.route("/api/view/users/<website_id>/<user_id>.json")
+async def view_user(website_id: str, user_id: str):
+    website = await Website.from_database_async(db, website_id)
+    if not website:
+        return error_resp(404, f"Website does not exist by ID: {website_id}")
+    version = await User.version_from_database_async(db, website.website_id, user_id)
+    if version is None:
+        return error_resp(404, f"There is no entry for a user with the ID {user_id} on {website.full_name}")
+    if is_not_modified(request, version):
+        return not_modified_resp(version)
+    cache_key = (ENTITY_USER, website.website_id, user_id)
+    data = response_cache().get(cache_key, "view", version.etag)
+    if data is None:
+        user = await User.from_database_async(db, website.website_id, user_id)
+        if not user:
+            return error_resp(404, f"There is no entry for a user with the ID {user_id} on {website.full_name}")
+        data = user.to_web_json()
+        response_cache().set(cache_key, "view", version.etag, data)
+    return versioned_resp(data, version)
+
+
+@app.route("/api/view/users/<website_id>/<user_id>/snapshots.json")
+async def view_user_snapshots(website_id: str, user_id: str):
+    website = await Website.from_database_async(db, website_id)
+    if not website:
+        return error_resp(404, f"Website does not exist by ID: {website_id}")
+    version = await User.version_from_database_async(db, website.website_id, user_id)
+    if version is None:
+        return error_resp(404, f"There are no snapshots for a user with the ID {user_id} on {website.full_name}")
+    if is_not_modified(request, version):
+        return not_modified_resp(version)
+    cache_key = (ENTITY_USER, website.website_id, user_id)
+    data = response_cache().get(cache_key, "snapshots", version.etag)
+    if data is None:
+        user = await User.from_database_async(db, website.website_id, user_id)
+        if not user:
+            return error_resp(404, f"There are no snapshots for a user with the ID {user_id} on {website.full_name}")
+        data = user.to_web_snapshots_json()
+        response_cache().set(cache_key, "snapshots", version.etag, data)
+    return versioned_resp(data, version)
+
+
+@app.route("/api/view/users/<website_id>/<user_id>/submissions.json")
+async def list_user_submissions(website_id: str, user_id: str):
+    website = await Website.from_database_async(db, website_id)
+    if not website:
+        return error_resp(404, f"Website does not exist by ID: {website_id}")
+    try:
+        after, limit = page_args(request.args)
+    except ValueError as e:
+        return error_resp(400, str(e))
+    submission_ids = await Submission.list_site_ids_for_uploader_async(
+        db, website.website_id, user_id, after=after, limit=limit
+    )
+    return {
+        "data": {
+            "website_id": website.website_id,
+            "site_user_id": user_id,
+            **page_data("submission_ids", submission_ids, limit),
+        }
+    }
+
+
+@app.route("/api/lookup/users/<website_id>.json")
+async def lookup_users_by_display_name(website_id: str):
+    website = await Website.from_database_async(db, website_id)
+    if not website:
+        return error_resp(404, f"Website does not exist by ID: {website_id}")
+    try:
+        display_name, fuzzy, limit = display_name_args(request.args)
+    except ValueError as e:
+        return error_resp(400, str(e))
+    matches = await DisplayNameMatch.search_async(db, website.website_id, display_name, fuzzy=fuzzy, limit=limit)
+    return {
+        "data": {
+            "website_id": website.website_id,
+            "display_name": display_name,
+            "fuzzy": fuzzy,
+            "matches": [match.to_web_json() for match in matches],
+        }
+    }
+
+
+@app.route("/api/view/users/<website_id>.json")
+async def list_users(website_id: str):
+    website = await Website.from_database_async(db, website_id)
+    if not website:
+        return error_resp(404, f"Website does not exist by ID: {website_id}")
+    user_ids = await User.list_unique_site_ids_async(db, website.website_id)
+    return {
+        "data": {
+            "user_count": len(user_ids),
+            "user_ids": user_ids
+        }
+    }
+
+
+@app.route("/api/date_range/users/<website_id>.json")
+async def list_users_by_date(website_id: str):
+    website = await Website.from_database_async(db, website_id)
+    if not website:
+        return error_resp(404, f"Website does not exist by ID: {website_id}")
+    try:
+        date_name, start, end, after, limit = date_range_args(request.args, USER_DATE_COLUMNS)
+    except ValueError as e:
+        return error_resp(400, str(e))
+    snapshot_rows = await User.list_snapshots_by_date_async(
+        db, website.website_id, date_name, start, end, after=after, limit=limit
+    )
+    return {
+        "data": {
+            "website_id": website.website_id,
+            **date_range_data(date_name, start, end),
+            **date_page_data(("user_snapshot_id", "site_user_id"), snapshot_rows, limit),
+        }
+    }
+
+
+def _save_ingested(format_resp: FormatResponse) -> None:
+    SubmissionSnapshot.save_batch(ingest_db, format_resp.submission_snapshots)
+    UserSnapshot.save_batch(ingest_db, format_resp.user_snapshots)
+
+
+@app.route("/api/ingest/<ingest_format:formatter>", methods=["POST"])
+async def ingest_data(formatter: BaseFormat):
+    api_key = request.headers.get("X-API-Key")
+    if not api_key:
+        return error_resp(403, "An API key is required to access this service")
+    contributor = await ArchiveContributor.from_database_by_api_key_async(db, api_key)
+    if contributor is None:
+        return error_resp(403, "Invalid API key")
+    web_data = await request.get_json()
+    if not web_data:
+        return error_resp(400, "Submission snapshot data must be posted as json")
+    format_resp = formatter.format_web_data(web_data, contributor)
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(ingest_executor, _save_ingested, format_resp)
+    except ValueError as e:
+        return error_resp(400, str(e))
+    return ingest_resp(format_resp)
+
+
+@app.route("/api/feed/<feed_name>.json")
+async def read_feed(feed_name: str):
+    entity = FEED_ENTITIES.get(feed_name)
+    if entity is None:
+        return error_resp(404, f"There is no feed by the name: {feed_name}")
+    try:
+        after_id, limit, wait = feed_args(request.args)
+    except ValueError as e:
+        return error_resp(400, str(e))
+    # Long poll, waiting to be notified of new snapshots if there are none after the cursor yet
+    deadline = time.monotonic() + wait
+    while True:
+        sequence = feed_listener.sequence(entity)
+        entries = await FeedEntry.list_after_async(db, entity, after_id, limit=limit)
+        remaining = deadline - time.monotonic()
+        if entries or remaining <= 0 or not await feed_listener.wait(entity, sequence, remaining):
+            break
+    return {
+        "data": feed_data(feed_name, entries, after_id)
+    }
+
+
+@app.route("/api/websites.json")
+async def list_websites() -> Dict:
+    websites = await Website.list_all_async(db)
+    return {
+        "data": {
+            "websites": [await website.to_web_json_async(db) for website in websites]
+        }
+    }
+
+
+@app.route("/api/hash_algos.json")
+async def list_hash_algos() -> Dict:
+    hash_algos = await HashAlgo.list_all_async(db)
+    return {
+        "data": {
+            "hash_algos": [await hash_algo.to_web_json_async(db) for hash_algo in hash_algos]
+        }
+    }
+
+
+@app.route("/api/archive_contributors.json")
+async def list_archive_contributors() -> Dict:
+    contributors = await ArchiveContributor.list_all_async(db)
+    return {
+        "data": {
+            "archive_contributors": [await contributor.to_web_json_async(db) for contributor in contributors]
+        }
+    }
+
+
+@app.route("/api/hash_search/", methods=["POST"])
+async def search_hash():
+    search_data = await request.get_json()
+    if not search_data:
+        return error_resp(400, "Hash search request must be posted as json")
+    hash_value = search_data["hash_value"]
+    hash_bytes = base64.b64decode(hash_value)
+    algo_id = search_data["algo_id"]
+    hash_algo = await HashAlgo.from_database_async(db, algo_id)
+    if not hash_algo:
+        return error_resp(400, "Hash algo not found by ID")
+    try:
+        hash_algo.db_values(hash_bytes)
+    except ValueError as e:
+        return error_resp(400, str(e))
+    # The "ids" mode answers from the hash lookup table alone, without loading the matching snapshots
+    if search_data.get("mode") == "ids":
+        matches = await SubmissionHashMatch.search_async(db, hash_algo, hash_bytes)
+        return {
+            "results": [match.to_web_json() for match in matches]
+        }
+    snapshots = await SubmissionSnapshot.search_by_file_hash_async(db, hash_algo, hash_bytes)
+    return {
+        "results": [snapshot.to_web_json() for snapshot in snapshots]
+    }
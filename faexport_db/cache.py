@@ -0,0 +1,143 @@
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional, Dict, Iterable, Tuple
+
+from faexport_db import serializer
+from faexport_db.metrics import RESPONSE_CACHE_REQUESTS, RESPONSE_CACHE_INVALIDATIONS
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+ENTITY_SUBMISSION = "submission"
+ENTITY_USER = "user"
+# Each entity is rendered as both a merged view and a list of snapshots
+VIEWS = ("view", "snapshots")
+
+# (entity type, website ID, site ID)
+EntityKey = Tuple[str, str, str]
+
+
+class ResponseCache(ABC):
+    """
+    Caches rendered view json for submissions and users. Each entry stores the entity version it was rendered from,
+    and is only returned if that still matches the current version, so an entry missed by invalidation is never served.
+    """
+
+    def get(self, entity_key: EntityKey, view: str, etag: str) -> Optional[Dict]:
+        entry = self._get_entry(entity_key, view)
+        if entry is None:
+            RESPONSE_CACHE_REQUESTS.labels(entity_key[0], "miss").inc()
+            return None
+        entry_etag, data = entry
+        if entry_etag != etag:
+            RESPONSE_CACHE_REQUESTS.labels(entity_key[0], "stale").inc()
+            return None
+        RESPONSE_CACHE_REQUESTS.labels(entity_key[0], "hit").inc()
+        return data
+
+    @abstractmethod
+    def set(self, entity_key: EntityKey, view: str, etag: str, data: Dict) -> None:
+        pass
+
+    @abstractmethod
+    def invalidate(self, entity_keys: Iterable[EntityKey]) -> None:
+        pass
+
+    @abstractmethod
+    def _get_entry(self, entity_key: EntityKey, view: str) -> Optional[Tuple[str, Dict]]:
+        pass
+
+
+class LRUResponseCache(ResponseCache):
+    def __init__(self, max_entries: int = 10_000) -> None:
+        self.max_entries = max_entries
+        self.entries: OrderedDict[Tuple[EntityKey, str], Tuple[str, Dict]] = OrderedDict()
+        # Ingestion saves may run in a different thread to request handlers
+        self._lock = threading.Lock()
+
+    def _get_entry(self, entity_key: EntityKey, view: str) -> Optional[Tuple[str, Dict]]:
+        with self._lock:
+            entry = self.entries.get((entity_key, view))
+            if entry is not None:
+                self.entries.move_to_end((entity_key, view))
+            return entry
+
+    def set(self, entity_key: EntityKey, view: str, etag: str, data: Dict) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self.entries[(entity_key, view)] = (etag, data)
+            self.entries.move_to_end((entity_key, view))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, entity_keys: Iterable[EntityKey]) -> None:
+        count = 0
+        with self._lock:
+            for entity_key in entity_keys:
+                for view in VIEWS:
+                    if self.entries.pop((entity_key, view), None) is not None:
+                        count += 1
+        RESPONSE_CACHE_INVALIDATIONS.inc(count)
+
+
+class RedisResponseCache(ResponseCache):
+    """Response cache shared between API workers, and invalidated by ingestion jobs which are configured with it"""
+
+    def __init__(self, url: str, *, ttl_seconds: int = 86400, prefix: str = "faexport_db:response:") -> None:
+        if redis is None:
+            raise ValueError("The redis package must be installed to use a shared response cache")
+        self.client = redis.Redis.from_url(url)
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+
+    def _key(self, entity_key: EntityKey, view: str) -> str:
+        return self.prefix + json.dumps([*entity_key, view])
+
+    def _get_entry(self, entity_key: EntityKey, view: str) -> Optional[Tuple[str, Dict]]:
+        value = self.client.get(self._key(entity_key, view))
+        if value is None:
+            return None
+        entry = serializer.loads(value)
+        return entry["etag"], entry["data"]
+
+    def set(self, entity_key: EntityKey, view: str, etag: str, data: Dict) -> None:
+        value = serializer.dumps_bytes({"etag": etag, "data": data})
+        self.client.set(self._key(entity_key, view), value, ex=self.ttl_seconds)
+
+    def invalidate(self, entity_keys: Iterable[EntityKey]) -> None:
+        keys = [self._key(entity_key, view) for entity_key in entity_keys for view in VIEWS]
+        if not keys:
+            return
+        count = self.client.delete(*keys)
+        RESPONSE_CACHE_INVALIDATIONS.inc(count)
+
+
+def response_cache_from_env() -> ResponseCache:
+    cache_url = os.getenv("RESPONSE_CACHE_URL")
+    if cache_url:
+        return RedisResponseCache(cache_url, ttl_seconds=int(os.getenv("RESPONSE_CACHE_TTL", "86400")))
+    return LRUResponseCache(int(os.getenv("RESPONSE_CACHE_SIZE", "10000")))
+
+
+_response_cache: Optional[ResponseCache] = None
+_response_cache_lock = threading.Lock()
+
+
+def response_cache() -> ResponseCache:
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = response_cache_from_env()
+        return _response_cache
+
+
+def set_response_cache(cache: ResponseCache) -> None:
+    global _response_cache
+    with _response_cache_lock:
+        _response_cache = cache
@@ -0,0 +1,162 @@
+import select
+import threading
+import time
+from typing import Dict, List, Optional, TYPE_CHECKING
+
+import psycopg2
+
+from faexport_db.cache import ENTITY_SUBMISSION, ENTITY_USER
+from faexport_db.db import Database, API_APPLICATION_NAME
+
+if TYPE_CHECKING:
+    from faexport_db.async_db import AsyncDatabase
+
+# Channel notified whenever new snapshots are saved, with the entity type as the payload
+FEED_CHANNEL = "snapshot_feed"
+# Advisory lock held by each writer while it adds to the feed, until it commits
+FEED_LOCK_ID = 0x66656564
+# Entity types by the name of their feed in the API
+FEED_ENTITIES = {
+    "submissions": ENTITY_SUBMISSION,
+    "users": ENTITY_USER,
+}
+# Feeds are read in feed ID order, so that a reader can resume from the last feed ID it saw. Entries for snapshots
+# which have since been removed are skipped
+_SELECT_FEED = {
+    ENTITY_SUBMISSION: (
+        "SELECT f.feed_id, s.submission_snapshot_id, s.website_id, s.site_submission_id "
+        "FROM snapshot_feed f "
+        "JOIN submission_snapshots s ON s.submission_snapshot_id = f.snapshot_id "
+        "WHERE f.entity_type = %s AND f.feed_id > %s ORDER BY f.feed_id LIMIT %s"
+    ),
+    ENTITY_USER: (
+        "SELECT f.feed_id, u.user_snapshot_id, u.website_id, u.site_user_id "
+        "FROM snapshot_feed f "
+        "JOIN user_snapshots u ON u.user_snapshot_id = f.snapshot_id "
+        "WHERE f.entity_type = %s AND f.feed_id > %s ORDER BY f.feed_id LIMIT %s"
+    ),
+}
+_ID_KEYS = {
+    ENTITY_SUBMISSION: ("submission_snapshot_id", "site_submission_id"),
+    ENTITY_USER: ("user_snapshot_id", "site_user_id"),
+}
+
+
+def record_new_snapshots(db: Database, entity: str, snapshot_ids: List[int]) -> None:
+    """
+    Adds newly saved snapshots to the change feed, and wakes feed readers. This must be called in the transaction which
+    inserted the snapshots, so that they and their feed entries are committed together, and a snapshot is never saved
+    without appearing in the feed.
+    Snapshot IDs are handed out when snapshots are inserted, so concurrent writers can commit them out of order. Feed
+    entries are instead written one writer at a time, under a lock held until commit, so feed IDs are committed in
+    order, and a reader which has read past a feed ID will never find an earlier entry committed later.
+    """
+    if not snapshot_ids:
+        return
+    if not db.in_transaction:
+        raise ValueError("New snapshots must be added to the change feed in the transaction which saved them")
+    db.update("SELECT pg_advisory_xact_lock(%s)", (FEED_LOCK_ID,))
+    db.bulk_insert_rows(
+        "snapshot_feed",
+        ("entity_type", "snapshot_id"),
+        [(entity, snapshot_id) for snapshot_id in sorted(set(snapshot_ids))],
+    )
+    # Notifications are only delivered once the transaction commits
+    db.update("SELECT pg_notify(%s, %s)", (FEED_CHANNEL, entity))
+
+
+class FeedEntry:
+    def __init__(self, entity: str, feed_id: int, snapshot_id: int, website_id: str, site_id: str) -> None:
+        self.entity = entity
+        self.feed_id = feed_id
+        self.snapshot_id = snapshot_id
+        self.website_id = website_id
+        self.site_id = site_id
+
+    def to_web_json(self) -> Dict:
+        snapshot_id_key, site_id_key = _ID_KEYS[self.entity]
+        return {
+            "feed_id": self.feed_id,
+            snapshot_id_key: self.snapshot_id,
+            "website_id": self.website_id,
+            site_id_key: self.site_id,
+        }
+
+    @classmethod
+    def list_after(cls, db: Database, entity: str, after_id: int, *, limit: int = 100) -> List["FeedEntry"]:
+        return cls._list_from_rows(entity, db.select(_SELECT_FEED[entity], (entity, after_id, limit)))
+
+    @classmethod
+    async def list_after_async(
+            cls, db: "AsyncDatabase", entity: str, after_id: int, *, limit: int = 100
+    ) -> List["FeedEntry"]:
+        return cls._list_from_rows(entity, await db.select(_SELECT_FEED[entity], (entity, after_id, limit)))
+
+    @classmethod
+    def _list_from_rows(cls, entity: str, feed_rows: List) -> List["FeedEntry"]:
+        return [
+            cls(entity, feed_id, snapshot_id, website_id, site_id)
+            for feed_id, snapshot_id, website_id, site_id in feed_rows
+        ]
+
+
+class ChangeFeedListener:
+    """
+    Listens for new snapshot notifications on its own connection, in a background thread, and wakes feed readers.
+    Readers take the sequence number of an entity type before reading the feed, and if there was nothing new, wait
+    for the sequence number to move on, so that a notification arriving between the two is not missed.
+    """
+
+    def __init__(self, dsn: str, *, poll_seconds: float = 5, reconnect_seconds: float = 5) -> None:
+        self.dsn = dsn
+        self.poll_seconds = poll_seconds
+        self.reconnect_seconds = reconnect_seconds
+        self._sequences: Dict[str, int] = {entity: 0 for entity in FEED_ENTITIES.values()}
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="change_feed", daemon=True)
+        self._thread.start()
+
+    def sequence(self, entity: str) -> int:
+        with self._condition:
+            return self._sequences[entity]
+
+    def wait(self, entity: str, sequence: int, timeout: float) -> bool:
+        """Waits for new snapshots of an entity type after the given sequence number. Returns False on timeout"""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._sequences[entity] > sequence, timeout)
+
+    def _notify(self, entities: List[str]) -> None:
+        with self._condition:
+            for entity in entities:
+                if entity in self._sequences:
+                    self._sequences[entity] += 1
+            self._condition.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self._listen()
+            except psycopg2.Error:
+                time.sleep(self.reconnect_seconds)
+
+    def _listen(self) -> None:
+        conn = psycopg2.connect(self.dsn, application_name=API_APPLICATION_NAME)
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {FEED_CHANNEL}")
+            # Notifications may have been missed while disconnected, so wake every reader to check again
+            self._notify(list(self._sequences))
+            while True:
+                if select.select([conn], [], [], self.poll_seconds) == ([], [], []):
+                    continue
+                conn.poll()
+                entities = [notification.payload for notification in conn.notifies]
+                conn.notifies.clear()
+                if entities:
+                    self._notify(entities)
+        finally:
+            conn.close()
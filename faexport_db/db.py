@@ -1,10 +1,19 @@
 import datetime
-import json
-from json import JSONEncoder
-from typing import Tuple, List, Any, Optional, Dict, TypeVar, Iterable
+import threading
+import time
+from contextlib import contextmanager
+from typing import Tuple, List, Any, Optional, Dict, TypeVar, Iterable, Iterator, Callable
 
 import dateutil.parser
 import psycopg2
+import psycopg2.pool
+
+from faexport_db import serializer
+from faexport_db.metrics import QUERY_LATENCY, QUERIES_IN_PROGRESS, query_template
+from faexport_db.profiler import QueryProfiler, process_profiler
+
+# Application name used by the API's database connections, so that batch jobs can tell when the API is live
+API_APPLICATION_NAME = "faexport_db_api"
 
 
 def merge_dicts(base: Optional[Dict[str, Any]], overlay: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
@@ -20,7 +29,7 @@ def merge_dicts(base: Optional[Dict[str, Any]], overlay: Optional[Dict[str, Any]
 def json_to_db(data: Optional[Dict[str, Any]]) -> Optional[str]:
     if data is None:
         return None
-    return json.dumps(data, cls=CustomJSONEncoder)
+    return serializer.dumps(data)
 
 
 N = TypeVar("N")
@@ -37,47 +46,95 @@ def parse_datetime(datetime_str: Optional[str]) -> Optional[datetime.datetime]:
     return dateutil.parser.parse(datetime_str)
 
 
-class CustomJSONEncoder(JSONEncoder):
-    def default(self, obj):
+class Database:
+    """
+    Runs queries on a single connection. Transaction state belongs to the connection, so a Database must only be used
+    by one thread at a time, see PooledDatabase for servers.
+    """
+
+    def __init__(self, conn, *, profiler: Optional[QueryProfiler] = None):
+        self._conn = conn
+        self.profiler = profiler or process_profiler()
+        self._in_transaction = False
+
+    @property
+    def conn(self):
+        return self._conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """
+        Commits the inserts and updates made within once at the end, rather than each as it is made, so that rows
+        which only make sense together are never left half saved. Nested transactions are part of the outermost one.
+        """
+        if self._in_transaction:
+            yield
+            return
+        self._in_transaction = True
         try:
-            if isinstance(obj, datetime.datetime):
-                return obj.isoformat()
-            iterable = iter(obj)
-        except TypeError:
-            pass
-        else:
-            return list(iterable)
-        return JSONEncoder.default(self, obj)
+            yield
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        finally:
+            self._in_transaction = False
 
+    @property
+    def in_transaction(self) -> bool:
+        return self._in_transaction
 
-class Database:
-    def __init__(self, conn):
-        self.conn = conn
-        self.analyze = False
+    def _commit(self) -> None:
+        if not self._in_transaction:
+            self.conn.commit()
+
+    @contextmanager
+    def _timed(self, operation: str, query: str, explain: Callable[[], Any] = None) -> Iterator[None]:
+        QUERIES_IN_PROGRESS.inc()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start_time
+            QUERY_LATENCY.labels(operation, query_template(query)).observe(duration)
+            QUERIES_IN_PROGRESS.dec()
+        # Only profile queries which succeeded
+        self.profiler.record(operation, query, duration, explain)
+
+    def _explain(self, query: str, args: Tuple) -> Optional[Any]:
+        """
+        Explains a query which has just been run, by running it again under EXPLAIN ANALYZE. This is done within a
+        savepoint which is always rolled back to, so that neither the second run nor a failure to explain it affects
+        the caller's transaction.
+        """
+        with self.conn.cursor() as cur:
+            cur.execute("SAVEPOINT explain_sample")
+            try:
+                cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query, args)
+                plan = cur.fetchall()[0][0]
+            except psycopg2.Error:
+                # A failed explain should not fail the query being profiled
+                plan = None
+            cur.execute("ROLLBACK TO SAVEPOINT explain_sample")
+            cur.execute("RELEASE SAVEPOINT explain_sample")
+        return plan
 
     def select(self, query: str, args: Tuple) -> List[Any]:
         with self.conn.cursor() as cur:
             try:
-                cur.execute(query, args)
-                result = cur.fetchall()
+                with self._timed("select", query, lambda: self._explain(query, args)):
+                    cur.execute(query, args)
+                    result = cur.fetchall()
             except psycopg2.Error as e:
                 self.conn.rollback()
                 raise e
-        if self.analyze:
-            with self.conn.cursor() as cur:
-                try:
-                    cur.execute("explain analyze "+query, args)
-                    analyze_result = cur.fetchall()
-                    print(analyze_result)
-                except psycopg2.Error as e:
-                    self.conn.rollback()
-                    raise e
         return result
 
     def select_iter(self, query: str, args: Tuple) -> Iterable[Any]:
         with self.conn.cursor("select_iter") as cur:
             try:
-                cur.execute(query, args)
+                with self._timed("select_iter", query):
+                    cur.execute(query, args)
                 while True:
                     rows = cur.fetchmany(5000)
                     if not rows:
@@ -88,49 +145,160 @@ class Database:
                 self.conn.rollback()
                 raise e
 
-    def insert(self, query: str, args: Tuple) -> List[Any]:
+    def _insert(self, query: str, args: Tuple) -> List[Any]:
         with self.conn.cursor() as cur:
             try:
                 cur.execute(query, args)
                 result = cur.fetchall()
-                self.conn.commit()
+                self._commit()
             except psycopg2.Error as e:
                 self.conn.rollback()
                 raise e
         return result
 
-    def bulk_insert(
+    def insert(self, query: str, args: Tuple) -> List[Any]:
+        with self._timed("insert", query):
+            return self._insert(query, args)
+
+    def _bulk_insert_chunks(
             self,
             table_name: str,
             columns: Tuple[str, ...],
             values: List[Tuple[Any, ...]],
-            id_column: str,
-            chunk_size: int = 1000
-    ) -> Iterable[int]:
-        if id_column in columns:
-            raise ValueError("ID column should not be in the list of columns")
+            returning: str,
+            chunk_size: int,
+    ) -> Iterator[Tuple[str, str, Tuple]]:
         if not columns:
             raise ValueError("Column list is missing")
-        if not values:
-            return []
         param_str = "(" + ", ".join("%s" for _ in columns) + ")"
+        # Chunks produce differently sized queries, so record them all under one template
+        template = f"INSERT INTO {table_name} (" + ", ".join(columns) + ") VALUES ... " + returning
         for values_chunk in chunks(values, chunk_size):
             query_str = (
                 f"INSERT INTO {table_name} ("
                 + ", ".join(columns) + ") VALUES "
                 + ", ".join(param_str for _ in values_chunk)
-                + f"RETURNING {id_column}"
+                + returning
             )
             param_values = tuple(sum([list(entry) for entry in values_chunk], start=[]))
-            inserted_rows = self.insert(query_str, param_values)
+            yield template, query_str, param_values
+
+    def bulk_insert(
+            self,
+            table_name: str,
+            columns: Tuple[str, ...],
+            values: List[Tuple[Any, ...]],
+            id_column: str,
+            chunk_size: int = 1000
+    ) -> Iterable[int]:
+        if id_column in columns:
+            raise ValueError("ID column should not be in the list of columns")
+        if not values:
+            return []
+        query_chunks = self._bulk_insert_chunks(table_name, columns, values, f"RETURNING {id_column}", chunk_size)
+        for template, query_str, param_values in query_chunks:
+            with self._timed("bulk_insert", template):
+                inserted_rows = self._insert(query_str, param_values)
             for row in inserted_rows:
                 yield row[0]
 
-    def update(self, query: str, args: Tuple) -> None:
+    def bulk_insert_rows(
+            self,
+            table_name: str,
+            columns: Tuple[str, ...],
+            values: List[Tuple[Any, ...]],
+            chunk_size: int = 1000,
+            *,
+            on_conflict: str = "",
+    ) -> None:
+        """
+        Inserts rows in chunks, like bulk_insert, for tables which do not have an ID column to return.
+        on_conflict is appended to each insert, to allow upserts. Rows within a chunk must not conflict with each other.
+        """
+        if not values:
+            return
+        query_chunks = self._bulk_insert_chunks(table_name, columns, values, on_conflict, chunk_size)
+        for template, query_str, param_values in query_chunks:
+            with self._timed("bulk_insert", template):
+                self._update(query_str, param_values)
+
+    def bulk_insert_returning(
+            self,
+            table_name: str,
+            columns: Tuple[str, ...],
+            values: List[Tuple[Any, ...]],
+            returning: Tuple[str, ...],
+            chunk_size: int = 1000,
+            *,
+            on_conflict: str = "",
+    ) -> List[Any]:
+        """
+        Inserts rows in chunks, like bulk_insert_rows, and returns the given columns of each inserted row.
+        Rows skipped by on_conflict are not returned, so results should be matched up to rows by their columns.
+        """
+        if not values:
+            return []
+        returning_str = f"{on_conflict} RETURNING " + ", ".join(returning)
+        result = []
+        for template, query_str, param_values in self._bulk_insert_chunks(
+                table_name, columns, values, returning_str, chunk_size
+        ):
+            with self._timed("bulk_insert", template):
+                result.extend(self._insert(query_str, param_values))
+        return result
+
+    def _update(self, query: str, args: Tuple) -> None:
         with self.conn.cursor() as cur:
             try:
                 cur.execute(query, args)
-                self.conn.commit()
+                self._commit()
             except psycopg2.Error as e:
                 self.conn.rollback()
                 raise e
+
+    def update(self, query: str, args: Tuple) -> None:
+        with self._timed("update", query):
+            self._update(query, args)
+
+
+class PooledDatabase(Database):
+    """
+    Database shared between the threads of a server. Each thread is given its own connection from the pool, along with
+    its own transaction state, so that one request's transaction never takes in, leaves uncommitted, or rolls back
+    another request's writes. A thread's connection goes back to the pool when release() is called, after each request.
+    """
+
+    def __init__(self, pool: psycopg2.pool.ThreadedConnectionPool, *, profiler: Optional[QueryProfiler] = None):
+        self.pool = pool
+        self._local = threading.local()
+        super().__init__(None, profiler=profiler)
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self.pool.getconn()
+        return conn
+
+    @property
+    def _in_transaction(self) -> bool:
+        return getattr(self._local, "in_transaction", False)
+
+    @_in_transaction.setter
+    def _in_transaction(self, value: bool) -> None:
+        self._local.in_transaction = value
+
+    def release(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            return
+        self._local.conn = None
+        self._local.in_transaction = False
+        broken = bool(conn.closed)
+        if not broken:
+            # End the transaction left open by any reads, so the connection is idle in the pool
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        self.pool.putconn(conn, close=broken)
@@ -0,0 +1,74 @@
+import pathlib
+import re
+from typing import Union
+
+from prometheus_client import Histogram, Counter, Gauge, REGISTRY, write_to_textfile
+
+REQUEST_LATENCY = Histogram(
+    "faexport_db_request_duration_seconds",
+    "Time taken to respond to API requests, by route",
+    ["method", "route", "status"],
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "faexport_db_requests_in_progress",
+    "Number of API requests currently being handled",
+    ["method", "route"],
+)
+QUERY_LATENCY = Histogram(
+    "faexport_db_query_duration_seconds",
+    "Time taken to run database queries, by query template",
+    ["operation", "query"],
+)
+QUERIES_IN_PROGRESS = Gauge(
+    "faexport_db_queries_in_progress",
+    "Number of database queries waiting on the database connection",
+)
+POOL_SIZE = Gauge(
+    "faexport_db_pool_connections",
+    "Number of connections open in the async API's database pool",
+)
+POOL_IDLE = Gauge(
+    "faexport_db_pool_idle_connections",
+    "Number of idle connections in the async API's database pool",
+)
+RESPONSE_CACHE_REQUESTS = Counter(
+    "faexport_db_response_cache_requests_total",
+    "Number of response cache lookups, by entity type and result (hit, miss, or stale)",
+    ["entity", "result"],
+)
+RESPONSE_CACHE_INVALIDATIONS = Counter(
+    "faexport_db_response_cache_invalidations_total",
+    "Number of response cache entries removed because new snapshots were saved",
+)
+INGEST_ROWS = Counter(
+    "faexport_db_ingest_rows_total",
+    "Number of source rows processed by an ingestion job",
+    ["job"],
+)
+INGEST_ROWS_PER_SECOND = Gauge(
+    "faexport_db_ingest_rows_per_second",
+    "Rate of source rows processed by an ingestion job, since the previous batch was saved",
+    ["job"],
+)
+INGEST_BATCH_SAVE_LATENCY = Histogram(
+    "faexport_db_ingest_batch_save_duration_seconds",
+    "Time taken to save and commit a batch of snapshots in an ingestion job",
+    ["job"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+INGEST_PENDING_SNAPSHOTS = Gauge(
+    "faexport_db_ingest_pending_snapshots",
+    "Number of snapshots collected by an ingestion job, waiting to be saved",
+    ["job", "snapshot_type"],
+)
+
+_whitespace = re.compile(r"\s+")
+
+
+def query_template(query: str) -> str:
+    return _whitespace.sub(" ", query).strip()
+
+
+def write_metrics_file(file_path: Union[str, pathlib.Path]) -> None:
+    """Writes current metrics in the node_exporter textfile format, for batch scripts which cannot be scraped"""
+    write_to_textfile(str(file_path), REGISTRY)
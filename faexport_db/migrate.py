@@ -0,0 +1,53 @@
+import argparse
+import json
+import pathlib
+from typing import List, Tuple
+
+import psycopg2
+
+from faexport_db.db import Database
+
+MIGRATIONS_DIR = pathlib.Path(__file__).parent / "schema" / "migrations"
+
+
+def parse_version(version: str) -> Tuple[int, ...]:
+    return tuple(int(part) for part in version.split("."))
+
+
+def current_version(db: Database) -> str:
+    version_rows = db.select("SELECT setting_value FROM settings WHERE setting_id = 'version'", tuple())
+    return version_rows[0][0]
+
+
+def pending_migrations(db: Database) -> List[pathlib.Path]:
+    version = parse_version(current_version(db))
+    migrations = sorted(MIGRATIONS_DIR.glob("*.sql"), key=lambda path: parse_version(path.stem))
+    return [path for path in migrations if parse_version(path.stem) > version]
+
+
+def migrate(db: Database, *, dry_run: bool = False) -> List[str]:
+    """Applies each pending migration in its own transaction, in version order. Returns the versions applied"""
+    applied = []
+    for migration_path in pending_migrations(db):
+        print(f"Applying migration to version {migration_path.stem}")
+        if not dry_run:
+            with open(migration_path, "r") as f:
+                db.update(f.read(), tuple())
+        applied.append(migration_path.stem)
+    return applied
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate the faexport_db schema to the latest version")
+    parser.add_argument("--dsn", help="Database to migrate. Defaults to db_conn in config.json")
+    parser.add_argument("--dry-run", action="store_true", help="List pending migrations without applying them")
+    args = parser.parse_args()
+    db_dsn = args.dsn
+    if db_dsn is None:
+        with open("./config.json", "r") as conf_file:
+            db_dsn = json.load(conf_file)["db_conn"]
+    db_obj = Database(psycopg2.connect(db_dsn))
+    print(f"Database schema is at version {current_version(db_obj)}")
+    versions = migrate(db_obj, dry_run=args.dry_run)
+    if not versions:
+        print("Database schema is up to date")
@@ -1,7 +1,15 @@
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, TYPE_CHECKING
 
 from faexport_db.db import Database
 
+if TYPE_CHECKING:
+    from faexport_db.async_db import AsyncDatabase
+
+_COUNT_USER_SNAPSHOTS = "SELECT COUNT(*) FROM user_snapshots WHERE archive_contributor_id = %s"
+_COUNT_SUBMISSION_SNAPSHOTS = "SELECT COUNT(*) FROM submission_snapshots WHERE archive_contributor_id = %s"
+_SELECT_ALL = "SELECT contributor_id, name, api_key FROM archive_contributors"
+_SELECT_BY_API_KEY = "SELECT contributor_id, name FROM archive_contributors WHERE api_key = %s"
+
 
 class ArchiveContributor:
 
@@ -11,19 +19,25 @@ class ArchiveContributor:
         self.api_key = api_key
 
     def count_user_snapshots(self, db: Database) -> int:
-        count_rows = db.select(
-            "SELECT COUNT(*) FROM user_snapshots WHERE archive_contributor_id = %s",
-            (self.contributor_id,)
-        )
+        count_rows = db.select(_COUNT_USER_SNAPSHOTS, (self.contributor_id,))
+        if count_rows:
+            return count_rows[0][0]
+        return 0
+
+    async def count_user_snapshots_async(self, db: "AsyncDatabase") -> int:
+        count_rows = await db.select(_COUNT_USER_SNAPSHOTS, (self.contributor_id,))
         if count_rows:
             return count_rows[0][0]
         return 0
 
     def count_submission_snapshots(self, db: Database) -> int:
-        count_rows = db.select(
-            "SELECT COUNT(*) FROM submission_snapshots WHERE archive_contributor_id = %s",
-            (self.contributor_id,)
-        )
+        count_rows = db.select(_COUNT_SUBMISSION_SNAPSHOTS, (self.contributor_id,))
+        if count_rows:
+            return count_rows[0][0]
+        return 0
+
+    async def count_submission_snapshots_async(self, db: "AsyncDatabase") -> int:
+        count_rows = await db.select(_COUNT_SUBMISSION_SNAPSHOTS, (self.contributor_id,))
         if count_rows:
             return count_rows[0][0]
         return 0
@@ -38,6 +52,12 @@ class ArchiveContributor:
             data["num_submission_snapshots"] = self.count_submission_snapshots(db)
         return data
 
+    async def to_web_json_async(self, db: "AsyncDatabase") -> Dict:
+        data = self.to_web_json()
+        data["num_user_snapshots"] = await self.count_user_snapshots_async(db)
+        data["num_submission_snapshots"] = await self.count_submission_snapshots_async(db)
+        return data
+
     def save(self, db: Database) -> None:
         if self.contributor_id is None:
             contributor_rows = db.insert(
@@ -58,10 +78,14 @@ class ArchiveContributor:
 
     @classmethod
     def list_all(cls, db: Database) -> List["ArchiveContributor"]:
-        contributor_rows = db.select(
-            "SELECT contributor_id, name, api_key FROM archive_contributors",
-            tuple()
-        )
+        return cls._list_from_rows(db.select(_SELECT_ALL, tuple()))
+
+    @classmethod
+    async def list_all_async(cls, db: "AsyncDatabase") -> List["ArchiveContributor"]:
+        return cls._list_from_rows(await db.select(_SELECT_ALL, tuple()))
+
+    @classmethod
+    def _list_from_rows(cls, contributor_rows: List) -> List["ArchiveContributor"]:
         contributors = []
         for contributor_row in contributor_rows:
             contributor_id, name, api_key = contributor_row
@@ -74,10 +98,18 @@ class ArchiveContributor:
 
     @classmethod
     def from_database_by_api_key(cls, db: Database, api_key: str) -> Optional["ArchiveContributor"]:
-        contributor_rows = db.select(
-            "SELECT contributor_id, name FROM archive_contributors WHERE api_key = %s",
-            (api_key,)
-        )
+        return cls._from_api_key_rows(api_key, db.select(_SELECT_BY_API_KEY, (api_key,)))
+
+    @classmethod
+    async def from_database_by_api_key_async(
+            cls,
+            db: "AsyncDatabase",
+            api_key: str
+    ) -> Optional["ArchiveContributor"]:
+        return cls._from_api_key_rows(api_key, await db.select(_SELECT_BY_API_KEY, (api_key,)))
+
+    @classmethod
+    def _from_api_key_rows(cls, api_key: str, contributor_rows: List) -> Optional["ArchiveContributor"]:
         if not contributor_rows:
             return None
         contributor_id, name = contributor_rows[0]
@@ -0,0 +1,38 @@
+from typing import Dict, List, Tuple
+
+from faexport_db.db import Database
+
+_SELECT_CHANGE_SEQS = (
+    "SELECT site_submission_id, change_seq FROM submission_change_markers "
+    "WHERE website_id = %s AND site_submission_id IN %s"
+)
+_UPSERT_CONFLICT = (
+    " ON CONFLICT (website_id, site_submission_id) DO UPDATE "
+    "SET change_seq = GREATEST(submission_change_markers.change_seq, EXCLUDED.change_seq)"
+)
+
+
+class SubmissionChangeMarker:
+    """
+    Remembers the highest change sequence number ingested for each submission, for data sources which provide one,
+    so that unchanged submissions can be skipped when ingesting a later export.
+    """
+
+    @classmethod
+    def change_seqs(cls, db: Database, website_id: str, site_submission_ids: List[str]) -> Dict[str, int]:
+        if not site_submission_ids:
+            return {}
+        rows = db.select(_SELECT_CHANGE_SEQS, (website_id, tuple(site_submission_ids)))
+        return {site_submission_id: change_seq for site_submission_id, change_seq in rows}
+
+    @classmethod
+    def save_batch(cls, db: Database, website_id: str, change_seqs: Dict[str, int]) -> None:
+        values: List[Tuple[str, str, int]] = [
+            (website_id, site_submission_id, change_seq) for site_submission_id, change_seq in change_seqs.items()
+        ]
+        db.bulk_insert_rows(
+            "submission_change_markers",
+            ("website_id", "site_submission_id", "change_seq"),
+            values,
+            on_conflict=_UPSERT_CONFLICT,
+        )
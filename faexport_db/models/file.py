@@ -1,8 +1,49 @@
 from __future__ import annotations
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple, TYPE_CHECKING
 import base64
 
-from faexport_db.db import Database, merge_dicts, json_to_db
+from faexport_db.db import Database, merge_dicts, json_to_db, chunks
+from faexport_db.models.snapshot_digest import content_digest
+
+if TYPE_CHECKING:
+    from faexport_db.async_db import AsyncDatabase
+
+_SELECT_FILES_FOR_SNAPSHOTS = (
+    "SELECT f.file_id, l.submission_snapshot_id, f.site_file_id, f.file_url, f.file_size, f.extra_data "
+    "FROM submission_snapshot_file_links l "
+    "JOIN submission_snapshot_files f ON l.file_id = f.file_id "
+    "WHERE l.submission_snapshot_id IN %s"
+)
+_SELECT_FILES_BY_DIGEST = "SELECT content_digest, file_id FROM submission_snapshot_files WHERE content_digest IN %s"
+_SELECT_HASHES_FOR_FILES = (
+    "SELECT hash_id, file_id, algo_id, hash_value, hash_int "
+    "FROM submission_snapshot_file_hashes "
+    "WHERE file_id IN %s"
+)
+_COUNT_ALGO_HASHES = "SELECT COUNT(*) FROM submission_snapshot_file_hashes WHERE algo_id = %s"
+_SELECT_ALL_ALGOS = "SELECT algo_id, language, algorithm_name, hash_length FROM hash_algos"
+_SELECT_ALGO_BY_ID = "SELECT language, algorithm_name, hash_length FROM hash_algos WHERE algo_id = %s"
+# Hashes of this many bytes are stored as bigint, rather than bytea, so they can be compared bitwise in SQL
+INT_HASH_LENGTH = 8
+# Hash lengths by algo ID. Algorithm hash lengths do not change once hashes are stored, so they are cached
+_hash_lengths: Dict[int, Optional[int]] = {}
+
+
+def hash_to_int(hash_value: bytes) -> int:
+    return int.from_bytes(hash_value, "big", signed=True)
+
+
+def int_to_hash(hash_int: int) -> bytes:
+    return hash_int.to_bytes(INT_HASH_LENGTH, "big", signed=True)
+
+
+def hash_db_values(hash_value: bytes, hash_length: Optional[int]) -> Tuple[Optional[bytes], Optional[int]]:
+    """Returns the (hash_value, hash_int) columns to store a hash in, for an algorithm of the given hash length"""
+    if hash_length is not None and len(hash_value) != hash_length:
+        raise ValueError(f"Hash value is {len(hash_value)} bytes long, but this algorithm's hashes are {hash_length}")
+    if hash_length == INT_HASH_LENGTH:
+        return None, hash_to_int(hash_value)
+    return hash_value, None
 
 
 class File:
@@ -71,61 +112,118 @@ class File:
             if file_hash.algo_id not in my_hash_map:
                 self.hashes.append(file_hash)
 
-    def create_snapshot(self, db: "Database") -> None:
-        file_rows = db.insert(
-            "INSERT INTO submission_snapshot_files "
-            "(submission_snapshot_id, site_file_id, file_url, file_size, extra_data) "
-            "VALUES (%s, %s, %s, %s, %s) "
-            "RETURNING file_id ",
-            (
-                self.submission_snapshot_id, self.site_file_id,
-                self.file_url, self.file_size, json_to_db(self.extra_data),
-            )
-        )
-        self.file_id = file_rows[0][0]
+    @property
+    def content_digest(self) -> bytes:
+        """Identity of the file's content. Files with the same digest are stored once, and shared between snapshots"""
+        return content_digest([
+            self.site_file_id, self.file_url, self.file_size, self.extra_data,
+            sorted([file_hash.algo_id, bytes(file_hash.hash_value)] for file_hash in self.hashes)
+        ])
 
     def save(self, db: Database, submission_snapshot_id: int) -> None:
         self.submission_snapshot_id = submission_snapshot_id
-        if self.file_id is None:
-            self.create_snapshot(db)
-        FileHash.save_batch(db, self.hashes, self.file_id)
+        self.save_batch(db, [self], submission_snapshot_id)
 
     @classmethod
     def save_batch(cls, db: Database, files: List["File"], submission_snapshot_id: Optional[int]) -> None:
-        unsaved = [file for file in files if file.file_id is None]
-        file_ids = db.bulk_insert(
-            "submission_snapshot_files",
-            ("submission_snapshot_id", "site_file_id", "file_url", "file_size", "extra_data"),
-            [
-                (
-                    file.submission_snapshot_id or submission_snapshot_id, file.site_file_id, file.file_url,
-                    file.file_size, json_to_db(file.extra_data)
-                )
-                for file in unsaved
-            ],
-            "file_id"
-        )
-        for file, file_id in zip(unsaved, file_ids):
-            file.file_id = file_id
+        """
+        Links files to their snapshots, saving only files which are not already stored.
+        Files are stored by content digest, so that a file which is unchanged between snapshots is stored once.
+        Each file is saved in the same transaction as its hashes, and a file saved concurrently by another writer is
+        shared.
+        """
+        for file in files:
             if file.submission_snapshot_id is None:
                 file.submission_snapshot_id = submission_snapshot_id
-            for file_hash in file.hashes:
-                file_hash.file_id = file_id
-        file_hashes = sum([file.hashes for file in files], start=[])
-        FileHash.save_batch(db, file_hashes, None)
+        unsaved_by_digest: Dict[bytes, List[File]] = {}
+        for file in files:
+            if file.file_id is None:
+                unsaved_by_digest.setdefault(file.content_digest, []).append(file)
+        with db.transaction():
+            file_ids_by_digest = cls._file_ids_by_digest(db, list(unsaved_by_digest.keys()))
+            # Save one copy of each new file. Files inserted by another writer in the meantime are skipped, and their
+            # IDs are found by digest, along with those of the files inserted here
+            new_files = [
+                digest_files[0]
+                for digest, digest_files in unsaved_by_digest.items()
+                if digest not in file_ids_by_digest
+            ]
+            db.bulk_insert_rows(
+                "submission_snapshot_files",
+                ("site_file_id", "file_url", "file_size", "extra_data", "content_digest"),
+                [
+                    (file.site_file_id, file.file_url, file.file_size, json_to_db(file.extra_data), file.content_digest)
+                    for file in new_files
+                ],
+                on_conflict=" ON CONFLICT (content_digest) DO NOTHING",
+            )
+            file_ids_by_digest.update(cls._file_ids_by_digest(db, [file.content_digest for file in new_files]))
+            # Save any hashes a stored file is missing, so a file which was saved without its hashes is repaired
+            stored_hashes = FileHash.list_for_files_batch(db, list(set(file_ids_by_digest.values())))
+            hashes_by_value = {
+                (file_hash.file_id, file_hash.algo_id, bytes(file_hash.hash_value)): file_hash
+                for file_hash in stored_hashes
+            }
+            missing_hashes = []
+            for digest, digest_files in unsaved_by_digest.items():
+                file_id = file_ids_by_digest[digest]
+                for file_hash in digest_files[0].hashes:
+                    hash_key = (file_id, file_hash.algo_id, bytes(file_hash.hash_value))
+                    if hash_key not in hashes_by_value:
+                        file_hash.file_id = file_id
+                        hashes_by_value[hash_key] = file_hash
+                        missing_hashes.append(file_hash)
+            FileHash.save_batch(db, missing_hashes, None)
+            # Every copy of a file takes the IDs of the stored file and its hashes
+            for digest, digest_files in unsaved_by_digest.items():
+                for file in digest_files:
+                    file.file_id = file_ids_by_digest[digest]
+                    for file_hash in file.hashes:
+                        stored_hash = hashes_by_value[(file.file_id, file_hash.algo_id, bytes(file_hash.hash_value))]
+                        file_hash.file_id = stored_hash.file_id
+                        file_hash.hash_id = stored_hash.hash_id
+            db.bulk_insert_rows(
+                "submission_snapshot_file_links",
+                ("submission_snapshot_id", "file_id"),
+                sorted({
+                    (file.submission_snapshot_id, file.file_id)
+                    for file in files
+                    if file.submission_snapshot_id is not None
+                }),
+                on_conflict=" ON CONFLICT DO NOTHING",
+            )
+
+    @classmethod
+    def _file_ids_by_digest(cls, db: Database, digests: List[bytes]) -> Dict[bytes, int]:
+        file_ids = {}
+        for digests_chunk in chunks(digests, 1000):
+            for digest, file_id in db.select(_SELECT_FILES_BY_DIGEST, (tuple(digests_chunk),)):
+                file_ids[bytes(digest)] = file_id
+        return file_ids
 
     @classmethod
     def list_for_submission_snapshots_batch(cls, db: Database, submission_snapshot_ids: List[int]) -> List["File"]:
-        file_rows = db.select(
-            "SELECT file_id, submission_snapshot_id, site_file_id, file_url, file_size, extra_data "
-            "FROM submission_snapshot_files "
-            "WHERE submission_snapshot_id IN %s",
-            (tuple(submission_snapshot_ids),)
-        )
+        if not submission_snapshot_ids:
+            return []
+        file_rows = db.select(_SELECT_FILES_FOR_SNAPSHOTS, (tuple(submission_snapshot_ids),))
+        all_hashes = FileHash.list_for_files_batch(db, list({row[0] for row in file_rows}))
+        return cls._list_from_rows(file_rows, all_hashes)
+
+    @classmethod
+    async def list_for_submission_snapshots_batch_async(
+            cls,
+            db: AsyncDatabase,
+            submission_snapshot_ids: List[int]
+    ) -> List["File"]:
+        if not submission_snapshot_ids:
+            return []
+        file_rows = await db.select(_SELECT_FILES_FOR_SNAPSHOTS, (tuple(submission_snapshot_ids),))
+        all_hashes = await FileHash.list_for_files_batch_async(db, list({row[0] for row in file_rows}))
+        return cls._list_from_rows(file_rows, all_hashes)
+
+    @classmethod
+    def _list_from_rows(cls, file_rows: List, all_hashes: List[FileHash]) -> List["File"]:
         files = []
-        file_rows = list(file_rows)
-        file_ids = [row[0] for row in file_rows]
-        all_hashes = FileHash.list_for_files_batch(db, file_ids)
         for file_row in file_rows:
             file_id, submission_snapshot_id, site_file_id, file_url, file_size, extra_data = file_row
             hashes = [file_hash for file_hash in all_hashes if file_hash.file_id == file_id]
@@ -142,26 +240,7 @@ class File:
 
     @classmethod
     def list_for_submission_snapshot(cls, db: Database, submission_snapshot_id: int) -> List["File"]:
-        file_rows = db.select(
-            "SELECT file_id, site_file_id, file_url, file_size, extra_data "
-            "FROM submission_snapshot_files "
-            "WHERE submission_snapshot_id = %s",
-            (submission_snapshot_id,)
-        )
-        files = []
-        for file_row in file_rows:
-            file_id, site_file_id, file_url, file_size, extra_data = file_row
-            hashes = FileHash.list_for_file(db, file_id)
-            files.append(cls(
-                site_file_id,
-                file_id=file_id,
-                submission_snapshot_id=submission_snapshot_id,
-                file_url=file_url,
-                file_size=file_size,
-                extra_data=extra_data,
-                hashes=hashes,
-            ))
-        return files
+        return cls.list_for_submission_snapshots_batch(db, [submission_snapshot_id])
 
 
 class FileHash:
@@ -191,13 +270,17 @@ class FileHash:
             base64.b64decode(web_data["hash_value"].encode('ascii'))
         )
 
+    def db_values(self, db: Database) -> Tuple[Optional[bytes], Optional[int]]:
+        return hash_db_values(self.hash_value, HashAlgo.hash_length_for_algo_id(db, self.algo_id))
+
     def create_snapshot(self, db: Database) -> None:
+        hash_value, hash_int = self.db_values(db)
         hash_rows = db.insert(
             "INSERT INTO submission_snapshot_file_hashes "
-            "(file_id, algo_id, hash_value) "
-            "VALUES (%s, %s, %s) "
+            "(file_id, algo_id, hash_value, hash_int) "
+            "VALUES (%s, %s, %s, %s) "
             "RETURNING hash_id ",
-            (self.file_id, self.algo_id, self.hash_value)
+            (self.file_id, self.algo_id, hash_value, hash_int)
         )
         self.hash_id = hash_rows[0][0]
 
@@ -211,8 +294,8 @@ class FileHash:
         unsaved = [file_hash for file_hash in file_hashes if file_hash.hash_id is None]
         hash_ids = db.bulk_insert(
             "submission_snapshot_file_hashes",
-            ("file_id", "algo_id", "hash_value"),
-            [(file_hash.file_id or file_id, file_hash.algo_id, file_hash.hash_value) for file_hash in unsaved],
+            ("file_id", "algo_id", "hash_value", "hash_int"),
+            [(file_hash.file_id or file_id, file_hash.algo_id, *file_hash.db_values(db)) for file_hash in unsaved],
             "hash_id"
         )
         for file_hash, hash_id in zip(unsaved, hash_ids):
@@ -220,20 +303,32 @@ class FileHash:
             if file_hash.file_id is None:
                 file_hash.file_id = file_id
 
+    @classmethod
+    def validate_batch(cls, db: Database, file_hashes: List["FileHash"]) -> None:
+        """Raises ValueError if any of the hashes does not fit its algorithm, before anything is saved"""
+        for file_hash in file_hashes:
+            file_hash.db_values(db)
+
     @classmethod
     def list_for_files_batch(cls, db: Database, file_ids: List[int]) -> List["FileHash"]:
-        hash_rows = db.select(
-            "SELECT hash_id, file_id, algo_id, hash_value "
-            "FROM submission_snapshot_file_hashes "
-            "WHERE file_id IN %s",
-            (tuple(file_ids),)
-        )
+        if not file_ids:
+            return []
+        return cls._list_from_rows(db.select(_SELECT_HASHES_FOR_FILES, (tuple(file_ids),)))
+
+    @classmethod
+    async def list_for_files_batch_async(cls, db: AsyncDatabase, file_ids: List[int]) -> List["FileHash"]:
+        if not file_ids:
+            return []
+        return cls._list_from_rows(await db.select(_SELECT_HASHES_FOR_FILES, (tuple(file_ids),)))
+
+    @classmethod
+    def _list_from_rows(cls, hash_rows: List) -> List["FileHash"]:
         hashes = []
         for hash_row in hash_rows:
-            hash_id, file_id, algo_id, hash_value = hash_row
+            hash_id, file_id, algo_id, hash_value, hash_int = hash_row
             hashes.append(cls(
                 algo_id,
-                hash_value,
+                hash_value if hash_int is None else int_to_hash(hash_int),
                 file_id=file_id,
                 hash_id=hash_id,
             ))
@@ -242,17 +337,17 @@ class FileHash:
     @classmethod
     def list_for_file(cls, db: Database, file_id: int) -> List["FileHash"]:
         hash_rows = db.select(
-            "SELECT hash_id, algo_id, hash_value "
+            "SELECT hash_id, algo_id, hash_value, hash_int "
             "FROM submission_snapshot_file_hashes "
             "WHERE file_id = %s",
             (file_id,)
         )
         hashes = []
         for hash_row in hash_rows:
-            hash_id, algo_id, hash_value = hash_row
+            hash_id, algo_id, hash_value, hash_int = hash_row
             hashes.append(cls(
                 algo_id,
-                hash_value,
+                hash_value if hash_int is None else int_to_hash(hash_int),
                 file_id=file_id,
                 hash_id=hash_id,
             ))
@@ -266,48 +361,89 @@ class HashAlgo:
         language: str,
         algorithm_name: str,
         *,
+        hash_length: Optional[int] = None,
         algo_id: int = None
     ):
         self.language = language
         self.algorithm_name = algorithm_name
+        self.hash_length = hash_length
         self.algo_id = algo_id
-        # TODO: Add some hash validation methods? Like, checking hash length. Especially important for web data
+
+    @property
+    def stores_as_int(self) -> bool:
+        return self.hash_length == INT_HASH_LENGTH
+
+    def db_values(self, hash_value: bytes) -> Tuple[Optional[bytes], Optional[int]]:
+        return hash_db_values(hash_value, self.hash_length)
 
     def count_file_hashes(self, db: Database) -> int:
-        count_rows = db.select(
-            "SELECT COUNT(*) FROM submission_snapshot_file_hashes WHERE algo_id = %s",
-            (self.algo_id,)
-        )
+        count_rows = db.select(_COUNT_ALGO_HASHES, (self.algo_id,))
         if count_rows:
             return count_rows[0][0]
         return 0
 
-    def to_web_json(self, db: Database) -> Dict:
+    async def count_file_hashes_async(self, db: AsyncDatabase) -> int:
+        count_rows = await db.select(_COUNT_ALGO_HASHES, (self.algo_id,))
+        if count_rows:
+            return count_rows[0][0]
+        return 0
+
+    def _web_json(self, num_file_hashes: int) -> Dict:
         return {
             "algo_id": self.algo_id,
             "language": self.language,
             "algorithm_name": self.algorithm_name,
-            "num_file_hashes": self.count_file_hashes(db),
+            "hash_length": self.hash_length,
+            "num_file_hashes": num_file_hashes,
         }
+
+    def to_web_json(self, db: Database) -> Dict:
+        return self._web_json(self.count_file_hashes(db))
+
+    async def to_web_json_async(self, db: AsyncDatabase) -> Dict:
+        return self._web_json(await self.count_file_hashes_async(db))
     
     def _create(self, db: Database) -> None:
         algo_rows = db.insert(
             "WITH e AS ( "
-            "INSERT INTO hash_algos (language, algorithm_name) "
-            "VALUES (%s, %s) "
+            "INSERT INTO hash_algos (language, algorithm_name, hash_length) "
+            "VALUES (%s, %s, %s) "
             "ON CONFLICT (language, algorithm_name) DO NOTHING "
-            "RETURNING algo_id "
+            "RETURNING algo_id, hash_length "
             ") SELECT * FROM e "
-            "UNION SELECT algo_id FROM hash_algos "
+            "UNION SELECT algo_id, hash_length FROM hash_algos "
             "WHERE language = %s AND algorithm_name = %s",
-            (self.language, self.algorithm_name, self.language, self.algorithm_name)
+            (self.language, self.algorithm_name, self.hash_length, self.language, self.algorithm_name)
         )
         if not algo_rows:
             algo_rows = db.select(
-                "SELECT algo_id FROM hash_algos WHERE language = %s AND algorithm_name = %s",
+                "SELECT algo_id, hash_length FROM hash_algos WHERE language = %s AND algorithm_name = %s",
                 (self.language, self.algorithm_name)
             )
-        self.algo_id = algo_rows[0][0]
+        algo_id, hash_length = algo_rows[0]
+        if hash_length is None and self.hash_length is not None:
+            hash_length = self._set_hash_length(db, algo_id)
+        if self.hash_length is not None and hash_length != self.hash_length:
+            raise ValueError(
+                f"Hash algorithm {self.language} {self.algorithm_name} is stored with hash length {hash_length}, "
+                f"not {self.hash_length}. Existing hashes may need migrating, see faexport_db.migrate"
+            )
+        self.algo_id = algo_id
+        self.hash_length = hash_length
+        _hash_lengths[algo_id] = hash_length
+
+    def _set_hash_length(self, db: Database, algo_id: int) -> Optional[int]:
+        # A length can only be given to an algorithm with no hashes yet, otherwise they would be stored wrongly
+        length_rows = db.insert(
+            "UPDATE hash_algos SET hash_length = %s "
+            "WHERE algo_id = %s AND hash_length IS NULL "
+            "AND NOT EXISTS (SELECT 1 FROM submission_snapshot_file_hashes WHERE algo_id = %s) "
+            "RETURNING hash_length",
+            (self.hash_length, algo_id, algo_id)
+        )
+        if not length_rows:
+            return None
+        return length_rows[0][0]
     
     def save(self, db: Database) -> None:
         if self.algo_id is None:
@@ -315,31 +451,51 @@ class HashAlgo:
     
     @classmethod
     def list_all(cls, db: Database) -> List["HashAlgo"]:
-        algo_rows = db.select(
-            "SELECT algo_id, language, algorithm_name FROM hash_algos",
-            tuple()
-        )
+        return cls._list_from_rows(db.select(_SELECT_ALL_ALGOS, tuple()))
+
+    @classmethod
+    async def list_all_async(cls, db: AsyncDatabase) -> List["HashAlgo"]:
+        return cls._list_from_rows(await db.select(_SELECT_ALL_ALGOS, tuple()))
+
+    @classmethod
+    def _list_from_rows(cls, algo_rows: List) -> List["HashAlgo"]:
         hash_algos = []
         for algo_row in algo_rows:
-            algo_id, language, name = algo_row
+            algo_id, language, name, hash_length = algo_row
+            _hash_lengths[algo_id] = hash_length
             hash_algos.append(HashAlgo(
                 language,
                 name,
+                hash_length=hash_length,
                 algo_id=algo_id,
             ))
         return hash_algos
 
+    @classmethod
+    def hash_length_for_algo_id(cls, db: Database, algo_id: int) -> Optional[int]:
+        if algo_id not in _hash_lengths:
+            cls.list_all(db)
+        if algo_id not in _hash_lengths:
+            raise ValueError(f"Hash algorithm does not exist by ID: {algo_id}")
+        return _hash_lengths[algo_id]
+
     @classmethod
     def from_database(cls, db: Database, algo_id: int) -> Optional["HashAlgo"]:
-        algo_rows = db.select(
-            "SELECT language, algorithm_name FROM hash_algos WHERE algo_id = %s",
-            (algo_id,)
-        )
+        return cls._from_rows(algo_id, db.select(_SELECT_ALGO_BY_ID, (algo_id,)))
+
+    @classmethod
+    async def from_database_async(cls, db: AsyncDatabase, algo_id: int) -> Optional["HashAlgo"]:
+        return cls._from_rows(algo_id, await db.select(_SELECT_ALGO_BY_ID, (algo_id,)))
+
+    @classmethod
+    def _from_rows(cls, algo_id: int, algo_rows: List) -> Optional["HashAlgo"]:
         if not algo_rows:
             return None
-        language, name = algo_rows[0]
+        language, name, hash_length = algo_rows[0]
+        _hash_lengths[algo_id] = hash_length
         return cls(
             language,
             name,
+            hash_length=hash_length,
             algo_id=algo_id,
         )
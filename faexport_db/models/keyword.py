@@ -1,6 +1,20 @@
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, TYPE_CHECKING
 
-from faexport_db.db import Database
+from faexport_db.db import Database, chunks
+from faexport_db.models.snapshot_digest import content_digest
+
+if TYPE_CHECKING:
+    from faexport_db.async_db import AsyncDatabase
+
+_SELECT_KEYWORDS_FOR_SNAPSHOTS = (
+    "SELECT k.keyword_id, s.submission_snapshot_id, k.keyword, k.ordinal "
+    "FROM submission_snapshots s "
+    "JOIN submission_snapshot_keywords k ON s.keyword_set_id = k.keyword_set_id "
+    "WHERE s.submission_snapshot_id IN %s"
+)
+_SELECT_KEYWORD_SETS_BY_DIGEST = (
+    "SELECT content_digest, keyword_set_id FROM submission_keyword_sets WHERE content_digest IN %s"
+)
 
 
 class SubmissionKeyword:
@@ -30,58 +44,76 @@ class SubmissionKeyword:
             ordinal=web_data.get("ordinal"),
         )
 
-    def create_snapshot(self, db: "Database") -> None:
-        keyword_rows = db.insert(
-            "INSERT INTO submission_snapshot_keywords "
-            "(submission_snapshot_id, keyword, ordinal) "
-            "VALUES (%s, %s, %s) "
-            "RETURNING keyword_id",
-            (self.submission_snapshot_id, self.keyword, self.ordinal)
+    @classmethod
+    def digest_data(cls, keywords: List["SubmissionKeyword"]) -> List[List]:
+        """Keywords in a fixed order, for digests which should not depend on the order keywords were listed in"""
+        return sorted(
+            ([keyword.keyword, keyword.ordinal] for keyword in keywords),
+            key=lambda keyword: (keyword[0], keyword[1] is None, keyword[1] or 0)
         )
-        self.keyword_id = keyword_rows[0][0]
-
-    def save(self, db: "Database", submission_snapshot_id: int) -> None:
-        self.submission_snapshot_id = submission_snapshot_id
-        if self.keyword_id is None:
-            self.create_snapshot(db)
 
     @classmethod
-    def save_batch(
+    def save_keyword_sets(
             cls,
             db: Database,
-            keywords: List["SubmissionKeyword"],
-            submission_snapshot_id: Optional[int]
-    ) -> None:
-        unsaved = [k for k in keywords if k.keyword_id is None]
-        keyword_ids = db.bulk_insert(
-            "submission_snapshot_keywords",
-            ("submission_snapshot_id", "keyword", "ordinal"),
-            [(k.submission_snapshot_id or submission_snapshot_id, k.keyword, k.ordinal) for k in unsaved],
-            "keyword_id"
-        )
-        for keyword, keyword_id in zip(unsaved, keyword_ids):
-            keyword.keyword_id = keyword_id
-            if keyword.submission_snapshot_id is None:
-                keyword.submission_snapshot_id = submission_snapshot_id
+            keyword_lists: List[Optional[List["SubmissionKeyword"]]],
+    ) -> List[Optional[int]]:
+        """
+        Saves lists of keywords as keyword sets, returning the keyword set ID of each list, or None where the list is
+        None. Keyword sets are stored by content digest, so only keyword lists which are not already stored are saved.
+        Each set is saved in the same transaction as its keywords, and a set saved concurrently by another writer is
+        shared. Concurrent writers must each have their own connection, as a Database's transaction belongs to its
+        connection, so servers use a PooledDatabase, which gives each request thread its own.
+        """
+        digests = [
+            content_digest(cls.digest_data(keywords)) if keywords is not None else None for keywords in keyword_lists
+        ]
+        with db.transaction():
+            set_ids = cls._keyword_set_ids_by_digest(db, list({digest for digest in digests if digest is not None}))
+            new_sets: Dict[bytes, List[SubmissionKeyword]] = {}
+            for digest, keywords in zip(digests, keyword_lists):
+                if digest is not None and digest not in set_ids:
+                    new_sets.setdefault(digest, keywords)
+            inserted_rows = db.bulk_insert_returning(
+                "submission_keyword_sets",
+                ("content_digest",),
+                [(digest,) for digest in new_sets.keys()],
+                ("content_digest", "keyword_set_id"),
+                on_conflict=" ON CONFLICT (content_digest) DO NOTHING",
+            )
+            inserted_set_ids = {bytes(digest): set_id for digest, set_id in inserted_rows}
+            set_ids.update(inserted_set_ids)
+            # Sets inserted by another writer in the meantime were skipped, and already have their keywords
+            set_ids.update(cls._keyword_set_ids_by_digest(db, [
+                digest for digest in new_sets.keys() if digest not in inserted_set_ids
+            ]))
+            new_keywords = [
+                (inserted_set_ids[digest], keyword)
+                for digest, keywords in new_sets.items()
+                if digest in inserted_set_ids
+                for keyword in keywords
+            ]
+            keyword_ids = db.bulk_insert(
+                "submission_snapshot_keywords",
+                ("keyword_set_id", "keyword", "ordinal"),
+                [(set_id, keyword.keyword, keyword.ordinal) for set_id, keyword in new_keywords],
+                "keyword_id"
+            )
+            for (_, keyword), keyword_id in zip(new_keywords, keyword_ids):
+                keyword.keyword_id = keyword_id
+        return [set_ids[digest] if digest is not None else None for digest in digests]
+
+    @classmethod
+    def _keyword_set_ids_by_digest(cls, db: Database, digests: List[bytes]) -> Dict[bytes, int]:
+        set_ids = {}
+        for digests_chunk in chunks(digests, 1000):
+            for digest, set_id in db.select(_SELECT_KEYWORD_SETS_BY_DIGEST, (tuple(digests_chunk),)):
+                set_ids[bytes(digest)] = set_id
+        return set_ids
 
     @classmethod
     def list_for_submission_snapshot(cls, db: Database, submission_snapshot_id: int) -> List["SubmissionKeyword"]:
-        keyword_rows = db.select(
-            "SELECT keyword_id, keyword, ordinal "
-            "FROM submission_snapshot_keywords "
-            "WHERE submission_snapshot_id = %s",
-            (submission_snapshot_id,)
-        )
-        keywords = []
-        for keyword_row in keyword_rows:
-            keyword_id, keyword, ordinal = keyword_row
-            keywords.append(SubmissionKeyword(
-                keyword,
-                submission_snapshot_id=submission_snapshot_id,
-                keyword_id=keyword_id,
-                ordinal=ordinal
-            ))
-        return keywords
+        return cls.list_for_submission_snapshots_batch(db, [submission_snapshot_id])
 
     @classmethod
     def list_for_submission_snapshots_batch(
@@ -89,14 +121,24 @@ class SubmissionKeyword:
             db: Database,
             submission_snapshot_ids: List[int]
     ) -> List["SubmissionKeyword"]:
-        keyword_rows = db.select(
-            "SELECT keyword_id, submission_snapshot_id, keyword, ordinal "
-            "FROM submission_snapshot_keywords "
-            "WHERE submission_snapshot_id IN %s",
-            (tuple(submission_snapshot_ids),)
-        )
         if not submission_snapshot_ids:
             return []
+        return cls._list_from_rows(db.select(_SELECT_KEYWORDS_FOR_SNAPSHOTS, (tuple(submission_snapshot_ids),)))
+
+    @classmethod
+    async def list_for_submission_snapshots_batch_async(
+            cls,
+            db: "AsyncDatabase",
+            submission_snapshot_ids: List[int]
+    ) -> List["SubmissionKeyword"]:
+        if not submission_snapshot_ids:
+            return []
+        return cls._list_from_rows(
+            await db.select(_SELECT_KEYWORDS_FOR_SNAPSHOTS, (tuple(submission_snapshot_ids),))
+        )
+
+    @classmethod
+    def _list_from_rows(cls, keyword_rows: List) -> List["SubmissionKeyword"]:
         keywords = []
         for keyword_row in keyword_rows:
             keyword_id, submission_snapshot_id, keyword, ordinal = keyword_row
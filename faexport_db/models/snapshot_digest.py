@@ -0,0 +1,81 @@
+import datetime
+import hashlib
+import json
+from typing import Any, Dict, List, Tuple, TypeVar, Callable, Union, Sequence
+
+from faexport_db import serializer
+from faexport_db.db import Database, chunks
+
+S = TypeVar("S")
+EntityKey = Tuple[str, str]
+# Snapshot ID, content digest and scan datetime of the latest stored snapshot of an entity
+LatestSnapshot = Tuple[int, bytes, datetime.datetime]
+
+
+def content_digest(data: Any) -> bytes:
+    """
+    Digest of a snapshot's content, for spotting snapshots identical to one already stored.
+    The stdlib encoder is always used with sorted keys, so that digests do not depend on the serializer backend.
+    """
+    encoded = json.dumps(data, sort_keys=True, separators=(",", ":"), default=serializer.default)
+    return hashlib.sha256(encoded.encode()).digest()
+
+
+def latest_snapshots(
+        db: Database,
+        query: str,
+        keys: List[EntityKey],
+        chunk_size: int = 1000,
+) -> Dict[EntityKey, LatestSnapshot]:
+    """Runs a latest snapshot query, which selects (website_id, site_id, snapshot_id, digest, scan_datetime) rows"""
+    latest = {}
+    for keys_chunk in chunks(sorted(set(keys)), chunk_size):
+        for website_id, site_id, snapshot_id, digest, scan_datetime in db.select(query, (tuple(keys_chunk),)):
+            latest[(website_id, site_id)] = (snapshot_id, bytes(digest) if digest is not None else None, scan_datetime)
+    return latest
+
+
+def split_repeats(
+        snapshots: Sequence[S],
+        latest: Dict[EntityKey, LatestSnapshot],
+        entity_key: Callable[[S], EntityKey],
+        digest: Callable[[S], bytes],
+) -> Tuple[List[S], List[Tuple[S, Union[int, S]]]]:
+    """
+    Splits snapshots into those which need saving, and repeats which are identical to the latest snapshot of the same
+    entity, either stored or earlier in the batch. Repeats are paired with the snapshot ID or snapshot they repeat.
+    A snapshot scanned before the latest one is never a repeat, as its content may since have changed and changed back.
+    """
+    new_snapshots = []
+    repeats = []
+    current: Dict[EntityKey, Tuple[Union[int, S], bytes, datetime.datetime]] = dict(latest)
+    for snapshot in snapshots:
+        key = entity_key(snapshot)
+        snapshot_digest = digest(snapshot)
+        match = current.get(key)
+        if match is not None and snapshot.scan_datetime < match[2]:
+            new_snapshots.append(snapshot)
+            continue
+        if match is not None and match[1] == snapshot_digest:
+            repeats.append((snapshot, match[0]))
+            continue
+        new_snapshots.append(snapshot)
+        current[key] = (snapshot, snapshot_digest, snapshot.scan_datetime)
+    return new_snapshots, repeats
+
+
+def record_seen(
+        db: Database,
+        table_name: str,
+        id_column: str,
+        seen: Dict[int, datetime.datetime],
+        chunk_size: int = 1000,
+) -> None:
+    """Moves the last seen datetime of stored snapshots forward, for snapshots which have been scanned again"""
+    for seen_chunk in chunks(sorted(seen.items()), chunk_size):
+        db.update(
+            f"UPDATE {table_name} t SET last_seen_datetime = GREATEST(t.last_seen_datetime, v.seen) "
+            "FROM (VALUES " + ", ".join("(%s, %s)" for _ in seen_chunk) + ") AS v (snapshot_id, seen) "
+            f"WHERE t.{id_column} = v.snapshot_id",
+            tuple(value for seen_row in seen_chunk for value in seen_row)
+        )
@@ -1,7 +1,9 @@
 from __future__ import annotations
 import datetime
-from typing import Optional, Dict, Any, List, Iterable
+from typing import Optional, Dict, Any, List, Tuple, Iterable, AsyncIterator, TYPE_CHECKING
 
+from faexport_db.cache import response_cache, ENTITY_SUBMISSION
+from faexport_db.change_feed import record_new_snapshots
 from faexport_db.db import (
     merge_dicts,
     Database,
@@ -9,8 +11,85 @@ from faexport_db.db import (
     parse_datetime,
 )
 from faexport_db.models.archive_contributor import ArchiveContributor
-from faexport_db.models.file import File, HashAlgo
+from faexport_db.models.file import File, FileHash, HashAlgo
 from faexport_db.models.keyword import SubmissionKeyword
+from faexport_db.models.snapshot_digest import content_digest, latest_snapshots, split_repeats, record_seen
+from faexport_db.models.version import EntityVersion
+
+if TYPE_CHECKING:
+    from faexport_db.async_db import AsyncDatabase
+
+_SNAPSHOT_COLUMNS = (
+    "s.submission_snapshot_id, s.website_id, s.site_submission_id, s.scan_datetime, "
+    "s.archive_contributor_id, a.name as contributor_name, s.ingest_datetime, s.uploader_site_user_id, "
+    "s.is_deleted, s.title, s.description, s.datetime_posted, s.extra_data, s.last_seen_datetime "
+)
+_SELECT_SNAPSHOTS_FOR_SUBMISSION = (
+    "SELECT " + _SNAPSHOT_COLUMNS +
+    "FROM submission_snapshots s "
+    "LEFT JOIN archive_contributors a ON s.archive_contributor_id = a.contributor_id "
+    "WHERE website_id = %s AND site_submission_id = %s"
+)
+_SELECT_VERSION = (
+    "SELECT COUNT(*), MAX(submission_snapshot_id), MAX(ingest_datetime), MAX(last_seen_datetime) "
+    "FROM submission_snapshots "
+    "WHERE website_id = %s AND site_submission_id = %s"
+)
+_SELECT_UNIQUE_SITE_IDS = "SELECT DISTINCT site_submission_id FROM submission_snapshots WHERE website_id = %s"
+# Submissions are listed by their latest recorded uploader, so that a submission whose uploader changed is only listed
+# for the current uploader. Candidates come from the uploader index, and the latest uploader of each is found with
+# DISTINCT ON over the latest uploader index, which returns them in site ID order, so a page stops once it is full.
+# Site IDs are text, so pages are in text order, where numeric IDs sort lexicographically ("10" before "9").
+_SELECT_SITE_IDS_FOR_UPLOADER = (
+    "SELECT l.site_submission_id FROM ( "
+    "SELECT DISTINCT ON (s.site_submission_id) s.site_submission_id, s.uploader_site_user_id "
+    "FROM submission_snapshots s "
+    "JOIN ( "
+    "SELECT DISTINCT site_submission_id FROM submission_snapshots "
+    "WHERE website_id = %s AND uploader_site_user_id = %s AND site_submission_id > %s "
+    ") c ON c.site_submission_id = s.site_submission_id "
+    "WHERE s.website_id = %s AND s.uploader_site_user_id IS NOT NULL "
+    "ORDER BY s.site_submission_id, s.scan_datetime DESC, s.submission_snapshot_id DESC "
+    ") l "
+    "WHERE l.uploader_site_user_id = %s "
+    "ORDER BY l.site_submission_id LIMIT %s"
+)
+# Date columns which submissions can be listed by, keyed by the name used in the API
+SUBMISSION_DATE_COLUMNS = {
+    "posted": "datetime_posted",
+    "scanned": "scan_datetime",
+    "ingested": "ingest_datetime",
+}
+# Snapshots dated within a range are listed in date order, paged by a (date, snapshot ID) keyset. The lower bound of
+# each page is the date of its cursor, so the BRIN index on the date column only scans from there to the range end
+_SELECT_SNAPSHOTS_BY_DATE = {
+    date_name: (
+        f"SELECT submission_snapshot_id, site_submission_id, {date_column} FROM submission_snapshots "
+        f"WHERE website_id = %s AND {date_column} >= %s AND {date_column} < %s "
+        f"AND ({date_column}, submission_snapshot_id) > (%s, %s) "
+        f"ORDER BY {date_column}, submission_snapshot_id LIMIT %s"
+    )
+    for date_name, date_column in SUBMISSION_DATE_COLUMNS.items()
+}
+_SELECT_LATEST_SNAPSHOTS = (
+    "SELECT DISTINCT ON (website_id, site_submission_id) "
+    "website_id, site_submission_id, submission_snapshot_id, content_digest, scan_datetime "
+    "FROM submission_snapshots "
+    "WHERE (website_id, site_submission_id) IN %s "
+    "ORDER BY website_id, site_submission_id, scan_datetime DESC, submission_snapshot_id DESC"
+)
+_SEARCH_BY_FILE_HASH = (
+    "SELECT " + _SNAPSHOT_COLUMNS +
+    "FROM submission_hash_lookup l "
+    "JOIN submission_snapshots s ON l.submission_snapshot_id = s.submission_snapshot_id "
+    "LEFT JOIN archive_contributors a ON s.archive_contributor_id = a.contributor_id "
+    "WHERE l.algo_id = %s AND l.hash_value = %s"
+)
+_SEARCH_HASH_LOOKUP = (
+    "SELECT website_id, site_submission_id, submission_snapshot_id, file_id "
+    "FROM submission_hash_lookup "
+    "WHERE algo_id = %s AND hash_value = %s"
+)
 
 
 class Submission:
@@ -39,6 +118,10 @@ class Submission:
     @property
     def latest_update(self) -> datetime.datetime:
         return self.sorted_snapshots[0].scan_datetime
+
+    @property
+    def last_seen(self) -> datetime.datetime:
+        return max(snapshot.last_seen for snapshot in self.snapshots)
     
     @property
     def uploader_site_user_id(self) -> Optional[str]:
@@ -111,6 +194,7 @@ class Submission:
                 "snapshot_count": len(self.snapshots),
                 "first_scanned": self.first_scanned,
                 "latest_update": self.latest_update,
+                "last_seen": self.last_seen,
             },
             "submission_data": {
                 "is_deleted": self.is_deleted,
@@ -136,69 +220,108 @@ class Submission:
     def from_database(
         cls, db: "Database", website_id: str, site_submission_id: str
     ) -> Optional["Submission"]:
-        snapshot_rows = db.select(
-            "SELECT s.submission_snapshot_id, s.scan_datetime, s.archive_contributor_id, a.name as contributor_name, "
-            "s.ingest_datetime, s.uploader_site_user_id, s.is_deleted, s.title, s.description, s.datetime_posted, "
-            "s.extra_data "
-            "FROM submission_snapshots s "
-            "LEFT JOIN archive_contributors a ON s.archive_contributor_id = a.contributor_id "
-            "WHERE website_id = %s AND site_submission_id = %s",
-            (website_id, site_submission_id)
-        )
-        snapshots = []
-        contributors = {}
-        snapshot_rows = list(snapshot_rows)
+        snapshot_rows = db.select(_SELECT_SNAPSHOTS_FOR_SUBMISSION, (website_id, site_submission_id))
         if not snapshot_rows:
             return None
         snapshot_ids = [row[0] for row in snapshot_rows]
         all_keywords = SubmissionKeyword.list_for_submission_snapshots_batch(db, snapshot_ids)
         all_files = File.list_for_submission_snapshots_batch(db, snapshot_ids)
-        for row in snapshot_rows:
-            (
-                submission_snapshot_id, scan_datetime, contributor_id, contributor_name, ingest_datetime,
-                uploader_site_user_id, is_deleted, title, description, datetime_posted, extra_data
-            ) = row
-            contributor = contributors.get(contributor_id)
-            if contributor is None:
-                contributor = ArchiveContributor(contributor_name, contributor_id=contributor_id)
-                contributors[contributor_id] = contributor
-            # Load keywords
-            keywords = [keyword for keyword in all_keywords if keyword.submission_snapshot_id == submission_snapshot_id]
-            # Load files
-            files = [file for file in all_files if file.submission_snapshot_id == submission_snapshot_id]
-            snapshots.append(SubmissionSnapshot(
-                website_id,
-                site_submission_id,
-                contributor,
-                scan_datetime,
-                submission_snapshot_id=submission_snapshot_id,
-                ingest_datetime=ingest_datetime,
-                uploader_site_user_id=uploader_site_user_id,
-                is_deleted=is_deleted,
-                title=title,
-                description=description,
-                datetime_posted=datetime_posted,
-                extra_data=extra_data,
-                keywords=keywords,
-                files=files,
-            ))
-        if not snapshots:
+        snapshots = SubmissionSnapshot._list_from_rows(snapshot_rows, all_keywords, all_files)
+        return cls(website_id, site_submission_id, snapshots)
+
+    @classmethod
+    async def from_database_async(
+        cls, db: "AsyncDatabase", website_id: str, site_submission_id: str
+    ) -> Optional["Submission"]:
+        snapshot_rows = await db.select(_SELECT_SNAPSHOTS_FOR_SUBMISSION, (website_id, site_submission_id))
+        if not snapshot_rows:
             return None
-        return Submission(
-            website_id,
-            site_submission_id,
-            snapshots
-        )
+        snapshot_ids = [row[0] for row in snapshot_rows]
+        all_keywords = await SubmissionKeyword.list_for_submission_snapshots_batch_async(db, snapshot_ids)
+        all_files = await File.list_for_submission_snapshots_batch_async(db, snapshot_ids)
+        snapshots = SubmissionSnapshot._list_from_rows(snapshot_rows, all_keywords, all_files)
+        return cls(website_id, site_submission_id, snapshots)
+
+    @classmethod
+    def version_from_database(cls, db: Database, website_id: str, site_submission_id: str) -> Optional[EntityVersion]:
+        version_rows = db.select(_SELECT_VERSION, (website_id, site_submission_id))
+        return EntityVersion.from_row(version_rows[0])
+
+    @classmethod
+    async def version_from_database_async(
+            cls, db: "AsyncDatabase", website_id: str, site_submission_id: str
+    ) -> Optional[EntityVersion]:
+        version_rows = await db.select(_SELECT_VERSION, (website_id, site_submission_id))
+        return EntityVersion.from_row(version_rows[0])
 
     @classmethod
     def list_unique_site_ids(cls, db: Database, website_id: str) -> Iterable[str]:
-        submission_rows = db.select_iter(
-            "SELECT DISTINCT site_submission_id FROM submission_snapshots WHERE website_id = %s",
-            (website_id,)
-        )
+        submission_rows = db.select_iter(_SELECT_UNIQUE_SITE_IDS, (website_id,))
         for submission_row in submission_rows:
             yield submission_row[0]
 
+    @classmethod
+    async def list_unique_site_ids_async(cls, db: "AsyncDatabase", website_id: str) -> AsyncIterator[str]:
+        async for submission_row in db.select_iter(_SELECT_UNIQUE_SITE_IDS, (website_id,)):
+            yield submission_row[0]
+
+    @classmethod
+    def list_site_ids_for_uploader(
+            cls, db: Database, website_id: str, site_user_id: str, *, after: str = "", limit: int = 100
+    ) -> List[str]:
+        """Lists a page of the IDs of submissions uploaded by a user, in site ID order, after the given site ID"""
+        submission_rows = db.select(
+            _SELECT_SITE_IDS_FOR_UPLOADER, (website_id, site_user_id, after, website_id, site_user_id, limit)
+        )
+        return [submission_row[0] for submission_row in submission_rows]
+
+    @classmethod
+    async def list_site_ids_for_uploader_async(
+            cls, db: "AsyncDatabase", website_id: str, site_user_id: str, *, after: str = "", limit: int = 100
+    ) -> List[str]:
+        submission_rows = await db.select(
+            _SELECT_SITE_IDS_FOR_UPLOADER, (website_id, site_user_id, after, website_id, site_user_id, limit)
+        )
+        return [submission_row[0] for submission_row in submission_rows]
+
+    @classmethod
+    def list_snapshots_by_date(
+            cls,
+            db: Database,
+            website_id: str,
+            date_name: str,
+            start: datetime.datetime,
+            end: datetime.datetime,
+            *,
+            after: Optional[Tuple[datetime.datetime, int]] = None,
+            limit: int = 100,
+    ) -> List[Tuple[int, str, datetime.datetime]]:
+        """
+        Lists a page of the snapshot ID, site submission ID, and date of snapshots dated from start up to end, by one
+        of the SUBMISSION_DATE_COLUMNS, in date order, after the given date and snapshot ID
+        """
+        after_date, after_id = after or (start, 0)
+        return db.select(
+            _SELECT_SNAPSHOTS_BY_DATE[date_name], (website_id, max(start, after_date), end, after_date, after_id, limit)
+        )
+
+    @classmethod
+    async def list_snapshots_by_date_async(
+            cls,
+            db: "AsyncDatabase",
+            website_id: str,
+            date_name: str,
+            start: datetime.datetime,
+            end: datetime.datetime,
+            *,
+            after: Optional[Tuple[datetime.datetime, int]] = None,
+            limit: int = 100,
+    ) -> List[Tuple[int, str, datetime.datetime]]:
+        after_date, after_id = after or (start, 0)
+        return await db.select(
+            _SELECT_SNAPSHOTS_BY_DATE[date_name], (website_id, max(start, after_date), end, after_date, after_id, limit)
+        )
+
 
 class SubmissionSnapshot:
     def __init__(
@@ -220,6 +343,7 @@ class SubmissionSnapshot:
         ordered_keywords: List[str] = None,
         unordered_keywords: List[str] = None,
         files: List[File] = None,
+        last_seen_datetime: datetime.datetime = None,
     ):
         self.website_id = website_id
         self.site_submission_id = site_submission_id
@@ -248,10 +372,30 @@ class SubmissionSnapshot:
         if unordered_keywords is not None:
             self.keywords = SubmissionKeyword.list_from_unordered_keywords(unordered_keywords)
         self.files: Optional[List[File]] = files
+        # Latest scan which found this snapshot's content unchanged, if it has been scanned again
+        self.last_seen_datetime = last_seen_datetime
     
     @property
     def keywords_recorded(self) -> bool:
         return self.keywords is not None
+
+    @property
+    def last_seen(self) -> datetime.datetime:
+        return max(self.scan_datetime, self.last_seen_datetime or self.scan_datetime)
+
+    @property
+    def content_digest(self) -> bytes:
+        """Digest of everything the snapshot records about the submission, excluding when and by whom it was scanned"""
+        keywords = None
+        if self.keywords is not None:
+            keywords = SubmissionKeyword.digest_data(self.keywords)
+        files = None
+        if self.files is not None:
+            files = sorted(file.content_digest for file in self.files)
+        return content_digest([
+            self.website_id, self.site_submission_id, self.uploader_site_user_id, self.is_deleted, self.title,
+            self.description, self.datetime_posted, self.extra_data, keywords, files
+        ])
     
     def to_web_json(self) -> Dict:
         keywords = None
@@ -265,6 +409,7 @@ class SubmissionSnapshot:
                 "scan_datetime": self.scan_datetime,
                 "archive_contributor": self.contributor.to_web_json(),
                 "ingest_datetime": self.ingest_datetime,
+                "last_seen_datetime": self.last_seen,
             },
             "submission_data": {
                 "uploader_site_user_id": self.uploader_site_user_id,
@@ -305,65 +450,83 @@ class SubmissionSnapshot:
             files=files,
         )
 
-    def create_snapshot(self, db: "Database") -> None:
-        snapshot_rows = db.insert(
-            "INSERT INTO submission_snapshots "
-            "(website_id, site_submission_id, scan_datetime, archive_contributor_id, ingest_datetime, "
-            "uploader_site_user_id, is_deleted, title, description, datetime_posted, keywords_recorded, extra_data) "
-            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) "
-            "RETURNING submission_snapshot_id ",
-            (
-                self.website_id, self.site_submission_id, self.scan_datetime, self.contributor.contributor_id,
-                self.ingest_datetime, self.uploader_site_user_id, self.is_deleted, self.title, self.description,
-                self.datetime_posted, self.keywords_recorded, json_to_db(self.extra_data),
-            )
-        )
-        self.submission_snapshot_id = snapshot_rows[0][0]
-        # Save keywords
-        if self.keywords is not None:
-            SubmissionKeyword.save_batch(db, self.keywords, self.submission_snapshot_id)
-        # Save files
-        if self.files is not None:
-            File.save_batch(db, self.files, self.submission_snapshot_id)
-
     def save(self, db: "Database") -> None:
         if self.submission_snapshot_id is None:
-            self.create_snapshot(db)
+            self.save_batch(db, [self])
 
     @classmethod
-    def save_batch(cls, db: Database, snapshots: List["SubmissionSnapshot"]) -> None:
-        unsaved = [snapshot for snapshot in snapshots if snapshot.submission_snapshot_id is None]
-        snapshot_ids = db.bulk_insert(
-            "submission_snapshots",
-            (
-                "website_id", "site_submission_id", "scan_datetime", "archive_contributor_id", "ingest_datetime",
-                "uploader_site_user_id", "is_deleted", "title", "description", "datetime_posted", "keywords_recorded",
-                "extra_data"
-            ),
-            [
+    def save_batch(cls, db: Database, snapshots: List["SubmissionSnapshot"], *, skip_repeats: bool = True) -> None:
+        """
+        Saves new snapshots. Snapshots identical to the latest known snapshot of their submission are not stored again,
+        instead they are given that snapshot's ID, and its last seen datetime is updated.
+        Everything is saved in one transaction, so a stored snapshot's content digest always covers keywords, files and
+        hashes which were saved with it, and later repeats of it can safely be skipped.
+        """
+        with db.transaction():
+            unsaved = [snapshot for snapshot in snapshots if snapshot.submission_snapshot_id is None]
+            repeats = []
+            if skip_repeats:
+                entity_keys = [(snapshot.website_id, snapshot.site_submission_id) for snapshot in unsaved]
+                latest = latest_snapshots(db, _SELECT_LATEST_SNAPSHOTS, entity_keys)
+                unsaved, repeats = split_repeats(
+                    unsaved, latest, lambda s: (s.website_id, s.site_submission_id), lambda s: s.content_digest
+                )
+            for snapshot, original in repeats:
+                if isinstance(original, SubmissionSnapshot):
+                    original.last_seen_datetime = max(original.last_seen, snapshot.scan_datetime)
+            # Check hashes first, so that an invalid hash does not leave behind partially saved snapshots
+            FileHash.validate_batch(
+                db, [file_hash for snapshot in unsaved for file in snapshot.files or [] for file_hash in file.hashes]
+            )
+            # Keywords are saved first, as snapshots reference their keyword set
+            keyword_set_ids = SubmissionKeyword.save_keyword_sets(db, [snapshot.keywords for snapshot in unsaved])
+            snapshot_ids = db.bulk_insert(
+                "submission_snapshots",
                 (
-                    snapshot.website_id, snapshot.site_submission_id, snapshot.scan_datetime,
-                    snapshot.contributor.contributor_id, snapshot.ingest_datetime, snapshot.uploader_site_user_id,
-                    snapshot.is_deleted, snapshot.title, snapshot.description, snapshot.datetime_posted,
-                    snapshot.keywords_recorded, json_to_db(snapshot.extra_data))
-                for snapshot in unsaved
-            ],
-            "submission_snapshot_id"
+                    "website_id", "site_submission_id", "scan_datetime", "archive_contributor_id", "ingest_datetime",
+                    "uploader_site_user_id", "is_deleted", "title", "description", "datetime_posted",
+                    "keywords_recorded", "extra_data", "content_digest", "last_seen_datetime", "keyword_set_id"
+                ),
+                [
+                    (
+                        snapshot.website_id, snapshot.site_submission_id, snapshot.scan_datetime,
+                        snapshot.contributor.contributor_id, snapshot.ingest_datetime, snapshot.uploader_site_user_id,
+                        snapshot.is_deleted, snapshot.title, snapshot.description, snapshot.datetime_posted,
+                        snapshot.keywords_recorded, json_to_db(snapshot.extra_data), snapshot.content_digest,
+                        snapshot.last_seen_datetime, keyword_set_id)
+                    for snapshot, keyword_set_id in zip(unsaved, keyword_set_ids)
+                ],
+                "submission_snapshot_id"
+            )
+            for snapshot, snapshot_id in zip(unsaved, snapshot_ids):
+                snapshot.submission_snapshot_id = snapshot_id
+                if snapshot.keywords is not None:
+                    for keyword in snapshot.keywords:
+                        keyword.submission_snapshot_id = snapshot_id
+                if snapshot.files is not None:
+                    for file in snapshot.files:
+                        file.submission_snapshot_id = snapshot_id
+            # Repeats share the ID of the snapshot they repeat, and stored snapshots record that they were seen again
+            seen = {}
+            for snapshot, original in repeats:
+                if isinstance(original, SubmissionSnapshot):
+                    snapshot.submission_snapshot_id = original.submission_snapshot_id
+                    continue
+                snapshot.submission_snapshot_id = original
+                seen[original] = max(seen.get(original, snapshot.scan_datetime), snapshot.scan_datetime)
+            record_seen(db, "submission_snapshots", "submission_snapshot_id", seen)
+            # Save files
+            files = sum([snapshot.files for snapshot in unsaved if snapshot.files is not None], start=[])
+            File.save_batch(db, files, None)
+            SubmissionHashMatch.save_batch(db, SubmissionHashMatch.snapshot_hashes(unsaved))
+            record_new_snapshots(db, ENTITY_SUBMISSION, [snapshot.submission_snapshot_id for snapshot in unsaved])
+        # Cached responses are only dropped once the new snapshots are committed and visible
+        response_cache().invalidate(
+            {
+                (ENTITY_SUBMISSION, snapshot.website_id, snapshot.site_submission_id)
+                for snapshot in unsaved + [repeat for repeat, _ in repeats]
+            }
         )
-        for snapshot, snapshot_id in zip(unsaved, snapshot_ids):
-            snapshot.submission_snapshot_id = snapshot_id
-            if snapshot.keywords is not None:
-                for keyword in snapshot.keywords:
-                    keyword.submission_snapshot_id = snapshot_id
-            if snapshot.files is not None:
-                for file in snapshot.files:
-                    file.submission_snapshot_id = snapshot_id
-        # Save keywords
-        keywords = sum([snapshot.keywords for snapshot in snapshots if snapshot.keywords is not None], start=[])
-        SubmissionKeyword.save_batch(db, keywords, None)
-        # Save files
-        files = sum([snapshot.files for snapshot in snapshots if snapshot.files is not None], start=[])
-        File.save_batch(db, files, None)
 
     @classmethod
     def list_all(cls, db: Database, website_id: str) -> Iterable["SubmissionSnapshot"]:
@@ -371,12 +534,12 @@ class SubmissionSnapshot:
         snapshot_rows = db.select_iter(
             "SELECT submission_snapshot_id, website_id, site_submission_id, scan_datetime, archive_contributor_id, "
             "ingest_datetime, uploader_site_user_id, is_deleted, title, description, datetime_posted, "
-            "keywords_recorded, extra_data "
+            "keywords_recorded, extra_data, last_seen_datetime "
             "FROM submission_snapshots WHERE website_id = %s",
             (website_id,)
         )
         for snapshot_row in snapshot_rows:
-            snapshot_id, website_id, site_submission_id, scan_datetime, archive_contributor_id, ingest_datetime, uploader_site_user_id, is_deleted, title, description, datetime_posted, keywords_recorded, extra_data = snapshot_row
+            snapshot_id, website_id, site_submission_id, scan_datetime, archive_contributor_id, ingest_datetime, uploader_site_user_id, is_deleted, title, description, datetime_posted, keywords_recorded, extra_data, last_seen_datetime = snapshot_row
             contributor = contributors[archive_contributor_id]
             keywords = SubmissionKeyword.list_for_submission_snapshot(db, snapshot_id)
             files = File.list_for_submission_snapshot(db, snapshot_id)
@@ -395,31 +558,23 @@ class SubmissionSnapshot:
                 extra_data=extra_data,
                 keywords=keywords,
                 files=files,
+                last_seen_datetime=last_seen_datetime,
             )
 
     @classmethod
-    def search_by_file_hash(cls, db: Database, hash_algo: HashAlgo, hash_value: bytes) -> List[SubmissionSnapshot]:
-        snapshot_rows = db.select(
-            "SELECT s.submission_snapshot_id, s.website_id, s.site_submission_id, s.scan_datetime, "
-            "s.archive_contributor_id, a.name as contributor_name, s.ingest_datetime, s.uploader_site_user_id, "
-            "s.is_deleted, s.title, s.description, s.datetime_posted, s.extra_data "
-            "FROM submission_snapshot_file_hashes hashes "
-            "LEFT JOIN submission_snapshot_files files on files.file_id = hashes.file_id "
-            "LEFT JOIN submission_snapshots s ON files.submission_snapshot_id = s.submission_snapshot_id "
-            "LEFT JOIN archive_contributors a ON s.archive_contributor_id = a.contributor_id "
-            "WHERE algo_id = %s AND hash_value = %s",
-            (hash_algo.algo_id, hash_value)
-        )
+    def _list_from_rows(
+            cls,
+            snapshot_rows: List,
+            all_keywords: List[SubmissionKeyword],
+            all_files: List[File],
+    ) -> List["SubmissionSnapshot"]:
         contributors = {}
         snapshots = []
-        snapshot_rows = list(snapshot_rows)
-        snapshot_ids = [row[0] for row in snapshot_rows]
-        all_keywords = SubmissionKeyword.list_for_submission_snapshots_batch(db, snapshot_ids)
-        all_files = File.list_for_submission_snapshots_batch(db, snapshot_ids)
         for snapshot_row in snapshot_rows:
             (
                 submission_snapshot_id, website_id, site_submission_id, scan_datetime, contributor_id, contributor_name,
-                ingest_datetime, uploader_site_user_id, is_deleted, title, description, datetime_posted, extra_data
+                ingest_datetime, uploader_site_user_id, is_deleted, title, description, datetime_posted, extra_data,
+                last_seen_datetime,
             ) = snapshot_row
             contributor = contributors.get(contributor_id)
             if contributor is None:
@@ -444,5 +599,106 @@ class SubmissionSnapshot:
                 extra_data=extra_data,
                 keywords=keywords,
                 files=files,
+                last_seen_datetime=last_seen_datetime,
             ))
         return snapshots
+
+    @classmethod
+    def search_by_file_hash(cls, db: Database, hash_algo: HashAlgo, hash_value: bytes) -> List[SubmissionSnapshot]:
+        snapshot_rows = db.select(_SEARCH_BY_FILE_HASH, SubmissionHashMatch.search_args(hash_algo, hash_value))
+        snapshot_ids = [row[0] for row in snapshot_rows]
+        all_keywords = SubmissionKeyword.list_for_submission_snapshots_batch(db, snapshot_ids)
+        all_files = File.list_for_submission_snapshots_batch(db, snapshot_ids)
+        return cls._list_from_rows(snapshot_rows, all_keywords, all_files)
+
+    @classmethod
+    async def search_by_file_hash_async(
+            cls,
+            db: "AsyncDatabase",
+            hash_algo: HashAlgo,
+            hash_value: bytes,
+    ) -> List[SubmissionSnapshot]:
+        snapshot_rows = await db.select(_SEARCH_BY_FILE_HASH, SubmissionHashMatch.search_args(hash_algo, hash_value))
+        snapshot_ids = [row[0] for row in snapshot_rows]
+        all_keywords = await SubmissionKeyword.list_for_submission_snapshots_batch_async(db, snapshot_ids)
+        all_files = await File.list_for_submission_snapshots_batch_async(db, snapshot_ids)
+        return cls._list_from_rows(snapshot_rows, all_keywords, all_files)
+
+
+class SubmissionHashMatch:
+    """
+    A row of the hash lookup table, which maps file hashes straight to the submission snapshots and files they are
+    from, so that exact hash searches do not need to join through files and snapshots.
+    """
+    def __init__(
+            self,
+            website_id: str,
+            site_submission_id: str,
+            submission_snapshot_id: int,
+            file_id: int,
+    ) -> None:
+        self.website_id = website_id
+        self.site_submission_id = site_submission_id
+        self.submission_snapshot_id = submission_snapshot_id
+        self.file_id = file_id
+
+    def to_web_json(self) -> Dict:
+        return {
+            "website_id": self.website_id,
+            "site_submission_id": self.site_submission_id,
+            "submission_snapshot_id": self.submission_snapshot_id,
+            "file_id": self.file_id,
+        }
+
+    @classmethod
+    def search_args(cls, hash_algo: HashAlgo, hash_value: bytes) -> Tuple[int, bytes]:
+        # The lookup table stores every hash as bytes, even those stored as integers in the hashes table
+        hash_algo.db_values(hash_value)
+        return hash_algo.algo_id, bytes(hash_value)
+
+    @classmethod
+    def search(cls, db: Database, hash_algo: HashAlgo, hash_value: bytes) -> List["SubmissionHashMatch"]:
+        return cls._list_from_rows(db.select(_SEARCH_HASH_LOOKUP, cls.search_args(hash_algo, hash_value)))
+
+    @classmethod
+    async def search_async(
+            cls, db: "AsyncDatabase", hash_algo: HashAlgo, hash_value: bytes
+    ) -> List["SubmissionHashMatch"]:
+        return cls._list_from_rows(await db.select(_SEARCH_HASH_LOOKUP, cls.search_args(hash_algo, hash_value)))
+
+    @classmethod
+    def _list_from_rows(cls, lookup_rows: List) -> List["SubmissionHashMatch"]:
+        return [
+            cls(website_id, site_submission_id, submission_snapshot_id, file_id)
+            for website_id, site_submission_id, submission_snapshot_id, file_id in lookup_rows
+        ]
+
+    @classmethod
+    def snapshot_hashes(cls, snapshots: List[SubmissionSnapshot]) -> List[Tuple[SubmissionSnapshot, File, FileHash]]:
+        return [
+            (snapshot, file, file_hash)
+            for snapshot in snapshots
+            for file in snapshot.files or []
+            for file_hash in file.hashes
+        ]
+
+    @classmethod
+    def save_batch(cls, db: Database, new_hashes: List[Tuple[SubmissionSnapshot, File, FileHash]]) -> None:
+        """
+        Writes lookup rows for the file hashes of newly saved snapshots, given by snapshot_hashes() after saving.
+        Files are shared between snapshots, so each snapshot gets lookup rows even if its files were already stored.
+        """
+        db.bulk_insert_rows(
+            "submission_hash_lookup",
+            (
+                "hash_id", "algo_id", "hash_value", "website_id", "site_submission_id", "submission_snapshot_id",
+                "file_id",
+            ),
+            [
+                (
+                    file_hash.hash_id, file_hash.algo_id, bytes(file_hash.hash_value), snapshot.website_id,
+                    snapshot.site_submission_id, snapshot.submission_snapshot_id, file.file_id,
+                )
+                for snapshot, file, file_hash in new_hashes
+            ]
+        )
@@ -1,8 +1,69 @@
 import datetime
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple, TYPE_CHECKING
 
+from faexport_db.cache import response_cache, ENTITY_USER
+from faexport_db.change_feed import record_new_snapshots
 from faexport_db.db import merge_dicts, Database, json_to_db, parse_datetime
 from faexport_db.models.archive_contributor import ArchiveContributor
+from faexport_db.models.snapshot_digest import content_digest, latest_snapshots, split_repeats, record_seen
+from faexport_db.models.version import EntityVersion
+
+if TYPE_CHECKING:
+    from faexport_db.async_db import AsyncDatabase
+
+_SELECT_SNAPSHOTS_FOR_USER = (
+    "SELECT u.user_snapshot_id, u.scan_datetime, u.archive_contributor_id, a.name as contributor_name, "
+    "u.ingest_datetime, u.is_deleted, u.display_name, u.extra_data, u.last_seen_datetime "
+    "FROM user_snapshots u "
+    "LEFT JOIN archive_contributors a ON u.archive_contributor_id = a.contributor_id "
+    "WHERE website_id = %s AND site_user_id = %s"
+)
+_SELECT_VERSION = (
+    "SELECT COUNT(*), MAX(user_snapshot_id), MAX(ingest_datetime), MAX(last_seen_datetime) "
+    "FROM user_snapshots "
+    "WHERE website_id = %s AND site_user_id = %s"
+)
+_SELECT_UNIQUE_SITE_IDS = "SELECT DISTINCT site_user_id FROM user_snapshots WHERE website_id = %s"
+_SELECT_LATEST_SNAPSHOTS = (
+    "SELECT DISTINCT ON (website_id, site_user_id) "
+    "website_id, site_user_id, user_snapshot_id, content_digest, scan_datetime "
+    "FROM user_snapshots "
+    "WHERE (website_id, site_user_id) IN %s "
+    "ORDER BY website_id, site_user_id, scan_datetime DESC, user_snapshot_id DESC"
+)
+# Date columns which users can be listed by, keyed by the name used in the API
+USER_DATE_COLUMNS = {
+    "scanned": "scan_datetime",
+    "ingested": "ingest_datetime",
+}
+# Snapshots dated within a range are listed in date order, paged by a (date, snapshot ID) keyset, as for submissions
+_SELECT_SNAPSHOTS_BY_DATE = {
+    date_name: (
+        f"SELECT user_snapshot_id, site_user_id, {date_column} FROM user_snapshots "
+        f"WHERE website_id = %s AND {date_column} >= %s AND {date_column} < %s "
+        f"AND ({date_column}, user_snapshot_id) > (%s, %s) "
+        f"ORDER BY {date_column}, user_snapshot_id LIMIT %s"
+    )
+    for date_name, date_column in USER_DATE_COLUMNS.items()
+}
+# Display name lookups match case-insensitively, or by trigram similarity, and list each user and name matched once
+_SEARCH_DISPLAY_NAME = (
+    "SELECT site_user_id, display_name, MAX(scan_datetime), NULL "
+    "FROM user_snapshots "
+    "WHERE website_id = %s AND lower(display_name) = lower(%s) "
+    "GROUP BY site_user_id, display_name "
+    "ORDER BY MAX(scan_datetime) DESC "
+    "LIMIT %s"
+)
+_SEARCH_DISPLAY_NAME_FUZZY = (
+    "SELECT site_user_id, display_name, MAX(scan_datetime), "
+    "similarity(lower(display_name), lower(%s)) AS name_similarity "
+    "FROM user_snapshots "
+    "WHERE website_id = %s AND lower(display_name) %% lower(%s) "
+    "GROUP BY site_user_id, display_name "
+    "ORDER BY name_similarity DESC, MAX(scan_datetime) DESC "
+    "LIMIT %s"
+)
 
 
 class User:
@@ -32,6 +93,10 @@ class User:
     def latest_update(self) -> datetime.datetime:
         return self.sorted_snapshots[0].scan_datetime
 
+    @property
+    def last_seen(self) -> datetime.datetime:
+        return max(snapshot.last_seen for snapshot in self.snapshots)
+
     @property
     def display_name(self) -> Optional[str]:
         for snapshot in self.snapshots:
@@ -55,6 +120,7 @@ class User:
                 "snapshot_count": len(self.snapshots),
                 "first_scanned": self.first_scanned,
                 "latest_update": self.latest_update,
+                "last_seen": self.last_seen,
             },
             "user_data": {
                 "is_deleted": self.is_deleted,
@@ -75,22 +141,24 @@ class User:
     def from_database(
         cls, db: "Database", website_id: str, site_user_id: str
     ) -> Optional["User"]:
-        snapshot_rows = db.select(
-            "SELECT u.user_snapshot_id, u.scan_datetime, u.archive_contributor_id, a.name as contributor_name, "
-            "u.ingest_datetime, u.is_deleted, u.display_name, u.extra_data "
-            "FROM user_snapshots u "
-            "LEFT JOIN archive_contributors a ON u.archive_contributor_id = a.contributor_id "
-            "WHERE website_id = %s AND site_user_id = %s",
-            (
-                website_id, site_user_id
-            )
-        )
+        snapshot_rows = db.select(_SELECT_SNAPSHOTS_FOR_USER, (website_id, site_user_id))
+        return cls._from_rows(website_id, site_user_id, snapshot_rows)
+
+    @classmethod
+    async def from_database_async(
+        cls, db: "AsyncDatabase", website_id: str, site_user_id: str
+    ) -> Optional["User"]:
+        snapshot_rows = await db.select(_SELECT_SNAPSHOTS_FOR_USER, (website_id, site_user_id))
+        return cls._from_rows(website_id, site_user_id, snapshot_rows)
+
+    @classmethod
+    def _from_rows(cls, website_id: str, site_user_id: str, snapshot_rows: List) -> Optional["User"]:
         snapshots = []
         contributors = {}
         for row in snapshot_rows:
             (
                 snapshot_id, scan_datetime, contributor_id, contributor_name, ingest_datetime, is_deleted,
-                display_name, extra_data
+                display_name, extra_data, last_seen_datetime
             ) = row
             contributor = contributors.get(contributor_id)
             if contributor is None:
@@ -105,7 +173,8 @@ class User:
                 ingest_datetime=ingest_datetime,
                 is_deleted=is_deleted,
                 display_name=display_name,
-                extra_data=extra_data
+                extra_data=extra_data,
+                last_seen_datetime=last_seen_datetime,
             ))
         if not snapshots:
             return None
@@ -115,6 +184,66 @@ class User:
             snapshots
         )
 
+    @classmethod
+    def version_from_database(cls, db: Database, website_id: str, site_user_id: str) -> Optional[EntityVersion]:
+        version_rows = db.select(_SELECT_VERSION, (website_id, site_user_id))
+        return EntityVersion.from_row(version_rows[0])
+
+    @classmethod
+    async def version_from_database_async(
+            cls, db: "AsyncDatabase", website_id: str, site_user_id: str
+    ) -> Optional[EntityVersion]:
+        version_rows = await db.select(_SELECT_VERSION, (website_id, site_user_id))
+        return EntityVersion.from_row(version_rows[0])
+
+    @classmethod
+    def list_unique_site_ids(cls, db: Database, website_id: str) -> List[str]:
+        user_rows = db.select(_SELECT_UNIQUE_SITE_IDS, (website_id,))
+        return [user_row[0] for user_row in user_rows]
+
+    @classmethod
+    async def list_unique_site_ids_async(cls, db: "AsyncDatabase", website_id: str) -> List[str]:
+        user_rows = await db.select(_SELECT_UNIQUE_SITE_IDS, (website_id,))
+        return [user_row[0] for user_row in user_rows]
+
+    @classmethod
+    def list_snapshots_by_date(
+            cls,
+            db: Database,
+            website_id: str,
+            date_name: str,
+            start: datetime.datetime,
+            end: datetime.datetime,
+            *,
+            after: Optional[Tuple[datetime.datetime, int]] = None,
+            limit: int = 100,
+    ) -> List[Tuple[int, str, datetime.datetime]]:
+        """
+        Lists a page of the snapshot ID, site user ID, and date of snapshots dated from start up to end, by one of the
+        USER_DATE_COLUMNS, in date order, after the given date and snapshot ID
+        """
+        after_date, after_id = after or (start, 0)
+        return db.select(
+            _SELECT_SNAPSHOTS_BY_DATE[date_name], (website_id, max(start, after_date), end, after_date, after_id, limit)
+        )
+
+    @classmethod
+    async def list_snapshots_by_date_async(
+            cls,
+            db: "AsyncDatabase",
+            website_id: str,
+            date_name: str,
+            start: datetime.datetime,
+            end: datetime.datetime,
+            *,
+            after: Optional[Tuple[datetime.datetime, int]] = None,
+            limit: int = 100,
+    ) -> List[Tuple[int, str, datetime.datetime]]:
+        after_date, after_id = after or (start, 0)
+        return await db.select(
+            _SELECT_SNAPSHOTS_BY_DATE[date_name], (website_id, max(start, after_date), end, after_date, after_id, limit)
+        )
+
 
 class UserSnapshot:
     def __init__(
@@ -129,6 +258,7 @@ class UserSnapshot:
             is_deleted: bool = False,
             display_name: str = None,
             extra_data: Dict[str, Any] = None,
+            last_seen_datetime: datetime.datetime = None,
     ):
         self.website_id = website_id
         self.site_user_id = site_user_id
@@ -140,6 +270,19 @@ class UserSnapshot:
         self.is_deleted = is_deleted
         self.display_name = display_name
         self.extra_data = extra_data
+        # Latest scan which found this snapshot's content unchanged, if it has been scanned again
+        self.last_seen_datetime = last_seen_datetime
+
+    @property
+    def last_seen(self) -> datetime.datetime:
+        return max(self.scan_datetime, self.last_seen_datetime or self.scan_datetime)
+
+    @property
+    def content_digest(self) -> bytes:
+        """Digest of everything the snapshot records about the user, excluding when and by whom it was scanned"""
+        return content_digest([
+            self.website_id, self.site_user_id, self.is_deleted, self.display_name, self.extra_data
+        ])
     
     def to_web_json(self) -> Dict:
         return {
@@ -150,6 +293,7 @@ class UserSnapshot:
                 "scan_datetime": self.scan_datetime,
                 "archive_contributor": self.contributor.to_web_json(),
                 "ingest_datetime": self.ingest_datetime,
+                "last_seen_datetime": self.last_seen,
             },
             "user_data": {
                 "is_deleted": self.is_deleted,
@@ -170,41 +314,115 @@ class UserSnapshot:
             extra_data=web_data.get("extra_data"),
         )
 
-    def create_snapshot(self, db: "Database") -> None:
-        user_rows = db.insert(
-            "INSERT INTO user_snapshots "
-            "(website_id, site_user_id, scan_datetime, archive_contributor_id, ingest_datetime, is_deleted, "
-            "display_name, extra_data) "
-            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s) "
-            "RETURNING user_snapshot_id ",
-            (
-                self.website_id, self.site_user_id, self.scan_datetime, self.contributor.contributor_id,
-                self.ingest_datetime, self.is_deleted, self.display_name, json_to_db(self.extra_data),
-            )
-        )
-        self.user_snapshot_id = user_rows[0][0]
-
     def save(self, db: "Database") -> None:
         if self.user_snapshot_id is None:
-            return self.create_snapshot(db)
+            return self.save_batch(db, [self])
 
     @classmethod
-    def save_batch(cls, db: "Database", snapshots: List["UserSnapshot"]) -> None:
-        unsaved = [snapshot for snapshot in snapshots if snapshot.user_snapshot_id is None]
-        user_ids = db.bulk_insert(
-            "user_snapshots",
-            (
-                "website_id", "site_user_id", "scan_datetime", "archive_contributor_id", "ingest_datetime",
-                "is_deleted", "display_name", "extra_data"
-            ),
-            [
-                (
-                    user.website_id, user.site_user_id, user.scan_datetime, user.contributor.contributor_id,
-                    user.ingest_datetime, user.is_deleted, user.display_name, json_to_db(user.extra_data)
+    def save_batch(cls, db: "Database", snapshots: List["UserSnapshot"], *, skip_repeats: bool = True) -> None:
+        """
+        Saves new snapshots. Snapshots identical to the latest known snapshot of their user are not stored again,
+        instead they are given that snapshot's ID, and its last seen datetime is updated. Everything is saved in one
+        transaction, as for submissions.
+        """
+        with db.transaction():
+            unsaved = [snapshot for snapshot in snapshots if snapshot.user_snapshot_id is None]
+            repeats = []
+            if skip_repeats:
+                entity_keys = [(snapshot.website_id, snapshot.site_user_id) for snapshot in unsaved]
+                latest = latest_snapshots(db, _SELECT_LATEST_SNAPSHOTS, entity_keys)
+                unsaved, repeats = split_repeats(
+                    unsaved, latest, lambda s: (s.website_id, s.site_user_id), lambda s: s.content_digest
                 )
-                for user in unsaved
-            ],
-            "user_snapshot_id"
+            for snapshot, original in repeats:
+                if isinstance(original, UserSnapshot):
+                    original.last_seen_datetime = max(original.last_seen, snapshot.scan_datetime)
+            user_ids = db.bulk_insert(
+                "user_snapshots",
+                (
+                    "website_id", "site_user_id", "scan_datetime", "archive_contributor_id", "ingest_datetime",
+                    "is_deleted", "display_name", "extra_data", "content_digest", "last_seen_datetime"
+                ),
+                [
+                    (
+                        user.website_id, user.site_user_id, user.scan_datetime, user.contributor.contributor_id,
+                        user.ingest_datetime, user.is_deleted, user.display_name, json_to_db(user.extra_data),
+                        user.content_digest, user.last_seen_datetime
+                    )
+                    for user in unsaved
+                ],
+                "user_snapshot_id"
+            )
+            for user_snapshot, snapshot_id in zip(unsaved, user_ids):
+                user_snapshot.user_snapshot_id = snapshot_id
+            # Repeats share the ID of the snapshot they repeat, and stored snapshots record that they were seen again
+            seen = {}
+            for snapshot, original in repeats:
+                if isinstance(original, UserSnapshot):
+                    snapshot.user_snapshot_id = original.user_snapshot_id
+                    continue
+                snapshot.user_snapshot_id = original
+                seen[original] = max(seen.get(original, snapshot.scan_datetime), snapshot.scan_datetime)
+            record_seen(db, "user_snapshots", "user_snapshot_id", seen)
+            record_new_snapshots(db, ENTITY_USER, [snapshot.user_snapshot_id for snapshot in unsaved])
+        # Cached responses are only dropped once the new snapshots are committed and visible
+        response_cache().invalidate(
+            {
+                (ENTITY_USER, snapshot.website_id, snapshot.site_user_id)
+                for snapshot in unsaved + [repeat for repeat, _ in repeats]
+            }
         )
-        for user_snapshot, snapshot_id in zip(unsaved, user_ids):
-            user_snapshot.user_snapshot_id = snapshot_id
+
+
+class DisplayNameMatch:
+    """A user who has had a display name matching a lookup, with when they were last scanned with that name"""
+    def __init__(
+            self,
+            website_id: str,
+            site_user_id: str,
+            display_name: str,
+            last_scanned: datetime.datetime,
+            similarity: Optional[float] = None,
+    ) -> None:
+        self.website_id = website_id
+        self.site_user_id = site_user_id
+        self.display_name = display_name
+        self.last_scanned = last_scanned
+        # Trigram similarity to the name looked up, for fuzzy lookups
+        self.similarity = similarity
+
+    def to_web_json(self) -> Dict:
+        return {
+            "website_id": self.website_id,
+            "site_user_id": self.site_user_id,
+            "display_name": self.display_name,
+            "last_scanned": self.last_scanned,
+            "similarity": self.similarity,
+        }
+
+    @classmethod
+    def search_args(cls, website_id: str, display_name: str, fuzzy: bool, limit: int) -> Tuple[str, Tuple]:
+        if fuzzy:
+            return _SEARCH_DISPLAY_NAME_FUZZY, (display_name, website_id, display_name, limit)
+        return _SEARCH_DISPLAY_NAME, (website_id, display_name, limit)
+
+    @classmethod
+    def search(
+            cls, db: Database, website_id: str, display_name: str, *, fuzzy: bool = False, limit: int = 100
+    ) -> List["DisplayNameMatch"]:
+        query, args = cls.search_args(website_id, display_name, fuzzy, limit)
+        return cls._list_from_rows(website_id, db.select(query, args))
+
+    @classmethod
+    async def search_async(
+            cls, db: "AsyncDatabase", website_id: str, display_name: str, *, fuzzy: bool = False, limit: int = 100
+    ) -> List["DisplayNameMatch"]:
+        query, args = cls.search_args(website_id, display_name, fuzzy, limit)
+        return cls._list_from_rows(website_id, await db.select(query, args))
+
+    @classmethod
+    def _list_from_rows(cls, website_id: str, match_rows: List) -> List["DisplayNameMatch"]:
+        return [
+            cls(website_id, site_user_id, display_name, last_scanned, similarity)
+            for site_user_id, display_name, last_scanned, similarity in match_rows
+        ]
@@ -0,0 +1,30 @@
+import dataclasses
+import datetime
+from typing import Optional, Sequence, Any
+
+
+@dataclasses.dataclass(frozen=True)
+class EntityVersion:
+    """
+    Cheap validator for a submission or user, which changes whenever one of its snapshots is added, removed, or seen
+    again. It is read from the snapshot lookup index alone, so that unchanged entities do not need their snapshots
+    loading.
+    """
+    snapshot_count: int
+    latest_snapshot_id: int
+    last_modified: datetime.datetime
+    last_seen: Optional[datetime.datetime] = None
+
+    @property
+    def etag(self) -> str:
+        if self.last_seen is None:
+            return f"{self.snapshot_count}-{self.latest_snapshot_id}"
+        # Last seen datetimes are scan datetimes, which can be older than the last ingest, so only the ETag covers them
+        return f"{self.snapshot_count}-{self.latest_snapshot_id}-{int(self.last_seen.timestamp() * 1_000_000)}"
+
+    @classmethod
+    def from_row(cls, row: Sequence[Any]) -> Optional["EntityVersion"]:
+        snapshot_count, latest_snapshot_id, last_modified, last_seen = row
+        if not snapshot_count:
+            return None
+        return cls(snapshot_count, latest_snapshot_id, last_modified, last_seen)
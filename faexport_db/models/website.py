@@ -2,8 +2,14 @@ from __future__ import annotations
 from typing import Optional, TYPE_CHECKING, Dict, List
 
 if TYPE_CHECKING:
+    from faexport_db.async_db import AsyncDatabase
     from faexport_db.db import Database
 
+_COUNT_USER_SNAPSHOTS = "SELECT COUNT(*) FROM user_snapshots WHERE website_id = %s"
+_COUNT_SUBMISSION_SNAPSHOTS = "SELECT COUNT(*) FROM submission_snapshots WHERE website_id = %s"
+_SELECT_BY_ID = "SELECT full_name, link FROM websites WHERE website_id = %s"
+_SELECT_ALL = "SELECT website_id, full_name, link FROM websites"
+
 
 class Website:
     def __init__(
@@ -17,32 +23,47 @@ class Website:
         self.link = link
 
     def count_user_snapshots(self, db: Database) -> int:
-        count_rows = db.select(
-            "SELECT COUNT(*) FROM user_snapshots WHERE website_id = %s",
-            (self.website_id,)
-        )
+        count_rows = db.select(_COUNT_USER_SNAPSHOTS, (self.website_id,))
+        if count_rows:
+            return count_rows[0][0]
+        return 0
+
+    async def count_user_snapshots_async(self, db: AsyncDatabase) -> int:
+        count_rows = await db.select(_COUNT_USER_SNAPSHOTS, (self.website_id,))
         if count_rows:
             return count_rows[0][0]
         return 0
 
     def count_submission_snapshots(self, db: Database) -> int:
-        count_rows = db.select(
-            "SELECT COUNT(*) FROM submission_snapshots WHERE website_id = %s",
-            (self.website_id,)
-        )
+        count_rows = db.select(_COUNT_SUBMISSION_SNAPSHOTS, (self.website_id,))
         if count_rows:
             return count_rows[0][0]
         return 0
 
-    def to_web_json(self, db: Database) -> Dict:
+    async def count_submission_snapshots_async(self, db: AsyncDatabase) -> int:
+        count_rows = await db.select(_COUNT_SUBMISSION_SNAPSHOTS, (self.website_id,))
+        if count_rows:
+            return count_rows[0][0]
+        return 0
+
+    def _web_json(self, num_user_snapshots: int, num_submission_snapshots: int) -> Dict:
         return {
             "website_id": self.website_id,
             "full_name": self.full_name,
             "link": self.link,
-            "num_user_snapshots": self.count_user_snapshots(db),
-            "num_submission_snapshots": self.count_submission_snapshots(db),
+            "num_user_snapshots": num_user_snapshots,
+            "num_submission_snapshots": num_submission_snapshots,
         }
 
+    def to_web_json(self, db: Database) -> Dict:
+        return self._web_json(self.count_user_snapshots(db), self.count_submission_snapshots(db))
+
+    async def to_web_json_async(self, db: AsyncDatabase) -> Dict:
+        return self._web_json(
+            await self.count_user_snapshots_async(db),
+            await self.count_submission_snapshots_async(db),
+        )
+
     def save(self, db: Database) -> None:
         if self.from_database(db, self.website_id):
             return
@@ -55,11 +76,7 @@ class Website:
         )
 
     @classmethod
-    def from_database(cls, db: Database, website_id: str) -> Optional["Website"]:
-        website_rows = db.select(
-            "SELECT full_name, link FROM websites WHERE website_id = %s",
-            (website_id,)
-        )
+    def _from_rows(cls, website_id: str, website_rows: List) -> Optional["Website"]:
         if not website_rows:
             return None
         full_name, link = website_rows[0]
@@ -68,15 +85,27 @@ class Website:
             full_name,
             link
         )
-    
+
     @classmethod
-    def list_all(cls, db: Database) -> List["Website"]:
-        website_rows = db.select(
-            "SELECT website_id, full_name, link FROM websites",
-            tuple()
-        )
+    def from_database(cls, db: Database, website_id: str) -> Optional["Website"]:
+        return cls._from_rows(website_id, db.select(_SELECT_BY_ID, (website_id,)))
+
+    @classmethod
+    async def from_database_async(cls, db: AsyncDatabase, website_id: str) -> Optional["Website"]:
+        return cls._from_rows(website_id, await db.select(_SELECT_BY_ID, (website_id,)))
+
+    @classmethod
+    def _list_from_rows(cls, website_rows: List) -> List["Website"]:
         websites = []
         for website_row in website_rows:
             website_id, full_name, link = website_row
             websites.append(Website(website_id, full_name, link))
         return websites
+
+    @classmethod
+    def list_all(cls, db: Database) -> List["Website"]:
+        return cls._list_from_rows(db.select(_SELECT_ALL, tuple()))
+
+    @classmethod
+    async def list_all_async(cls, db: AsyncDatabase) -> List["Website"]:
+        return cls._list_from_rows(await db.select(_SELECT_ALL, tuple()))
@@ -0,0 +1,202 @@
+import argparse
+import atexit
+import dataclasses
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+from typing import Dict, List, Optional, Callable, Iterable, Any
+
+logger = logging.getLogger(__name__)
+
+SORT_KEYS = ["total_seconds", "max_seconds", "mean_seconds", "calls"]
+
+_whitespace = re.compile(r"\s+")
+_value_groups = re.compile(r"\((?:%s, )*%s\)(?:, \((?:%s, )*%s\))+")
+
+
+def configure_slow_query_log(file_path: str) -> None:
+    handler = logging.FileHandler(file_path)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.propagate = False
+    # Query stats are logged at info level when the process exits
+    logger.setLevel(logging.INFO)
+
+
+def normalize_query(query: str) -> str:
+    query = _whitespace.sub(" ", query).strip()
+    # Collapse multi-row VALUES lists, so that each batch size does not count as a separate query
+    return _value_groups.sub("(...), ...", query)
+
+
+@dataclasses.dataclass
+class QueryStats:
+    query: str
+    calls: int = 0
+    slow_calls: int = 0
+    total_seconds: float = 0
+    max_seconds: float = 0
+
+    @property
+    def mean_seconds(self) -> float:
+        if not self.calls:
+            return 0
+        return self.total_seconds / self.calls
+
+    def add_call(self, duration: float, is_slow: bool) -> None:
+        self.calls += 1
+        self.total_seconds += duration
+        self.max_seconds = max(self.max_seconds, duration)
+        if is_slow:
+            self.slow_calls += 1
+
+    def add_stats(self, other: "QueryStats") -> None:
+        self.calls += other.calls
+        self.slow_calls += other.slow_calls
+        self.total_seconds += other.total_seconds
+        self.max_seconds = max(self.max_seconds, other.max_seconds)
+
+    def to_json(self) -> Dict:
+        return {
+            "query": self.query,
+            "calls": self.calls,
+            "slow_calls": self.slow_calls,
+            "total_seconds": self.total_seconds,
+            "mean_seconds": self.mean_seconds,
+            "max_seconds": self.max_seconds,
+        }
+
+
+class QueryProfiler:
+    def __init__(self, *, slow_threshold_ms: float = 1000, explain_sample_rate: float = 0.01) -> None:
+        self.slow_threshold_ms = slow_threshold_ms
+        self.explain_sample_rate = explain_sample_rate
+        self.stats: Dict[str, QueryStats] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "QueryProfiler":
+        return cls(
+            slow_threshold_ms=float(os.getenv("SLOW_QUERY_MS", "1000")),
+            explain_sample_rate=float(os.getenv("SLOW_QUERY_EXPLAIN_RATE", "0.01")),
+        )
+
+    def record(
+            self,
+            operation: str,
+            query: str,
+            duration: float,
+            explain: Optional[Callable[[], Any]] = None,
+    ) -> None:
+        normalized = normalize_query(query)
+        is_slow = duration * 1000 >= self.slow_threshold_ms
+        with self._lock:
+            stats = self.stats.get(normalized)
+            if stats is None:
+                stats = self.stats[normalized] = QueryStats(normalized)
+            stats.add_call(duration, is_slow)
+        if not is_slow:
+            return
+        log_data = {
+            "event": "slow_query",
+            "operation": operation,
+            "query": normalized,
+            "duration_ms": round(duration * 1000, 3),
+            "threshold_ms": self.slow_threshold_ms,
+        }
+        if explain is not None and random.random() < self.explain_sample_rate:
+            log_data["plan"] = explain()
+        logger.warning(json.dumps(log_data))
+
+    def top(self, count: int = 10, sort_by: str = "total_seconds") -> List[QueryStats]:
+        with self._lock:
+            stats = list(self.stats.values())
+        return top_stats(stats, count, sort_by)
+
+    def log_stats(self) -> None:
+        """Logs the stats of every query profiled, so that the worst offenders overall can be read from the log"""
+        with self._lock:
+            stats = list(self.stats.values())
+        for query_stats in top_stats(stats, len(stats), "total_seconds"):
+            logger.info(json.dumps({"event": "query_stats", **query_stats.to_json()}))
+
+
+_process_profiler: Optional[QueryProfiler] = None
+_process_profiler_lock = threading.Lock()
+
+
+def process_profiler() -> QueryProfiler:
+    """
+    Profiler shared by every database connection in the process, configured from the environment, which logs its stats
+    when the process exits
+    """
+    global _process_profiler
+    with _process_profiler_lock:
+        if _process_profiler is None:
+            _process_profiler = QueryProfiler.from_env()
+            atexit.register(_process_profiler.log_stats)
+        return _process_profiler
+
+
+def top_stats(stats: Iterable[QueryStats], count: int, sort_by: str) -> List[QueryStats]:
+    return sorted(stats, key=lambda s: getattr(s, sort_by), reverse=True)[:count]
+
+
+def stats_from_log(lines: Iterable[str]) -> Dict[str, QueryStats]:
+    """
+    Reads query stats from a slow query log. The stats logged by each process at exit cover every query, rather than
+    just the slow ones, so if there are any, they are used, and otherwise the stats are built from the slow queries
+    """
+    slow_stats: Dict[str, QueryStats] = {}
+    process_stats: Dict[str, QueryStats] = {}
+    for line in lines:
+        # Log lines may have a logging prefix before the json body
+        json_start = line.find("{")
+        if json_start == -1:
+            continue
+        try:
+            data = json.loads(line[json_start:])
+        except json.JSONDecodeError:
+            continue
+        if not isinstance(data, dict):
+            continue
+        event = data.get("event")
+        if event == "slow_query":
+            query_stats = slow_stats.setdefault(data["query"], QueryStats(data["query"]))
+            query_stats.add_call(data["duration_ms"] / 1000, True)
+        elif event == "query_stats":
+            query_stats = process_stats.setdefault(data["query"], QueryStats(data["query"]))
+            query_stats.add_stats(QueryStats(
+                data["query"], data["calls"], data["slow_calls"], data["total_seconds"], data["max_seconds"]
+            ))
+    return process_stats or slow_stats
+
+
+def print_top_offenders(stats: List[QueryStats]) -> None:
+    if not stats:
+        print("No queries found")
+        return
+    print(f"{'calls':>8} {'slow':>8} {'total (s)':>10} {'mean (ms)':>10} {'max (ms)':>10}  query")
+    for query_stats in stats:
+        print(
+            f"{query_stats.calls:>8} {query_stats.slow_calls:>8} {query_stats.total_seconds:>10.2f} "
+            f"{query_stats.mean_seconds * 1000:>10.1f} {query_stats.max_seconds * 1000:>10.1f}  {query_stats.query}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print the worst offenders from a faexport_db slow query log")
+    parser.add_argument("log_file", nargs="?", help="Slow query log file to read. Reads stdin if not given")
+    parser.add_argument("--top", type=int, default=20, help="Number of queries to show")
+    parser.add_argument("--sort", choices=SORT_KEYS, default="total_seconds", help="Statistic to rank queries by")
+    args = parser.parse_args()
+    if args.log_file:
+        with open(args.log_file, "r") as log_file:
+            log_stats = stats_from_log(log_file)
+    else:
+        log_stats = stats_from_log(sys.stdin)
+    print_top_offenders(top_stats(log_stats.values(), args.top, args.sort))
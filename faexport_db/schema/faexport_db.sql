@@ -1,3 +1,6 @@
+-- Trigram matching, for fuzzy display name lookups
+create extension if not exists pg_trgm;
+
 create table websites
 (
     website_id text not null
@@ -40,7 +43,10 @@ create table user_snapshots
     is_deleted       boolean not null,
     display_name     text,
     -- Site specific data
-    extra_data       json
+    extra_data       json,
+    -- Repeat scan tracking
+    content_digest   bytea,
+    last_seen_datetime timestamp with time zone
 );
 
 create table submission_snapshots
@@ -64,31 +70,61 @@ create table submission_snapshots
     description      text,
     datetime_posted  timestamp with time zone,
     keywords_recorded boolean not null,
+    keyword_set_id   int,
     -- Site specific data
-    extra_data       json
+    extra_data       json,
+    -- Repeat scan tracking
+    content_digest   bytea,
+    last_seen_datetime timestamp with time zone
+);
+
+-- Keyword lists are stored once per content digest, and snapshots reference the keyword set they recorded
+create table submission_keyword_sets
+(
+    keyword_set_id   serial
+        constraint submission_keyword_sets_pk
+            primary key,
+    -- Digest of the keyword list, null for keyword lists stored before keyword sets were shared
+    content_digest   bytea
 );
 
+create unique index submission_keyword_sets_digest_uindex
+    on submission_keyword_sets (content_digest);
+
 create table submission_snapshot_keywords
 (
     -- Keys
     keyword_id       serial,
-    submission_snapshot_id    int not null,
+    keyword_set_id   int not null,
     -- Type specific data
     keyword          text not null,
     ordinal          int
 );
 
+-- Files are stored once per content digest, and linked to each snapshot which recorded them
 create table submission_snapshot_files
 (
     -- Keys
     file_id          serial,
-    submission_snapshot_id    int not null,
     site_file_id     text,
     -- Type specific data
     file_url         text,
     file_size        int,
     -- Site specific data
-    extra_data      json
+    extra_data      json,
+    -- Digest of the file and its hashes, null for files stored before files were shared
+    content_digest  bytea
+);
+
+create unique index submission_snapshot_files_digest_uindex
+    on submission_snapshot_files (content_digest);
+
+create table submission_snapshot_file_links
+(
+    submission_snapshot_id int not null,
+    file_id                int not null,
+    constraint submission_snapshot_file_links_pk
+        primary key (submission_snapshot_id, file_id)
 );
 
 create table hash_algos
@@ -97,7 +133,9 @@ create table hash_algos
         constraint hash_algos_pk
             primary key,
     language       text,
-    algorithm_name text not null
+    algorithm_name text not null,
+    -- Length of hash values in bytes, if fixed. 8 byte hashes are stored as bigint
+    hash_length    int
 );
 
 create unique index hash_algos_uindex
@@ -110,7 +148,44 @@ create table submission_snapshot_file_hashes
     algo_id    int not null
         constraint submission_snapshot_file_hashes_algo_id_fk
             references hash_algos,
-    hash_value bytea not null
+    hash_value bytea,
+    hash_int   bigint,
+    constraint submission_snapshot_file_hashes_value_check
+        check ((hash_value is null) <> (hash_int is null))
+);
+
+-- Denormalised copy of file hashes, so that exact hash searches can be answered from one index
+create table submission_hash_lookup
+(
+    hash_id                int not null,
+    algo_id                int not null,
+    -- All hashes are stored as bytes here, including those stored in hash_int
+    hash_value             bytea not null,
+    website_id             text not null,
+    site_submission_id     text not null,
+    submission_snapshot_id int not null,
+    file_id                int not null
+);
+
+-- Highest change sequence number ingested per submission, for data sources which provide one (such as e621's
+-- change_seq), so that delta ingests can skip submissions which have not changed
+create table submission_change_markers
+(
+    website_id         text not null,
+    site_submission_id text not null,
+    change_seq         bigint not null,
+    constraint submission_change_markers_pk
+        primary key (website_id, site_submission_id)
+);
+
+create table snapshot_feed
+(
+    -- Entries are committed in feed ID order, see record_new_snapshots in faexport_db/change_feed.py
+    feed_id     bigserial
+        constraint snapshot_feed_pk
+            primary key,
+    entity_type text not null,
+    snapshot_id int  not null
 );
 
 create table settings
@@ -121,4 +196,4 @@ create table settings
     setting_value       text
 );
 
-insert into settings (setting_id, setting_value) values ('version', '0.2.1');
\ No newline at end of file
+insert into settings (setting_id, setting_value) values ('version', '0.13.0');
\ No newline at end of file
@@ -1,25 +1,59 @@
 -- Indexes were left out when initially ingesting data dumps to popualate the database.
 -- This allowed initial data ingestion to run at a much faster pace
 -- Indexes were added afterwards, to allow speed of access
+-- Ingestion jobs now do this automatically for large loads, see --bulk-load in scripts/ingest/ingestion_job.py
 
 -- Website listing indexes
 CREATE INDEX user_snapshots_website_id_index ON user_snapshots (website_id);
 CREATE INDEX submission_snapshots_website_id_index ON submission_snapshots (website_id);
 
 -- Snapshot lookup indexes
-CREATE INDEX user_snapshots_site_id_index ON user_snapshots (website_id, site_user_id);
-CREATE INDEX submission_snapshots_site_id_index ON submission_snapshots (website_id, site_submission_id);
+-- These include the snapshot ID, ingest and last seen datetimes, so that entity versions for conditional requests are
+-- index-only
+CREATE INDEX user_snapshots_site_id_index ON user_snapshots (website_id, site_user_id)
+    INCLUDE (user_snapshot_id, ingest_datetime, last_seen_datetime);
+CREATE INDEX submission_snapshots_site_id_index ON submission_snapshots (website_id, site_submission_id)
+    INCLUDE (submission_snapshot_id, ingest_datetime, last_seen_datetime);
+
+-- Uploader listing index, ordered by site ID for keyset pagination
+CREATE INDEX submission_snapshots_uploader_index
+    ON submission_snapshots (website_id, uploader_site_user_id, site_submission_id);
+-- Latest uploader index, covering each submission's recorded uploaders, latest first, in site ID order
+CREATE INDEX submission_snapshots_latest_uploader_index
+    ON submission_snapshots (website_id, site_submission_id, scan_datetime DESC, submission_snapshot_id DESC)
+    INCLUDE (uploader_site_user_id) WHERE uploader_site_user_id IS NOT NULL;
+
+-- Display name lookup indexes, case-insensitive for exact matches, and trigram for fuzzy matches
+CREATE INDEX user_snapshots_display_name_index ON user_snapshots (website_id, lower(display_name))
+    INCLUDE (site_user_id, scan_datetime);
+CREATE INDEX user_snapshots_display_name_trgm_index ON user_snapshots USING gin (lower(display_name) gin_trgm_ops);
+
+-- Date range indexes, BRIN as snapshots are appended roughly in date order
+CREATE INDEX submission_snapshots_posted_brin_index ON submission_snapshots USING brin (datetime_posted);
+CREATE INDEX submission_snapshots_scan_brin_index ON submission_snapshots USING brin (scan_datetime);
+CREATE INDEX submission_snapshots_ingest_brin_index ON submission_snapshots USING brin (ingest_datetime);
+CREATE INDEX user_snapshots_scan_brin_index ON user_snapshots USING brin (scan_datetime);
+CREATE INDEX user_snapshots_ingest_brin_index ON user_snapshots USING brin (ingest_datetime);
+
+-- Change feed index, for reading each entity type's feed in order
+CREATE INDEX snapshot_feed_entity_index ON snapshot_feed (entity_type, feed_id);
 
 -- Foreign key indexes
-CREATE INDEX submission_file_submission_id_index ON submission_snapshot_files (submission_snapshot_id);
-CREATE INDEX submission_keyword_submission_id_index ON submission_snapshot_keywords (submission_snapshot_id);
+CREATE INDEX submission_file_link_file_id_index ON submission_snapshot_file_links (file_id);
+CREATE INDEX submission_keyword_set_id_index ON submission_snapshot_keywords (keyword_set_id);
 CREATE INDEX submission_file_hash_file_id_index ON submission_snapshot_file_hashes (file_id);
 
 ANALYZE;
 
 -- Hash search indexes
 CREATE INDEX submission_snapshot_file_hash_value_index ON submission_snapshot_file_hashes (algo_id, hash_value);
+CREATE INDEX submission_snapshot_file_hash_int_index ON submission_snapshot_file_hashes (algo_id, hash_int)
+    WHERE hash_int IS NOT NULL;
 CREATE INDEX submission_snapshot_file_hash_algo_index ON submission_snapshot_file_hashes (algo_id);
 CREATE INDEX submission_snapshots_snapshot_id_index ON submission_snapshots (submission_snapshot_id);
 CREATE INDEX submission_snapshot_files_file_id_index ON submission_snapshot_files (file_id);
+CREATE INDEX submission_hash_lookup_hash_index ON submission_hash_lookup (algo_id, hash_value)
+    INCLUDE (website_id, site_submission_id, submission_snapshot_id, file_id);
+CREATE INDEX submission_hash_lookup_hash_id_index ON submission_hash_lookup (hash_id);
+CREATE INDEX submission_hash_lookup_file_id_index ON submission_hash_lookup (file_id);
 ANALYZE;
@@ -0,0 +1,10 @@
+-- Display name lookup, so that ingestion jobs and API clients can find which users have had a display name.
+-- Exact lookups are case-insensitive, and fuzzy lookups use trigram similarity.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS user_snapshots_display_name_index
+    ON user_snapshots (website_id, lower(display_name)) INCLUDE (site_user_id, scan_datetime);
+CREATE INDEX IF NOT EXISTS user_snapshots_display_name_trgm_index
+    ON user_snapshots USING gin (lower(display_name) gin_trgm_ops);
+ANALYZE user_snapshots;
+
+UPDATE settings SET setting_value = '0.10.0' WHERE setting_id = 'version';
@@ -0,0 +1,13 @@
+-- Date range indexes, for listing what was posted, scanned, or ingested between two dates.
+-- Snapshots are appended roughly in scan and ingest order, so BRIN indexes stay small and selective for those dates.
+-- Posted dates are only loosely correlated with insert order, but a BRIN index still skips most of the table.
+CREATE INDEX IF NOT EXISTS submission_snapshots_posted_brin_index
+    ON submission_snapshots USING brin (datetime_posted);
+CREATE INDEX IF NOT EXISTS submission_snapshots_scan_brin_index ON submission_snapshots USING brin (scan_datetime);
+CREATE INDEX IF NOT EXISTS submission_snapshots_ingest_brin_index ON submission_snapshots USING brin (ingest_datetime);
+CREATE INDEX IF NOT EXISTS user_snapshots_scan_brin_index ON user_snapshots USING brin (scan_datetime);
+CREATE INDEX IF NOT EXISTS user_snapshots_ingest_brin_index ON user_snapshots USING brin (ingest_datetime);
+ANALYZE submission_snapshots;
+ANALYZE user_snapshots;
+
+UPDATE settings SET setting_value = '0.11.0' WHERE setting_id = 'version';
@@ -0,0 +1,20 @@
+-- Change feed of new snapshots. Snapshot IDs are handed out when snapshots are inserted, so concurrent writers can
+-- commit them out of order. Feed entries are written under a lock held until commit, so feed IDs are committed in order
+-- and readers can safely resume from the last feed ID they saw.
+CREATE TABLE snapshot_feed
+(
+    feed_id     bigserial
+        CONSTRAINT snapshot_feed_pk
+            PRIMARY KEY,
+    entity_type text NOT NULL,
+    snapshot_id int  NOT NULL
+);
+-- Existing snapshots are added to the feed in snapshot ID order, so readers starting from the beginning see them all
+INSERT INTO snapshot_feed (entity_type, snapshot_id)
+    SELECT 'submission', submission_snapshot_id FROM submission_snapshots ORDER BY submission_snapshot_id;
+INSERT INTO snapshot_feed (entity_type, snapshot_id)
+    SELECT 'user', user_snapshot_id FROM user_snapshots ORDER BY user_snapshot_id;
+CREATE INDEX snapshot_feed_entity_index ON snapshot_feed (entity_type, feed_id);
+ANALYZE snapshot_feed;
+
+UPDATE settings SET setting_value = '0.12.0' WHERE setting_id = 'version';
@@ -0,0 +1,8 @@
+-- Index for finding the latest recorded uploader of each submission, in site ID order, when listing an uploader's
+-- submissions
+CREATE INDEX IF NOT EXISTS submission_snapshots_latest_uploader_index
+    ON submission_snapshots (website_id, site_submission_id, scan_datetime DESC, submission_snapshot_id DESC)
+    INCLUDE (uploader_site_user_id) WHERE uploader_site_user_id IS NOT NULL;
+ANALYZE submission_snapshots;
+
+UPDATE settings SET setting_value = '0.13.0' WHERE setting_id = 'version';
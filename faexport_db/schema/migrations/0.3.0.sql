@@ -0,0 +1,27 @@
+-- Fixed width storage for 64 bit hashes
+ALTER TABLE hash_algos ADD COLUMN hash_length int;
+ALTER TABLE submission_snapshot_file_hashes ADD COLUMN hash_int bigint;
+ALTER TABLE submission_snapshot_file_hashes ALTER COLUMN hash_value DROP NOT NULL;
+
+-- Record the hash length of each algorithm whose existing hashes all have the same length
+UPDATE hash_algos a SET hash_length = l.hash_length
+FROM (
+    SELECT algo_id, MIN(length(hash_value)) AS hash_length
+    FROM submission_snapshot_file_hashes
+    GROUP BY algo_id
+    HAVING MIN(length(hash_value)) = MAX(length(hash_value))
+) l
+WHERE a.algo_id = l.algo_id;
+
+-- Move 8 byte hashes into bigint, as big-endian signed integers
+UPDATE submission_snapshot_file_hashes h
+SET hash_int = ('x' || encode(h.hash_value, 'hex'))::bit(64)::bigint, hash_value = NULL
+FROM hash_algos a
+WHERE h.algo_id = a.algo_id AND a.hash_length = 8;
+
+ALTER TABLE submission_snapshot_file_hashes
+    ADD CONSTRAINT submission_snapshot_file_hashes_value_check CHECK ((hash_value IS NULL) <> (hash_int IS NULL));
+CREATE INDEX IF NOT EXISTS submission_snapshot_file_hash_int_index ON submission_snapshot_file_hashes (algo_id, hash_int)
+    WHERE hash_int IS NOT NULL;
+
+UPDATE settings SET setting_value = '0.3.0' WHERE setting_id = 'version';
@@ -0,0 +1,27 @@
+-- Denormalised hash lookup table for exact hash searches
+CREATE TABLE submission_hash_lookup
+(
+    hash_id                int not null,
+    algo_id                int not null,
+    hash_value             bytea not null,
+    website_id             text not null,
+    site_submission_id     text not null,
+    submission_snapshot_id int not null,
+    file_id                int not null
+);
+
+INSERT INTO submission_hash_lookup
+    (hash_id, algo_id, hash_value, website_id, site_submission_id, submission_snapshot_id, file_id)
+SELECT h.hash_id, h.algo_id, COALESCE(h.hash_value, int8send(h.hash_int)), s.website_id, s.site_submission_id,
+       s.submission_snapshot_id, f.file_id
+FROM submission_snapshot_file_hashes h
+JOIN submission_snapshot_files f ON h.file_id = f.file_id
+JOIN submission_snapshots s ON f.submission_snapshot_id = s.submission_snapshot_id;
+
+CREATE INDEX submission_hash_lookup_hash_index ON submission_hash_lookup (algo_id, hash_value)
+    INCLUDE (website_id, site_submission_id, submission_snapshot_id, file_id);
+CREATE INDEX submission_hash_lookup_hash_id_index ON submission_hash_lookup (hash_id);
+CREATE INDEX submission_hash_lookup_file_id_index ON submission_hash_lookup (file_id);
+ANALYZE submission_hash_lookup;
+
+UPDATE settings SET setting_value = '0.4.0' WHERE setting_id = 'version';
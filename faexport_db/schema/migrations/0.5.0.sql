@@ -0,0 +1,10 @@
+-- Highest change sequence number ingested per submission, so delta ingests can skip unchanged submissions
+CREATE TABLE submission_change_markers
+(
+    website_id         text not null,
+    site_submission_id text not null,
+    change_seq         bigint not null,
+    CONSTRAINT submission_change_markers_pk PRIMARY KEY (website_id, site_submission_id)
+);
+
+UPDATE settings SET setting_value = '0.5.0' WHERE setting_id = 'version';
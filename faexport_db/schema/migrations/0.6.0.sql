@@ -0,0 +1,18 @@
+-- Content digests of snapshots, so that ingesting a snapshot identical to the latest one only records that it was seen
+-- again. Existing snapshots have no digest, so the first repeat scan of each entity is still stored as a snapshot.
+ALTER TABLE user_snapshots ADD COLUMN content_digest bytea;
+ALTER TABLE user_snapshots ADD COLUMN last_seen_datetime timestamp with time zone;
+ALTER TABLE submission_snapshots ADD COLUMN content_digest bytea;
+ALTER TABLE submission_snapshots ADD COLUMN last_seen_datetime timestamp with time zone;
+
+-- Snapshot lookup indexes include the last seen datetime, so that entity versions stay index-only
+DROP INDEX IF EXISTS user_snapshots_site_id_index;
+CREATE INDEX user_snapshots_site_id_index ON user_snapshots (website_id, site_user_id)
+    INCLUDE (user_snapshot_id, ingest_datetime, last_seen_datetime);
+DROP INDEX IF EXISTS submission_snapshots_site_id_index;
+CREATE INDEX submission_snapshots_site_id_index ON submission_snapshots (website_id, site_submission_id)
+    INCLUDE (submission_snapshot_id, ingest_datetime, last_seen_datetime);
+ANALYZE user_snapshots;
+ANALYZE submission_snapshots;
+
+UPDATE settings SET setting_value = '0.6.0' WHERE setting_id = 'version';
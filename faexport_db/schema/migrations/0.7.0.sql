@@ -0,0 +1,21 @@
+-- Files are stored once per content digest, and linked to the snapshots which recorded them, rather than each snapshot
+-- storing its own copy of every file and file hash. Existing files are linked to their snapshot, and have no digest,
+-- so are not shared with later snapshots.
+CREATE TABLE submission_snapshot_file_links
+(
+    submission_snapshot_id int not null,
+    file_id                int not null,
+    CONSTRAINT submission_snapshot_file_links_pk PRIMARY KEY (submission_snapshot_id, file_id)
+);
+
+INSERT INTO submission_snapshot_file_links (submission_snapshot_id, file_id)
+SELECT DISTINCT submission_snapshot_id, file_id FROM submission_snapshot_files;
+
+CREATE INDEX submission_file_link_file_id_index ON submission_snapshot_file_links (file_id);
+
+ALTER TABLE submission_snapshot_files DROP COLUMN submission_snapshot_id;
+ALTER TABLE submission_snapshot_files ADD COLUMN content_digest bytea;
+CREATE UNIQUE INDEX submission_snapshot_files_digest_uindex ON submission_snapshot_files (content_digest);
+ANALYZE submission_snapshot_file_links;
+
+UPDATE settings SET setting_value = '0.7.0' WHERE setting_id = 'version';
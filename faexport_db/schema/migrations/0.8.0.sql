@@ -0,0 +1,29 @@
+-- Keyword lists are stored once per content digest as keyword sets, which snapshots reference, rather than every
+-- snapshot storing its own copy of its keywords. Existing keywords become one keyword set per snapshot, with the same ID
+-- as the snapshot, and have no digest, so are not shared with later snapshots.
+CREATE TABLE submission_keyword_sets
+(
+    keyword_set_id serial CONSTRAINT submission_keyword_sets_pk PRIMARY KEY,
+    content_digest bytea
+);
+
+INSERT INTO submission_keyword_sets (keyword_set_id)
+SELECT DISTINCT submission_snapshot_id FROM submission_snapshot_keywords;
+SELECT setval(
+    pg_get_serial_sequence('submission_keyword_sets', 'keyword_set_id'),
+    COALESCE(MAX(keyword_set_id), 0) + 1,
+    false
+) FROM submission_keyword_sets;
+CREATE UNIQUE INDEX submission_keyword_sets_digest_uindex ON submission_keyword_sets (content_digest);
+
+ALTER TABLE submission_snapshot_keywords RENAME COLUMN submission_snapshot_id TO keyword_set_id;
+ALTER INDEX IF EXISTS submission_keyword_submission_id_index RENAME TO submission_keyword_set_id_index;
+
+ALTER TABLE submission_snapshots ADD COLUMN keyword_set_id int;
+UPDATE submission_snapshots s SET keyword_set_id = k.keyword_set_id
+FROM submission_keyword_sets k
+WHERE s.submission_snapshot_id = k.keyword_set_id;
+ANALYZE submission_keyword_sets;
+ANALYZE submission_snapshots;
+
+UPDATE settings SET setting_value = '0.8.0' WHERE setting_id = 'version';
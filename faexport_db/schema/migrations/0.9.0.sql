@@ -0,0 +1,6 @@
+-- Index for listing the submissions of an uploader, ordered by site ID for keyset pagination
+CREATE INDEX IF NOT EXISTS submission_snapshots_uploader_index
+    ON submission_snapshots (website_id, uploader_site_user_id, site_submission_id);
+ANALYZE submission_snapshots;
+
+UPDATE settings SET setting_value = '0.9.0' WHERE setting_id = 'version';
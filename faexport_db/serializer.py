@@ -0,0 +1,52 @@
+import base64
+import datetime
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def default(obj: Any) -> Any:
+    """Converts values json cannot represent natively, checking common types before falling back to iter()"""
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return base64.b64encode(obj).decode()
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    try:
+        iterable = iter(obj)
+    except TypeError:
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+    return list(iterable)
+
+
+_encoder = json.JSONEncoder(default=default, separators=(",", ":"))
+
+if orjson is not None:
+    BACKEND = "orjson"
+    # Non-string keys are converted to strings, as the stdlib json module does
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumps(data: Any) -> str:
+        return orjson.dumps(data, default=default, option=_ORJSON_OPTIONS).decode()
+
+    def dumps_bytes(data: Any) -> bytes:
+        return orjson.dumps(data, default=default, option=_ORJSON_OPTIONS)
+
+    def loads(data: Union[str, bytes]) -> Any:
+        return orjson.loads(data)
+else:
+    BACKEND = "json"
+
+    def dumps(data: Any) -> str:
+        return _encoder.encode(data)
+
+    def dumps_bytes(data: Any) -> bytes:
+        return _encoder.encode(data).encode()
+
+    def loads(data: Union[str, bytes]) -> Any:
+        return json.loads(data)
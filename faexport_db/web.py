@@ -1,68 +1,95 @@
 import base64
-import json
 import os
-from typing import Dict, Tuple, Type
-
-import psycopg2
-from werkzeug.routing import BaseConverter, ValidationError
-
-from faexport_db.db import Database, CustomJSONEncoder
-from faexport_db.ingest_formats.base import SimpleUserSnapshot, SimpleSubmissionSnapshot, BaseFormat
-from faexport_db.ingest_formats.faexport import FAExportUser, FAExportSubmission
+import time
+from typing import Dict, Any, Union
+
+import psycopg2.pool
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+
+from faexport_db import serializer
+from faexport_db.cache import response_cache, ENTITY_SUBMISSION, ENTITY_USER
+from faexport_db.change_feed import FEED_ENTITIES, FeedEntry, ChangeFeedListener
+from faexport_db.db import PooledDatabase, API_APPLICATION_NAME
+from faexport_db.ingest_formats.base import BaseFormat
+from faexport_db.metrics import REQUEST_LATENCY, REQUESTS_IN_PROGRESS
 from faexport_db.models.archive_contributor import ArchiveContributor
 from faexport_db.models.file import HashAlgo
-from faexport_db.models.submission import Submission, SubmissionSnapshot
-from faexport_db.models.user import User, UserSnapshot
+from faexport_db.models.submission import SUBMISSION_DATE_COLUMNS, Submission, SubmissionSnapshot, SubmissionHashMatch
+from faexport_db.models.user import USER_DATE_COLUMNS, User, UserSnapshot, DisplayNameMatch
 from faexport_db.models.website import Website
-from flask import Flask, request
+from faexport_db.web_common import IngestionFormatConverter, WELCOME_MESSAGE, load_dsn, error_resp, ingest_resp
+from faexport_db.web_common import is_not_modified, not_modified_resp, versioned_resp, page_args, page_data
+from faexport_db.web_common import display_name_args, date_range_args, date_range_data, date_page_data
+from faexport_db.web_common import feed_args, feed_data
+from flask import Flask, request, g, Response
+from flask.json.provider import JSONProvider
 
 
-class IngestionFormatConverter(BaseConverter):
-    """Extracts an ingestion format from the path and returns an ingestion formatter"""
-    format_classes = [SimpleUserSnapshot, SimpleSubmissionSnapshot, FAExportUser, FAExportSubmission]
-    regex = "|".join(klass.format_name for klass in format_classes)
+class SerializerJSONProvider(JSONProvider):
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return serializer.dumps(obj)
 
-    def to_python(self, value: str) -> Type[BaseFormat]:
-        format_map = {klass.format_name: klass for klass in self.format_classes}
-        klass = format_map.get(value)
-        if klass:
-            return klass
-        raise ValidationError()
-
-    def to_url(self, value: Type[BaseFormat]) -> str:
-        if isinstance(value.format_name, str):
-            return str(value.format_name)
-        raise ValidationError()
+    def loads(self, s: Union[str, bytes], **kwargs: Any) -> Any:
+        return serializer.loads(s)
 
 
 app = Flask(__name__)
 app.url_map.converters["ingest_format"] = IngestionFormatConverter
-app.json_encoder = CustomJSONEncoder
+app.json = SerializerJSONProvider(app)
+
+dsn = load_dsn()
+# Requests are handled in threads, which each take their own connection from the pool for the length of the request
+db = PooledDatabase(psycopg2.pool.ThreadedConnectionPool(
+    int(os.getenv("DB_POOL_MIN_SIZE", "2")),
+    int(os.getenv("DB_POOL_SIZE", "20")),
+    dsn,
+    application_name=API_APPLICATION_NAME,
+))
+# Change feed readers are woken by notifications, which are listened for on a separate connection
+feed_listener = ChangeFeedListener(dsn)
+feed_listener.start()
+
+
+def _route_label() -> str:
+    if request.url_rule is None:
+        return "unmatched"
+    return request.url_rule.rule
+
+
+@app.before_request
+def start_request_timer() -> None:
+    g.request_start_time = time.perf_counter()
+    g.request_route = _route_label()
+    REQUESTS_IN_PROGRESS.labels(request.method, g.request_route).inc()
+
+
+@app.after_request
+def record_request_latency(response: Response) -> Response:
+    REQUEST_LATENCY.labels(request.method, g.request_route, response.status_code).observe(
+        time.perf_counter() - g.request_start_time
+    )
+    return response
 
-dsn = os.getenv("DSN")
-if dsn is None:
-    with open("./config.json", "r") as f:
-        conf = json.load(f)
-    dsn = conf["db_conn"]
-db_conn = psycopg2.connect(dsn)
-db = Database(db_conn)
 
+@app.teardown_request
+def finish_request_timer(_exc) -> None:
+    if "request_route" in g:
+        REQUESTS_IN_PROGRESS.labels(request.method, g.request_route).dec()
 
-def error_resp(code: int, message: str) -> Tuple[Dict, int]:
-    return {
-        "error": {
-            "code": code,
-            "message": message
-        }
-    }, code
+
+@app.teardown_request
+def release_db_connection(_exc) -> None:
+    db.release()
 
 
 @app.route('/')
 def hello():
-    return (
-        'Welcome to FAExport_DB. This is a project to provide a cache database for furry art websites, and '
-        'hopefully reduce scraping impact on those websites!'
-    )
+    return WELCOME_MESSAGE
+
+
+@app.route("/metrics")
+def metrics() -> Response:
+    return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
 
 
 @app.route("/api/view/submissions/<website_id>/<submission_id>.json")
@@ -70,12 +97,23 @@ def view_submission(website_id: str, submission_id: str):
     website = Website.from_database(db, website_id)
     if not website:
         return error_resp(404, f"Website does not exist by ID: {website_id}")
-    submission = Submission.from_database(db, website.website_id, submission_id)
-    if not submission:
+    version = Submission.version_from_database(db, website.website_id, submission_id)
+    if version is None:
         return error_resp(404, f"There is no entry for a submission with the ID {submission_id} on {website.full_name}")
-    return {
-        "data": submission.to_web_json()
-    }
+    if is_not_modified(request, version):
+        return not_modified_resp(version)
+    cache_key = (ENTITY_SUBMISSION, website.website_id, submission_id)
+    data = response_cache().get(cache_key, "view", version.etag)
+    if data is None:
+        submission = Submission.from_database(db, website.website_id, submission_id)
+        if not submission:
+            return error_resp(
+                404,
+                f"There is no entry for a submission with the ID {submission_id} on {website.full_name}"
+            )
+        data = submission.to_web_json()
+        response_cache().set(cache_key, "view", version.etag, data)
+    return versioned_resp(data, version)
 
 
 @app.route("/api/view/submissions/<website_id>/<submission_id>/snapshots.json")
@@ -83,15 +121,26 @@ def view_submission_snapshots(website_id: str, submission_id: str):
     website = Website.from_database(db, website_id)
     if not website:
         return error_resp(404, f"Website does not exist by ID: {website_id}")
-    submission = Submission.from_database(db, website.website_id, submission_id)
-    if not submission:
+    version = Submission.version_from_database(db, website.website_id, submission_id)
+    if version is None:
         return error_resp(
             404,
             f"There are no snapshots for a submission with the ID {submission_id} on {website.full_name}"
         )
-    return {
-        "data": submission.to_web_snapshots_json()
-    }
+    if is_not_modified(request, version):
+        return not_modified_resp(version)
+    cache_key = (ENTITY_SUBMISSION, website.website_id, submission_id)
+    data = response_cache().get(cache_key, "snapshots", version.etag)
+    if data is None:
+        submission = Submission.from_database(db, website.website_id, submission_id)
+        if not submission:
+            return error_resp(
+                404,
+                f"There are no snapshots for a submission with the ID {submission_id} on {website.full_name}"
+            )
+        data = submission.to_web_snapshots_json()
+        response_cache().set(cache_key, "snapshots", version.etag, data)
+    return versioned_resp(data, version)
 
 
 @app.route("/api/view/submissions/<website_id>.json")
@@ -109,17 +158,46 @@ def list_submissions(website_id: str):
     }
 
 
+@app.route("/api/date_range/submissions/<website_id>.json")
+def list_submissions_by_date(website_id: str):
+    website = Website.from_database(db, website_id)
+    if not website:
+        return error_resp(404, f"Website does not exist by ID: {website_id}")
+    try:
+        date_name, start, end, after, limit = date_range_args(request.args, SUBMISSION_DATE_COLUMNS)
+    except ValueError as e:
+        return error_resp(400, str(e))
+    snapshot_rows = Submission.list_snapshots_by_date(
+        db, website.website_id, date_name, start, end, after=after, limit=limit
+    )
+    return {
+        "data": {
+            "website_id": website.website_id,
+            **date_range_data(date_name, start, end),
+            **date_page_data(("submission_snapshot_id", "site_submission_id"), snapshot_rows, limit),
+        }
+    }
+
+
 @app.route("/api/view/users/<website_id>/<user_id>.json")
 def view_user(website_id: str, user_id: str):
     website = Website.from_database(db, website_id)
     if not website:
         return error_resp(404, f"Website does not exist by ID: {website_id}")
-    user = User.from_database(db, website_id, user_id)
-    if not user:
+    version = User.version_from_database(db, website.website_id, user_id)
+    if version is None:
         return error_resp(404, f"There is no entry for a user with the ID {user_id} on {website.full_name}")
-    return {
-        "data": user.to_web_json()
-    }
+    if is_not_modified(request, version):
+        return not_modified_resp(version)
+    cache_key = (ENTITY_USER, website.website_id, user_id)
+    data = response_cache().get(cache_key, "view", version.etag)
+    if data is None:
+        user = User.from_database(db, website.website_id, user_id)
+        if not user:
+            return error_resp(404, f"There is no entry for a user with the ID {user_id} on {website.full_name}")
+        data = user.to_web_json()
+        response_cache().set(cache_key, "view", version.etag, data)
+    return versioned_resp(data, version)
 
 
 @app.route("/api/view/users/<website_id>/<user_id>/snapshots.json")
@@ -127,11 +205,58 @@ def view_user_snapshots(website_id: str, user_id: str):
     website = Website.from_database(db, website_id)
     if not website:
         return error_resp(404, f"Website does not exist by ID: {website_id}")
-    user = User.from_database(db, website_id, user_id)
-    if not user:
+    version = User.version_from_database(db, website.website_id, user_id)
+    if version is None:
         return error_resp(404, f"There are no snapshots for a user with the ID {user_id} on {website.full_name}")
+    if is_not_modified(request, version):
+        return not_modified_resp(version)
+    cache_key = (ENTITY_USER, website.website_id, user_id)
+    data = response_cache().get(cache_key, "snapshots", version.etag)
+    if data is None:
+        user = User.from_database(db, website.website_id, user_id)
+        if not user:
+            return error_resp(404, f"There are no snapshots for a user with the ID {user_id} on {website.full_name}")
+        data = user.to_web_snapshots_json()
+        response_cache().set(cache_key, "snapshots", version.etag, data)
+    return versioned_resp(data, version)
+
+
+@app.route("/api/view/users/<website_id>/<user_id>/submissions.json")
+def list_user_submissions(website_id: str, user_id: str):
+    website = Website.from_database(db, website_id)
+    if not website:
+        return error_resp(404, f"Website does not exist by ID: {website_id}")
+    try:
+        after, limit = page_args(request.args)
+    except ValueError as e:
+        return error_resp(400, str(e))
+    submission_ids = Submission.list_site_ids_for_uploader(db, website.website_id, user_id, after=after, limit=limit)
+    return {
+        "data": {
+            "website_id": website.website_id,
+            "site_user_id": user_id,
+            **page_data("submission_ids", submission_ids, limit),
+        }
+    }
+
+
+@app.route("/api/lookup/users/<website_id>.json")
+def lookup_users_by_display_name(website_id: str):
+    website = Website.from_database(db, website_id)
+    if not website:
+        return error_resp(404, f"Website does not exist by ID: {website_id}")
+    try:
+        display_name, fuzzy, limit = display_name_args(request.args)
+    except ValueError as e:
+        return error_resp(400, str(e))
+    matches = DisplayNameMatch.search(db, website.website_id, display_name, fuzzy=fuzzy, limit=limit)
     return {
-        "data": user.to_web_snapshots_json()
+        "data": {
+            "website_id": website.website_id,
+            "display_name": display_name,
+            "fuzzy": fuzzy,
+            "matches": [match.to_web_json() for match in matches],
+        }
     }
 
 
@@ -140,11 +265,7 @@ def list_users(website_id: str):
     website = Website.from_database(db, website_id)
     if not website:
         return error_resp(404, f"Website does not exist by ID: {website_id}")
-    user_rows = db.select(
-        "SELECT DISTINCT site_user_id FROM user_snapshots WHERE website_id = %s",
-        (website.website_id,)
-    )
-    user_ids = [user_row[0] for user_row in user_rows]
+    user_ids = User.list_unique_site_ids(db, website.website_id)
     return {
         "data": {
             "user_count": len(user_ids),
@@ -153,6 +274,27 @@ def list_users(website_id: str):
     }
 
 
+@app.route("/api/date_range/users/<website_id>.json")
+def list_users_by_date(website_id: str):
+    website = Website.from_database(db, website_id)
+    if not website:
+        return error_resp(404, f"Website does not exist by ID: {website_id}")
+    try:
+        date_name, start, end, after, limit = date_range_args(request.args, USER_DATE_COLUMNS)
+    except ValueError as e:
+        return error_resp(400, str(e))
+    snapshot_rows = User.list_snapshots_by_date(
+        db, website.website_id, date_name, start, end, after=after, limit=limit
+    )
+    return {
+        "data": {
+            "website_id": website.website_id,
+            **date_range_data(date_name, start, end),
+            **date_page_data(("user_snapshot_id", "site_user_id"), snapshot_rows, limit),
+        }
+    }
+
+
 @app.route("/api/ingest/<ingest_format:formatter>", methods=["POST"])
 def ingest_data(formatter: BaseFormat):
     api_key = request.headers.get("X-API-Key")
@@ -165,8 +307,38 @@ def ingest_data(formatter: BaseFormat):
     if not web_data:
         return error_resp(400, "Submission snapshot data must be posted as json")
     format_resp = formatter.format_web_data(web_data, contributor)
-    SubmissionSnapshot.save_batch(db, format_resp.submission_snapshots)
+    try:
+        SubmissionSnapshot.save_batch(db, format_resp.submission_snapshots)
+    except ValueError as e:
+        return error_resp(400, str(e))
     UserSnapshot.save_batch(db, format_resp.user_snapshots)
+    return ingest_resp(format_resp)
+
+
+@app.route("/api/feed/<feed_name>.json")
+def read_feed(feed_name: str):
+    entity = FEED_ENTITIES.get(feed_name)
+    if entity is None:
+        return error_resp(404, f"There is no feed by the name: {feed_name}")
+    try:
+        after_id, limit, wait = feed_args(request.args)
+    except ValueError as e:
+        return error_resp(400, str(e))
+    # Long poll, waiting to be notified of new snapshots if there are none after the cursor yet
+    deadline = time.monotonic() + wait
+    while True:
+        sequence = feed_listener.sequence(entity)
+        entries = FeedEntry.list_after(db, entity, after_id, limit=limit)
+        remaining = deadline - time.monotonic()
+        if entries or remaining <= 0:
+            break
+        # Give the connection back while waiting, so that long polls do not hold the pool
+        db.release()
+        if not feed_listener.wait(entity, sequence, remaining):
+            break
+    return {
+        "data": feed_data(feed_name, entries, after_id)
+    }
 
 
 @app.route("/api/websites.json")
@@ -210,6 +382,16 @@ def search_hash():
     hash_algo = HashAlgo.from_database(db, algo_id)
     if not hash_algo:
         return error_resp(400, "Hash algo not found by ID")
+    try:
+        hash_algo.db_values(hash_bytes)
+    except ValueError as e:
+        return error_resp(400, str(e))
+    # The "ids" mode answers from the hash lookup table alone, without loading the matching snapshots
+    if search_data.get("mode") == "ids":
+        matches = SubmissionHashMatch.search(db, hash_algo, hash_bytes)
+        return {
+            "results": [match.to_web_json() for match in matches]
+        }
     snapshots = SubmissionSnapshot.search_by_file_hash(db, hash_algo, hash_bytes)
     return {
         "results": [snapshot.to_web_json() for snapshot in snapshots]
@@ -0,0 +1,231 @@
+import datetime
+import json
+import os
+from typing import Dict, Tuple, Type, Any, TYPE_CHECKING, Mapping, List, Collection, Optional
+
+from werkzeug.http import http_date, quote_etag
+from werkzeug.routing import BaseConverter, ValidationError
+
+from faexport_db.db import parse_datetime
+from faexport_db.ingest_formats.base import SimpleUserSnapshot, SimpleSubmissionSnapshot, BaseFormat, FormatResponse
+from faexport_db.ingest_formats.faexport import FAExportUser, FAExportSubmission
+from faexport_db.models.version import EntityVersion
+from faexport_db.profiler import configure_slow_query_log
+
+if TYPE_CHECKING:
+    from werkzeug.sansio.request import Request
+    from faexport_db.change_feed import FeedEntry
+
+WELCOME_MESSAGE = (
+    'Welcome to FAExport_DB. This is a project to provide a cache database for furry art websites, and '
+    'hopefully reduce scraping impact on those websites!'
+)
+# Page sizes for paginated listings
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Seconds a change feed request may wait for new snapshots, when there are none after its cursor
+DEFAULT_FEED_WAIT = 30
+MAX_FEED_WAIT = 60
+# Longest date range which can be listed, so that the snapshots read for each page of a listing stay bounded
+MAX_DATE_RANGE = datetime.timedelta(days=31)
+
+
+class IngestionFormatConverter(BaseConverter):
+    """Extracts an ingestion format from the path and returns an ingestion formatter"""
+    format_classes = [SimpleUserSnapshot, SimpleSubmissionSnapshot, FAExportUser, FAExportSubmission]
+    regex = "|".join(klass.format_name for klass in format_classes)
+
+    def to_python(self, value: str) -> Type[BaseFormat]:
+        format_map = {klass.format_name: klass for klass in self.format_classes}
+        klass = format_map.get(value)
+        if klass:
+            return klass
+        raise ValidationError()
+
+    def to_url(self, value: Type[BaseFormat]) -> str:
+        if isinstance(value.format_name, str):
+            return str(value.format_name)
+        raise ValidationError()
+
+
+def load_dsn() -> str:
+    dsn = os.getenv("DSN")
+    if dsn is None:
+        with open("./config.json", "r") as f:
+            conf = json.load(f)
+        dsn = conf["db_conn"]
+    slow_query_log = os.getenv("SLOW_QUERY_LOG")
+    if slow_query_log:
+        configure_slow_query_log(slow_query_log)
+    return dsn
+
+
+def error_resp(code: int, message: str) -> Tuple[Dict, int]:
+    return {
+        "error": {
+            "code": code,
+            "message": message
+        }
+    }, code
+
+
+def ingest_resp(format_resp: FormatResponse) -> Dict:
+    return {
+        "data": {
+            "submission_snapshot_ids": [
+                snapshot.submission_snapshot_id for snapshot in format_resp.submission_snapshots
+            ],
+            "user_snapshot_ids": [snapshot.user_snapshot_id for snapshot in format_resp.user_snapshots],
+        }
+    }
+
+
+def _limit_arg(args: Mapping[str, str]) -> int:
+    try:
+        limit = int(args.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("Page limit must be an integer")
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"Page limit must be between 1 and {MAX_PAGE_SIZE}")
+    return limit
+
+
+def page_args(args: Mapping[str, str]) -> Tuple[str, int]:
+    """Reads keyset pagination query arguments, the site ID to list from after, and the page size"""
+    return args.get("after", ""), _limit_arg(args)
+
+
+def _datetime_arg(args: Mapping[str, str], name: str) -> Optional[datetime.datetime]:
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        parsed = parse_datetime(value)
+    except (ValueError, OverflowError):
+        raise ValueError(f"The {name} date must be an ISO 8601 datetime")
+    # Dates without a timezone are taken to be UTC
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed
+
+
+def date_range_args(
+        args: Mapping[str, str], date_names: Collection[str]
+) -> Tuple[str, datetime.datetime, datetime.datetime, Optional[Tuple[datetime.datetime, int]], int]:
+    """
+    Reads date range listing query arguments, the date to list by, the start and end of the range, which is at most
+    MAX_DATE_RANGE long and ends that long after the start if no end is given, the date and snapshot ID to list from
+    after, and the page size
+    """
+    date_name = args.get("date", next(iter(date_names)))
+    if date_name not in date_names:
+        raise ValueError(f"Listings can be by date: {', '.join(date_names)}")
+    start = _datetime_arg(args, "start")
+    if start is None:
+        raise ValueError("A start date must be given")
+    end = _datetime_arg(args, "end") or start + MAX_DATE_RANGE
+    if start >= end:
+        raise ValueError("The start date must be before the end date")
+    if end - start > MAX_DATE_RANGE:
+        raise ValueError(f"Date ranges can be at most {MAX_DATE_RANGE.days} days long")
+    after = None
+    after_date = _datetime_arg(args, "after_date")
+    if after_date is not None:
+        try:
+            after = after_date, int(args.get("after_id", 0))
+        except ValueError:
+            raise ValueError("Date range cursor after_id must be an integer snapshot ID")
+    return date_name, start, end, after, _limit_arg(args)
+
+
+def date_range_data(date_name: str, start: datetime.datetime, end: datetime.datetime) -> Dict:
+    return {
+        "date": date_name,
+        "start": start,
+        "end": end,
+    }
+
+
+def date_page_data(
+        id_keys: Tuple[str, str], snapshot_rows: List[Tuple[int, str, datetime.datetime]], limit: int
+) -> Dict:
+    # As with site ID pages, only a full page gives a cursor, which is the date and snapshot ID of its last snapshot
+    snapshot_id_key, site_id_key = id_keys
+    last_row = snapshot_rows[-1] if len(snapshot_rows) == limit else None
+    return {
+        "count": len(snapshot_rows),
+        "snapshots": [
+            {snapshot_id_key: snapshot_id, site_id_key: site_id, "date": date}
+            for snapshot_id, site_id, date in snapshot_rows
+        ],
+        "next_after_date": last_row[2] if last_row else None,
+        "next_after_id": last_row[0] if last_row else None,
+    }
+
+
+def display_name_args(args: Mapping[str, str]) -> Tuple[str, bool, int]:
+    """Reads display name lookup query arguments, the display name, whether to match fuzzily, and the result limit"""
+    display_name = args.get("display_name", "")
+    if not display_name:
+        raise ValueError("A display_name to look up must be given")
+    fuzzy = args.get("fuzzy", "false").lower() in ("true", "1", "yes")
+    return display_name, fuzzy, _limit_arg(args)
+
+
+def page_data(ids_key: str, site_ids: List[str], limit: int) -> Dict:
+    # Only a full page may be followed by more results, so only a full page gives a cursor for the next page
+    return {
+        "count": len(site_ids),
+        ids_key: site_ids,
+        "next_after": site_ids[-1] if len(site_ids) == limit else None,
+    }
+
+
+def feed_args(args: Mapping[str, str]) -> Tuple[int, int, float]:
+    """Reads change feed query arguments, the feed ID to read from after, the page size, and how long to wait"""
+    try:
+        after_id = int(args.get("after_id", 0))
+    except ValueError:
+        raise ValueError("Feed cursor after_id must be an integer feed ID")
+    try:
+        wait = float(args.get("wait", DEFAULT_FEED_WAIT))
+    except ValueError:
+        raise ValueError("Feed wait must be a number of seconds")
+    if not 0 <= wait <= MAX_FEED_WAIT:
+        raise ValueError(f"Feed wait must be between 0 and {MAX_FEED_WAIT} seconds")
+    return after_id, _limit_arg(args), wait
+
+
+def feed_data(feed_name: str, entries: List["FeedEntry"], after_id: int) -> Dict:
+    # The cursor is always given, so that a reader can keep polling with it whether or not there was anything new
+    return {
+        "feed": feed_name,
+        "count": len(entries),
+        "snapshots": [entry.to_web_json() for entry in entries],
+        "next_after_id": entries[-1].feed_id if entries else after_id,
+    }
+
+
+def validator_headers(version: EntityVersion) -> Dict[str, str]:
+    return {
+        "ETag": quote_etag(version.etag),
+        "Last-Modified": http_date(version.last_modified),
+    }
+
+
+def is_not_modified(request: "Request", version: EntityVersion) -> bool:
+    # If-None-Match takes precedence over If-Modified-Since, as in RFC 7232
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(version.etag)
+    if request.if_modified_since is not None:
+        # HTTP dates have a resolution of whole seconds
+        return version.last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def not_modified_resp(version: EntityVersion) -> Tuple[str, int, Dict[str, str]]:
+    return "", 304, validator_headers(version)
+
+
+def versioned_resp(data: Any, version: EntityVersion) -> Tuple[Dict, int, Dict[str, str]]:
+    return {"data": data}, 200, validator_headers(version)
@@ -0,0 +1,207 @@
+import dataclasses
+import datetime
+import hashlib
+import json
+import pathlib
+import random
+from typing import Iterator, List, Optional, Dict
+
+import tqdm
+
+from faexport_db.db import Database
+from faexport_db.models.archive_contributor import ArchiveContributor
+from faexport_db.models.file import File, FileHash, HashAlgo
+from faexport_db.models.submission import SubmissionSnapshot
+from faexport_db.models.user import UserSnapshot
+from faexport_db.models.website import Website
+from scripts.ingest.bulk_load import BulkLoader
+
+SCHEMA_DIR = pathlib.Path(__file__).parent.parent.parent / "faexport_db" / "schema"
+CORPUS_SETTING = "benchmark_corpus"
+WEBSITE = Website("bench", "Benchmark website", "https://example.com")
+CONTRIBUTOR = ArchiveContributor("benchmark corpus")
+SHA_HASH = HashAlgo("any", "sha256", hash_length=32)
+DHASH = HashAlgo("rust", "dhash", hash_length=8)
+BASE_DATE = datetime.datetime(2020, 1, 1, 0, 0, 0, tzinfo=datetime.timezone.utc)
+
+
+class NotABenchmarkDatabase(Exception):
+    pass
+
+
+@dataclasses.dataclass
+class CorpusConfig:
+    submissions: int = 100_000
+    snapshots_per_submission: int = 3
+    keywords_per_snapshot: int = 15
+    keyword_vocabulary: int = 50_000
+    users: int = 10_000
+    snapshots_per_user: int = 2
+    random_seed: int = 621
+
+    @property
+    def total_submission_snapshots(self) -> int:
+        return self.submissions * self.snapshots_per_submission
+
+    def to_json(self) -> Dict:
+        return dataclasses.asdict(self)
+
+    @classmethod
+    def from_json(cls, data: Dict) -> "CorpusConfig":
+        return cls(**data)
+
+
+def submission_id(num: int) -> str:
+    return str(num + 1)
+
+
+def user_id(num: int) -> str:
+    return f"user{num}"
+
+
+def file_sha256(submission_num: int, file_version: int) -> bytes:
+    return hashlib.sha256(f"{submission_num}-{file_version}".encode()).digest()
+
+
+def file_dhash(submission_num: int, file_version: int) -> bytes:
+    return hashlib.blake2b(f"{submission_num}-{file_version}".encode(), digest_size=8).digest()
+
+
+class CorpusGenerator:
+    def __init__(self, config: CorpusConfig) -> None:
+        self.config = config
+        self.rand = random.Random(config.random_seed)
+        self.vocabulary = [f"keyword{num}" for num in range(config.keyword_vocabulary)]
+
+    def submission_snapshots(self, submission_num: int) -> List[SubmissionSnapshot]:
+        snapshots = []
+        file_version = 0
+        uploader = user_id(submission_num % self.config.users)
+        for snapshot_num in range(self.config.snapshots_per_submission):
+            # Files are mostly unchanged between snapshots, as they are in real data
+            if self.rand.random() < 0.1:
+                file_version += 1
+            snapshots.append(SubmissionSnapshot(
+                WEBSITE.website_id,
+                submission_id(submission_num),
+                CONTRIBUTOR,
+                BASE_DATE + datetime.timedelta(days=snapshot_num * 30, seconds=submission_num),
+                uploader_site_user_id=uploader,
+                title=f"Benchmark submission {submission_num}",
+                description=f"Description of benchmark submission {submission_num}, snapshot {snapshot_num}",
+                datetime_posted=BASE_DATE + datetime.timedelta(seconds=submission_num),
+                extra_data={"rating": self.rand.choice(["general", "mature", "adult"]), "view_count": snapshot_num},
+                ordered_keywords=self.rand.sample(self.vocabulary, self.config.keywords_per_snapshot),
+                files=[File(
+                    None,
+                    file_url=f"https://example.com/files/{submission_num}/{file_version}.png",
+                    file_size=1000 + submission_num,
+                    hashes=[
+                        FileHash(SHA_HASH.algo_id, file_sha256(submission_num, file_version)),
+                        FileHash(DHASH.algo_id, file_dhash(submission_num, file_version)),
+                    ]
+                )]
+            ))
+        return snapshots
+
+    def user_snapshots(self, user_num: int) -> List[UserSnapshot]:
+        return [
+            UserSnapshot(
+                WEBSITE.website_id,
+                user_id(user_num),
+                CONTRIBUTOR,
+                BASE_DATE + datetime.timedelta(days=snapshot_num * 30, seconds=user_num),
+                display_name=f"User_{user_num}",
+                extra_data={"watcher_count": snapshot_num},
+            )
+            for snapshot_num in range(self.config.snapshots_per_user)
+        ]
+
+    def iter_submission_batches(self, batch_size: int) -> Iterator[List[SubmissionSnapshot]]:
+        batch = []
+        for submission_num in range(self.config.submissions):
+            batch.extend(self.submission_snapshots(submission_num))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def iter_user_batches(self, batch_size: int) -> Iterator[List[UserSnapshot]]:
+        batch = []
+        for user_num in range(self.config.users):
+            batch.extend(self.user_snapshots(user_num))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def seeded_corpus(db: Database) -> Optional[CorpusConfig]:
+    setting_rows = db.select(
+        "SELECT setting_value FROM settings WHERE setting_id = %s",
+        (CORPUS_SETTING,)
+    )
+    if not setting_rows:
+        return None
+    return CorpusConfig.from_json(json.loads(setting_rows[0][0]))
+
+
+def _has_schema(db: Database) -> bool:
+    table_rows = db.select("SELECT to_regclass('public.websites')", tuple())
+    return table_rows[0][0] is not None
+
+
+def _create_schema(db: Database) -> None:
+    for schema_file in ["faexport_db.sql", "indexes.sql"]:
+        with open(SCHEMA_DIR / schema_file, "r") as f:
+            db.update(f.read(), tuple())
+
+
+def check_benchmark_database(db: Database) -> None:
+    if not _has_schema(db):
+        return
+    if seeded_corpus(db) is not None:
+        return
+    website_ids = [website.website_id for website in Website.list_all(db) if website.website_id != WEBSITE.website_id]
+    if website_ids:
+        raise NotABenchmarkDatabase(
+            f"Database already contains data for websites {website_ids}, and was not created as a benchmark corpus. "
+            "Point the benchmark at an empty database."
+        )
+
+
+def seed_corpus(db: Database, dsn: str, config: CorpusConfig, *, batch_size: int = 5000) -> None:
+    check_benchmark_database(db)
+    existing = seeded_corpus(db)
+    if existing is not None:
+        if existing == config:
+            print("Benchmark corpus is already seeded")
+            return
+        raise NotABenchmarkDatabase(
+            f"Database is already seeded with a different benchmark corpus: {existing}. Use a fresh database."
+        )
+    if not _has_schema(db):
+        print("Creating schema")
+        _create_schema(db)
+    WEBSITE.save(db)
+    CONTRIBUTOR.save(db)
+    SHA_HASH.save(db)
+    DHASH.save(db)
+    generator = CorpusGenerator(config)
+    loader = BulkLoader(db, dsn)
+    # Corpus snapshots all differ from each other, so are saved without checking for repeats
+    with loader.deferred_indexes():
+        with tqdm.tqdm(desc="Seeding submission snapshots", total=config.total_submission_snapshots) as progress:
+            for submission_batch in generator.iter_submission_batches(batch_size):
+                SubmissionSnapshot.save_batch(db, submission_batch, skip_repeats=False)
+                progress.update(len(submission_batch))
+        with tqdm.tqdm(desc="Seeding user snapshots", total=config.users * config.snapshots_per_user) as progress:
+            for user_batch in generator.iter_user_batches(batch_size):
+                UserSnapshot.save_batch(db, user_batch, skip_repeats=False)
+                progress.update(len(user_batch))
+    db.update(
+        "INSERT INTO settings (setting_id, setting_value) VALUES (%s, %s)",
+        (CORPUS_SETTING, json.dumps(config.to_json()))
+    )
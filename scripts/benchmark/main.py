@@ -0,0 +1,241 @@
+import argparse
+import datetime
+import json
+import os
+import pathlib
+import platform
+import random
+import statistics
+import subprocess
+import time
+from typing import Callable, Dict, List, Any, Optional
+
+import psycopg2
+
+from faexport_db import serializer
+from faexport_db.db import Database
+from faexport_db.models.file import HashAlgo
+from faexport_db.models.submission import Submission, SubmissionSnapshot
+from faexport_db.models.user import User
+from scripts.benchmark.corpus import (
+    CorpusConfig,
+    CorpusGenerator,
+    seed_corpus,
+    seeded_corpus,
+    submission_id,
+    user_id,
+    file_sha256,
+    WEBSITE,
+    SHA_HASH,
+    CONTRIBUTOR,
+    DHASH,
+    check_benchmark_database,
+)
+from scripts.cron.remove_duplicates import delete_submissions
+
+RESULTS_DIR = pathlib.Path("./benchmark_results")
+
+
+def time_calls(func: Callable[[Any], Any], call_args: List[Any], *, warmup: int = 3) -> Dict:
+    for arg in call_args[:warmup]:
+        func(arg)
+    durations = []
+    for arg in call_args:
+        start_time = time.perf_counter()
+        func(arg)
+        durations.append(time.perf_counter() - start_time)
+    durations.sort()
+    return {
+        "calls": len(durations),
+        "mean_ms": statistics.mean(durations) * 1000,
+        "p50_ms": durations[len(durations) // 2] * 1000,
+        "p95_ms": durations[int(len(durations) * 0.95)] * 1000,
+        "p99_ms": durations[int(len(durations) * 0.99)] * 1000,
+        "max_ms": durations[-1] * 1000,
+    }
+
+
+class LegacyJSONEncoder(json.JSONEncoder):
+    """The encoder used before faexport_db.serializer, kept as a baseline for the serializer benchmarks"""
+    def default(self, obj):
+        try:
+            if isinstance(obj, datetime.datetime):
+                return obj.isoformat()
+            iterable = iter(obj)
+        except TypeError:
+            pass
+        else:
+            return list(iterable)
+        return json.JSONEncoder.default(self, obj)
+
+
+class BenchmarkSuite:
+    def __init__(self, db: Database, dsn: str, config: CorpusConfig, *, calls: int = 200) -> None:
+        self.db = db
+        self.dsn = dsn
+        self.config = config
+        self.calls = calls
+        self.rand = random.Random(config.random_seed)
+        self.benchmarks: Dict[str, Callable[[], Dict]] = {
+            "submission_from_database": self.bench_submission_from_database,
+            "user_from_database": self.bench_user_from_database,
+            "search_by_file_hash": self.bench_search_by_file_hash,
+            "api_list_submissions": self.bench_api_list_submissions,
+            "api_list_users": self.bench_api_list_users,
+            "json_legacy_encoder": self.bench_json_legacy_encoder,
+            "json_serializer": self.bench_json_serializer,
+            "submission_snapshot_save_batch": self.bench_submission_save_batch,
+        }
+        self._web_client = None
+        self._web_payloads: Optional[List[Dict]] = None
+
+    def _random_submission_nums(self) -> List[int]:
+        return [self.rand.randrange(self.config.submissions) for _ in range(self.calls)]
+
+    def bench_submission_from_database(self) -> Dict:
+        site_ids = [submission_id(num) for num in self._random_submission_nums()]
+        return time_calls(lambda site_id: Submission.from_database(self.db, WEBSITE.website_id, site_id), site_ids)
+
+    def bench_user_from_database(self) -> Dict:
+        site_ids = [user_id(self.rand.randrange(self.config.users)) for _ in range(self.calls)]
+        return time_calls(lambda site_id: User.from_database(self.db, WEBSITE.website_id, site_id), site_ids)
+
+    def bench_submission_save_batch(self) -> Dict:
+        generator = CorpusGenerator(self.config)
+        batch_count = max(1, self.calls // 20)
+        # Benchmark batches re-save existing submissions, as real ingests mostly do
+        batches = [
+            sum([generator.submission_snapshots(num) for num in self._random_submission_nums()[:100]], start=[])
+            for _ in range(batch_count)
+        ]
+        result = time_calls(lambda batch: SubmissionSnapshot.save_batch(self.db, batch), batches, warmup=0)
+        # Remove the saved snapshots again, so that repeated runs benchmark the same corpus
+        delete_submissions(self.db, [snapshot.submission_snapshot_id for batch in batches for snapshot in batch])
+        return result
+
+    def bench_search_by_file_hash(self) -> Dict:
+        hash_algo = HashAlgo.from_database(self.db, SHA_HASH.algo_id)
+        hash_values = [file_sha256(num, 0) for num in self._random_submission_nums()]
+        return time_calls(
+            lambda hash_value: SubmissionSnapshot.search_by_file_hash(self.db, hash_algo, hash_value),
+            hash_values
+        )
+
+    def web_payloads(self) -> List[Dict]:
+        # Snapshot lists are the largest responses, and include datetimes and nested extra data
+        if self._web_payloads is None:
+            self._web_payloads = [
+                Submission.from_database(self.db, WEBSITE.website_id, submission_id(num)).to_web_snapshots_json()
+                for num in self._random_submission_nums()
+            ]
+        return self._web_payloads
+
+    def bench_json_legacy_encoder(self) -> Dict:
+        return time_calls(lambda payload: json.dumps(payload, cls=LegacyJSONEncoder), self.web_payloads())
+
+    def bench_json_serializer(self) -> Dict:
+        return time_calls(serializer.dumps, self.web_payloads())
+
+    def web_client(self) -> Any:
+        if self._web_client is None:
+            os.environ["DSN"] = self.dsn
+            from faexport_db.web import app
+            self._web_client = app.test_client()
+        return self._web_client
+
+    def _bench_endpoint(self, path: str, calls: int) -> Dict:
+        client = self.web_client()
+
+        def fetch(_: Any) -> None:
+            resp = client.get(path)
+            if resp.status_code != 200:
+                raise ValueError(f"Benchmark request to {path} failed with status {resp.status_code}")
+        return time_calls(fetch, list(range(calls)), warmup=1)
+
+    def bench_api_list_submissions(self) -> Dict:
+        return self._bench_endpoint(f"/api/view/submissions/{WEBSITE.website_id}.json", max(1, self.calls // 50))
+
+    def bench_api_list_users(self) -> Dict:
+        return self._bench_endpoint(f"/api/view/users/{WEBSITE.website_id}.json", max(1, self.calls // 50))
+
+    def run(self, only: Optional[List[str]] = None) -> Dict:
+        results = {}
+        for name, benchmark in self.benchmarks.items():
+            if only and name not in only:
+                continue
+            print(f"Running benchmark: {name}")
+            results[name] = benchmark()
+            print(f"  mean {results[name]['mean_ms']:.2f}ms, p95 {results[name]['p95_ms']:.2f}ms")
+        return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results: Dict, baseline: Dict) -> None:
+    print(f"Comparison against commit {baseline.get('commit')}:")
+    for name, result in results["benchmarks"].items():
+        baseline_result = baseline["benchmarks"].get(name)
+        if baseline_result is None:
+            print(f"  {name}: no baseline")
+            continue
+        ratio = result["mean_ms"] / baseline_result["mean_ms"]
+        print(f"  {name}: {baseline_result['mean_ms']:.2f}ms -> {result['mean_ms']:.2f}ms ({ratio:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark faexport_db model hot paths against a local postgres database seeded with synthetic data"
+    )
+    parser.add_argument("--dsn", required=True, help="DSN of the benchmark database. Must be empty, or a benchmark db")
+    parser.add_argument("--seed", action="store_true", help="Seed the database with the synthetic corpus first")
+    parser.add_argument("--submissions", type=int, default=CorpusConfig.submissions)
+    parser.add_argument("--snapshots-per-submission", type=int, default=CorpusConfig.snapshots_per_submission)
+    parser.add_argument("--keywords-per-snapshot", type=int, default=CorpusConfig.keywords_per_snapshot)
+    parser.add_argument("--users", type=int, default=CorpusConfig.users)
+    parser.add_argument("--calls", type=int, default=200, help="Number of calls to time for each benchmark")
+    parser.add_argument("--only", nargs="*", help="Names of benchmarks to run")
+    parser.add_argument("--output", help="File to write results to. Defaults to benchmark_results/<commit>.json")
+    parser.add_argument("--compare", help="Previous results file to compare against")
+    args = parser.parse_args()
+
+    db_conn = psycopg2.connect(args.dsn)
+    db_obj = Database(db_conn)
+    check_benchmark_database(db_obj)
+    if args.seed:
+        seed_corpus(db_obj, args.dsn, CorpusConfig(
+            submissions=args.submissions,
+            snapshots_per_submission=args.snapshots_per_submission,
+            keywords_per_snapshot=args.keywords_per_snapshot,
+            users=args.users,
+        ))
+    corpus = seeded_corpus(db_obj)
+    if corpus is None:
+        raise SystemExit("Benchmark database has not been seeded, run with --seed first")
+    WEBSITE.save(db_obj)
+    CONTRIBUTOR.save(db_obj)
+    SHA_HASH.save(db_obj)
+    DHASH.save(db_obj)
+
+    suite = BenchmarkSuite(db_obj, args.dsn, corpus, calls=args.calls)
+    commit = git_commit()
+    results_data = {
+        "commit": commit,
+        "run_datetime": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python_version": platform.python_version(),
+        "json_backend": serializer.BACKEND,
+        "corpus": corpus.to_json(),
+        "benchmarks": suite.run(args.only),
+    }
+    output_path = pathlib.Path(args.output) if args.output else RESULTS_DIR / f"{commit or 'unknown'}.json"
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump(results_data, f, indent=2)
+    print(f"Results written to {output_path}")
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare_results(results_data, json.load(f))
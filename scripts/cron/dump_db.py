@@ -5,7 +5,8 @@ import sys
 import psycopg2
 import tqdm
 
-from faexport_db.db import Database, CustomJSONEncoder
+from faexport_db import serializer
+from faexport_db.db import Database
 from faexport_db.models.submission import Submission, SubmissionSnapshot
 from faexport_db.models.website import Website
 
@@ -18,7 +19,7 @@ def create_snapshot_dump(db: Database, filename: str) -> None:
         for website in websites:
             for snapshot in tqdm.tqdm(SubmissionSnapshot.list_all(db, website.website_id), total=cap):
                 # TODO: very slow, probably needs a submission_id index on files and keywords?
-                data = json.dumps(snapshot.to_web_json(), cls=CustomJSONEncoder) + "\n"
+                data = serializer.dumps(snapshot.to_web_json()) + "\n"
                 f.write(data)
                 row += 1
                 if row > cap:
@@ -34,7 +35,7 @@ def create_submission_dump(db: Database, filename: str) -> None:
         for website in websites:
             for site_sub_id in tqdm.tqdm(Submission.list_unique_site_ids(db, website.website_id), total=cap):
                 sub = Submission.from_database(db, website.website_id, site_sub_id)
-                data = json.dumps(sub.to_web_json(), cls=CustomJSONEncoder) + "\n"
+                data = serializer.dumps(sub.to_web_json()) + "\n"
                 f.write(data)
                 row += 1
                 if row > cap:
@@ -4,7 +4,7 @@ import sys
 import threading
 import time
 from contextlib import contextmanager
-from typing import List
+from typing import List, Tuple
 
 import psycopg2
 import tqdm
@@ -68,22 +68,10 @@ def delete_file_hashes(db: Database, hash_ids: List[int]) -> None:
     chunk_count = (len(hash_ids) // chunk_size) + 1
     for hash_ids_chunk in tqdm.tqdm(chunks(hash_ids, chunk_size), "Removing hashes", total=chunk_count):
         print(f"Removing {len(hash_ids_chunk)} hashes")
+        db.update("DELETE FROM submission_hash_lookup WHERE hash_id IN %s", (tuple(hash_ids_chunk),))
         db.update("DELETE FROM submission_snapshot_file_hashes WHERE hash_id IN %s", (tuple(hash_ids_chunk),))
 
 
-def delete_file_hashes_by_file(db: Database, file_ids: List[int]) -> None:
-    if DRY_RUN:
-        return
-    if not file_ids:
-        print("No file hashes to remove")
-        return
-    chunk_size = 1000
-    chunk_count = (len(file_ids) // chunk_size) + 1
-    for file_ids_chunk in tqdm.tqdm(chunks(file_ids, chunk_size), "Removing hashes", total=chunk_count):
-        print(f"Removing {len(file_ids_chunk)} hashes")
-        db.update("DELETE FROM submission_snapshot_file_hashes WHERE file_id IN %s", (tuple(file_ids_chunk),))
-
-
 def remove_orphaned_file_hashes(db: Database) -> int:
     print("Scanning for orphaned file hashes")
     orphaned_hashes = db.select_iter(
@@ -134,18 +122,37 @@ def delete_files(db: Database, file_ids: List[int]) -> None:
     chunk_count = (len(file_ids) // chunk_size) + 1
     for file_ids_chunk in tqdm.tqdm(chunks(file_ids, chunk_size), "Removing files", total=chunk_count):
         print(f"Removing {len(file_ids_chunk)} files")
+        db.update("DELETE FROM submission_hash_lookup WHERE file_id IN %s", (tuple(file_ids_chunk),))
         db.update("DELETE FROM submission_snapshot_file_hashes WHERE file_id IN %s", (tuple(file_ids_chunk),))
+        db.update("DELETE FROM submission_snapshot_file_links WHERE file_id IN %s", (tuple(file_ids_chunk),))
         db.update("DELETE FROM submission_snapshot_files WHERE file_id IN %s", (tuple(file_ids_chunk),))
 
 
+def delete_unlinked_files(db: Database, file_ids: List[int]) -> None:
+    # Files are shared between snapshots, so only files which no snapshot links to any more are removed
+    unlinked_ids = []
+    for file_ids_chunk in chunks(sorted(set(file_ids)), 1000):
+        file_rows = db.select(
+            "SELECT files.file_id "
+            "FROM submission_snapshot_files files "
+            "WHERE files.file_id IN %s "
+            "AND NOT EXISTS (SELECT 1 FROM submission_snapshot_file_links links WHERE links.file_id = files.file_id)",
+            (tuple(file_ids_chunk),)
+        )
+        unlinked_ids.extend([file_row[0] for file_row in file_rows])
+    delete_files(db, unlinked_ids)
+
+
 def remove_orphaned_files(db: Database) -> int:
     print("Scanning for orphaned files")
     orphaned_files = db.select_iter(
         "SELECT files.file_id "
         "FROM submission_snapshot_files files "
-        "LEFT JOIN submission_snapshots submissions "
-        "ON files.submission_snapshot_id = submissions.submission_snapshot_id "
-        "WHERE submissions.submission_snapshot_id IS NULL",
+        "WHERE NOT EXISTS ( "
+        "SELECT 1 FROM submission_snapshot_file_links links "
+        "JOIN submission_snapshots submissions ON links.submission_snapshot_id = submissions.submission_snapshot_id "
+        "WHERE links.file_id = files.file_id "
+        ")",
         tuple()
     )
     remove_ids = []
@@ -158,59 +165,89 @@ def remove_orphaned_files(db: Database) -> int:
     return len(remove_ids)
 
 
+def delete_file_links(db: Database, links: List[Tuple[int, int]]) -> None:
+    if DRY_RUN:
+        return
+    if not links:
+        print("No file links to remove")
+        return
+    chunk_size = 1000
+    chunk_count = (len(links) // chunk_size) + 1
+    for links_chunk in tqdm.tqdm(chunks(links, chunk_size), "Removing file links", total=chunk_count):
+        print(f"Removing {len(links_chunk)} file links")
+        db.update(
+            "DELETE FROM submission_hash_lookup WHERE (submission_snapshot_id, file_id) IN %s",
+            (tuple(links_chunk),)
+        )
+        db.update(
+            "DELETE FROM submission_snapshot_file_links WHERE (submission_snapshot_id, file_id) IN %s",
+            (tuple(links_chunk),)
+        )
+    delete_unlinked_files(db, [file_id for _, file_id in links])
+
+
 def remove_duplicate_files(db: Database) -> int:
     print("Scanning for duplicate files")
-    duplicate_files = db.select_iter(
-        "SELECT file_id FROM ( "
-        "SELECT file_id, row_number() over w as rnum "
-        "FROM submission_snapshot_files WINDOW w AS ( "
-        "PARTITION BY submission_snapshot_id, site_file_id ORDER BY file_id DESC "
+    duplicate_links = db.select_iter(
+        "SELECT submission_snapshot_id, file_id FROM ( "
+        "SELECT links.submission_snapshot_id, links.file_id, row_number() over w as rnum "
+        "FROM submission_snapshot_file_links links "
+        "JOIN submission_snapshot_files files ON links.file_id = files.file_id WINDOW w AS ( "
+        "PARTITION BY links.submission_snapshot_id, files.site_file_id ORDER BY links.file_id DESC "
         ")) t WHERE t.rnum > 1",
         tuple()
     )
-    remove_ids = []
+    remove_links = []
     with timer("Scanning for duplicate files"):
-        for file_row in duplicate_files:
-            file_id = file_row[0]
-            print(f"Removing duplicate file, ID: {file_id}")
-            remove_ids.append(file_id)
-    delete_files(db, remove_ids)
-    return len(remove_ids)
+        for snapshot_id, file_id in duplicate_links:
+            print(f"Removing duplicate file from submission snapshot, ID: {snapshot_id}, file ID: {file_id}")
+            remove_links.append((snapshot_id, file_id))
+    delete_file_links(db, remove_links)
+    return len(remove_links)
 
 
-def delete_keywords(db: Database, keyword_ids: List[int]) -> None:
+def delete_keyword_sets(db: Database, keyword_set_ids: List[int]) -> None:
     if DRY_RUN:
         return
-    if not keyword_ids:
-        print("No keywords to remove")
+    if not keyword_set_ids:
+        print("No keyword sets to remove")
         return
     chunk_size = 1000
-    chunk_count = (len(keyword_ids) // chunk_size) + 1
-    for keyword_ids_chunk in tqdm.tqdm(chunks(keyword_ids, chunk_size), "Removing keywords", total=chunk_count):
-        print(f"Removing {len(keyword_ids_chunk)} keywords")
+    chunk_count = (len(keyword_set_ids) // chunk_size) + 1
+    for set_ids_chunk in tqdm.tqdm(chunks(keyword_set_ids, chunk_size), "Removing keyword sets", total=chunk_count):
+        print(f"Removing {len(set_ids_chunk)} keyword sets")
         db.update(
-            "DELETE FROM submission_snapshot_keywords WHERE keyword_id IN %s",
-            (tuple(keyword_ids_chunk),)
+            "DELETE FROM submission_snapshot_keywords WHERE keyword_set_id IN %s",
+            (tuple(set_ids_chunk),)
+        )
+        db.update(
+            "DELETE FROM submission_keyword_sets WHERE keyword_set_id IN %s",
+            (tuple(set_ids_chunk),)
         )
 
 
 def remove_orphaned_keywords(db: Database) -> int:
-    print("Scanning for orphaned keywords")
-    orphaned_keywords = db.select_iter(
-        "SELECT keywords.keyword_id "
+    # Keyword sets are shared between snapshots, so are only orphaned once no snapshot references them
+    print("Scanning for orphaned keyword sets")
+    orphaned_sets = db.select_iter(
+        "SELECT sets.keyword_set_id "
+        "FROM submission_keyword_sets sets "
+        "WHERE NOT EXISTS ( "
+        "SELECT 1 FROM submission_snapshots submissions WHERE submissions.keyword_set_id = sets.keyword_set_id "
+        ") "
+        "UNION SELECT DISTINCT keywords.keyword_set_id "
         "FROM submission_snapshot_keywords keywords "
-        "LEFT JOIN submission_snapshots submissions "
-        "ON keywords.submission_snapshot_id = submissions.submission_snapshot_id "
-        "WHERE submissions.submission_snapshot_id IS NULL",
+        "LEFT JOIN submission_keyword_sets sets ON keywords.keyword_set_id = sets.keyword_set_id "
+        "WHERE sets.keyword_set_id IS NULL",
         tuple()
     )
     remove_ids = []
-    with timer("Scanning for orphaned keywords"):
-        for keyword_row in orphaned_keywords:
-            keyword_id = keyword_row[0]
-            print(f"Removed orphaned keyword, ID: {keyword_id}")
-            remove_ids.append(keyword_id)
-    delete_keywords(db, remove_ids)
+    with timer("Scanning for orphaned keyword sets"):
+        for set_row in orphaned_sets:
+            keyword_set_id = set_row[0]
+            print(f"Removed orphaned keyword set, ID: {keyword_set_id}")
+            remove_ids.append(keyword_set_id)
+    delete_keyword_sets(db, remove_ids)
     return len(remove_ids)
 
 
@@ -231,23 +268,23 @@ def delete_submissions(db: Database, submission_ids: List[int]) -> None:
         print(f"Removing {len(submission_ids_chunk)} submission snapshots")
 
         file_rows = db.select_iter(
-            "SELECT file_id FROM submission_snapshot_files WHERE submission_snapshot_id IN %s",
+            "SELECT file_id FROM submission_snapshot_file_links WHERE submission_snapshot_id IN %s",
             (tuple(submission_ids_chunk),)
         )
         file_ids.extend([file_row[0] for file_row in file_rows])
         db.update(
-            "DELETE FROM submission_snapshot_files WHERE submission_snapshot_id IN %s",
+            "DELETE FROM submission_hash_lookup WHERE submission_snapshot_id IN %s",
             (tuple(submission_ids_chunk),)
         )
         db.update(
-            "DELETE FROM submission_snapshot_keywords WHERE submission_snapshot_id IN %s",
+            "DELETE FROM submission_snapshot_file_links WHERE submission_snapshot_id IN %s",
             (tuple(submission_ids_chunk),)
         )
         db.update(
             "DELETE FROM submission_snapshots WHERE submission_snapshot_id IN %s",
             (tuple(submission_ids_chunk),)
         )
-    delete_file_hashes_by_file(db, file_ids)
+    delete_unlinked_files(db, file_ids)
 
 
 def remove_duplicate_submission_snapshots(db: Database) -> int:
@@ -307,6 +344,30 @@ def remove_duplicate_user_snapshots(db: Database) -> int:
     return len(remove_ids)
 
 
+def remove_orphaned_feed_entries(db: Database) -> int:
+    # Feed readers skip entries for removed snapshots, but the entries are cleared out too, once snapshots are removed
+    print("Scanning for orphaned change feed entries")
+    orphaned_entries = db.select_iter(
+        "SELECT feed.feed_id "
+        "FROM snapshot_feed feed "
+        "WHERE (feed.entity_type = 'submission' AND NOT EXISTS ( "
+        "SELECT 1 FROM submission_snapshots s WHERE s.submission_snapshot_id = feed.snapshot_id "
+        ")) OR (feed.entity_type = 'user' AND NOT EXISTS ( "
+        "SELECT 1 FROM user_snapshots u WHERE u.user_snapshot_id = feed.snapshot_id "
+        "))",
+        tuple()
+    )
+    remove_ids = []
+    with timer("Scanning for orphaned change feed entries"):
+        for feed_row in orphaned_entries:
+            remove_ids.append(feed_row[0])
+    if DRY_RUN or not remove_ids:
+        return len(remove_ids)
+    for feed_ids_chunk in chunks(remove_ids, 1000):
+        db.update("DELETE FROM snapshot_feed WHERE feed_id IN %s", (tuple(feed_ids_chunk),))
+    return len(remove_ids)
+
+
 if __name__ == "__main__":
     config_path = "./config.json"
     with open(config_path, "r") as conf_file:
@@ -317,12 +378,15 @@ if __name__ == "__main__":
     removed_users = remove_duplicate_user_snapshots(db_obj)
     removed_hashes = remove_orphaned_file_hashes(db_obj)
     removed_hashes += remove_duplicate_file_hashes(db_obj)
-    removed_files = remove_orphaned_files(db_obj)
-    removed_files += remove_duplicate_files(db_obj)
-    removed_keywords = remove_orphaned_keywords(db_obj)
+    removed_files = remove_duplicate_files(db_obj)
+    removed_files += remove_orphaned_files(db_obj)
     removed_submissions = remove_duplicate_submission_snapshots(db_obj)
+    # Keyword sets are removed once the snapshots referencing them are
+    removed_keywords = remove_orphaned_keywords(db_obj)
+    removed_feed_entries = remove_orphaned_feed_entries(db_obj)
     print(f"Removed users: {removed_users}")
     print(f"Removed hashes: {removed_hashes}")
-    print(f"Removed keywords: {removed_keywords}")
+    print(f"Removed keyword sets: {removed_keywords}")
     print(f"Removed files: {removed_files}")
     print(f"Removed submissions: {removed_submissions}")
+    print(f"Removed change feed entries: {removed_feed_entries}")
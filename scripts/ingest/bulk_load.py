@@ -0,0 +1,146 @@
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import List, Tuple, Optional, Iterator
+
+import psycopg2
+import tqdm
+
+from faexport_db.db import Database, API_APPLICATION_NAME
+
+BULK_LOAD_TABLES = (
+    "user_snapshots",
+    "submission_snapshots",
+    "submission_keyword_sets",
+    "submission_snapshot_keywords",
+    "submission_snapshot_files",
+    "submission_snapshot_file_links",
+    "submission_snapshot_file_hashes",
+    "submission_hash_lookup",
+    "snapshot_feed",
+)
+# Setting used to remember which indexes were dropped, so that they can be rebuilt after a crash
+PENDING_INDEXES_SETTING = "bulk_load_pending_indexes"
+# A load is only worth dropping indexes for if it is large, and large compared to what is already in the database
+BULK_LOAD_MIN_ROWS = 1_000_000
+BULK_LOAD_MIN_RATIO = 0.5
+
+
+class BulkLoadRefused(Exception):
+    pass
+
+
+class BulkLoader:
+    def __init__(
+            self,
+            db: Database,
+            dsn: Optional[str] = None,
+            *,
+            parallel: int = 4,
+            tables: Tuple[str, ...] = BULK_LOAD_TABLES,
+    ) -> None:
+        self.db = db
+        self.dsn = dsn
+        self.parallel = parallel if dsn is not None else 1
+        self.tables = tables
+
+    def api_connection_count(self) -> int:
+        count_rows = self.db.select(
+            "SELECT COUNT(*) FROM pg_stat_activity "
+            "WHERE datname = current_database() AND application_name = %s AND pid <> pg_backend_pid()",
+            (API_APPLICATION_NAME,)
+        )
+        return count_rows[0][0]
+
+    def estimated_existing_rows(self) -> int:
+        count_rows = self.db.select(
+            "SELECT COALESCE(SUM(GREATEST(reltuples, 0)), 0) FROM pg_class WHERE relname IN %s AND relkind = 'r'",
+            (("submission_snapshots", "user_snapshots"),)
+        )
+        return int(count_rows[0][0])
+
+    def is_large_load(self, row_count: Optional[int]) -> bool:
+        if row_count is None or row_count < BULK_LOAD_MIN_ROWS:
+            return False
+        return row_count >= self.estimated_existing_rows() * BULK_LOAD_MIN_RATIO
+
+    def check_api_idle(self) -> None:
+        api_connections = self.api_connection_count()
+        if api_connections:
+            raise BulkLoadRefused(
+                f"The API has {api_connections} open database connection(s). Dropping indexes would make its reads "
+                f"fall back to full table scans, so bulk load mode will not run while the API is live."
+            )
+
+    def list_secondary_indexes(self) -> List[Tuple[str, str]]:
+        # Primary keys and unique indexes are left in place, as they enforce constraints rather than speed up reads
+        index_rows = self.db.select(
+            "SELECT i.indexrelid::regclass::text, pg_get_indexdef(i.indexrelid) "
+            "FROM pg_index i "
+            "JOIN pg_class t ON t.oid = i.indrelid "
+            "WHERE t.relname IN %s AND NOT i.indisprimary AND NOT i.indisunique",
+            (self.tables,)
+        )
+        return [(index_name, index_def) for index_name, index_def in index_rows]
+
+    def pending_indexes(self) -> List[Tuple[str, str]]:
+        setting_rows = self.db.select(
+            "SELECT setting_value FROM settings WHERE setting_id = %s",
+            (PENDING_INDEXES_SETTING,)
+        )
+        if not setting_rows or not setting_rows[0][0]:
+            return []
+        return [(index_name, index_def) for index_name, index_def in json.loads(setting_rows[0][0])]
+
+    def _save_pending_indexes(self, indexes: List[Tuple[str, str]]) -> None:
+        if not indexes:
+            self.db.update("DELETE FROM settings WHERE setting_id = %s", (PENDING_INDEXES_SETTING,))
+            return
+        self.db.update(
+            "INSERT INTO settings (setting_id, setting_value) VALUES (%s, %s) "
+            "ON CONFLICT (setting_id) DO UPDATE SET setting_value = excluded.setting_value",
+            (PENDING_INDEXES_SETTING, json.dumps(indexes))
+        )
+
+    def drop_indexes(self) -> None:
+        self.check_api_idle()
+        pending = self.pending_indexes()
+        pending_names = {index_name for index_name, _ in pending}
+        to_drop = [index for index in self.list_secondary_indexes() if index[0] not in pending_names]
+        # Record the definitions before dropping anything, so a crash mid-load cannot lose them
+        self._save_pending_indexes(pending + to_drop)
+        for index_name, _ in tqdm.tqdm(to_drop, desc="Dropping indexes"):
+            self.db.update(f"DROP INDEX IF EXISTS {index_name}", tuple())
+
+    def _run_in_session(self, query: str) -> None:
+        if self.dsn is None:
+            self.db.update(query, tuple())
+            return
+        conn = psycopg2.connect(self.dsn)
+        try:
+            Database(conn).update(query, tuple())
+        finally:
+            conn.close()
+
+    def _run_parallel(self, queries: List[str], desc: str) -> None:
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            futures = [executor.submit(self._run_in_session, query) for query in queries]
+            for future in tqdm.tqdm(as_completed(futures), desc=desc, total=len(futures)):
+                future.result()
+
+    def rebuild_indexes(self) -> None:
+        pending = self.pending_indexes()
+        if pending:
+            create_queries = [
+                index_def.replace("CREATE INDEX ", "CREATE INDEX IF NOT EXISTS ", 1)
+                for _, index_def in pending
+            ]
+            self._run_parallel(create_queries, "Rebuilding indexes")
+            self._save_pending_indexes([])
+        self._run_parallel([f"ANALYZE {table}" for table in self.tables], "Analyzing tables")
+
+    @contextmanager
+    def deferred_indexes(self) -> Iterator[None]:
+        self.drop_indexes()
+        yield
+        self.rebuild_indexes()
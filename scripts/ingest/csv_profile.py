@@ -0,0 +1,241 @@
+import csv
+import dataclasses
+import datetime
+import json
+import os
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, List, Dict, Tuple, Union, Sequence, Callable
+
+import dateutil.parser
+import tqdm
+
+from scripts.ingest.csv_shards import iterate_rows_with_offsets, read_header, byte_ranges
+
+PROFILE_VERSION = 1
+CHECKPOINT_EVERY = 100_000
+
+
+@dataclasses.dataclass
+class ColumnStats:
+    non_null: int = 0
+    min_value: Optional[str] = None
+    max_value: Optional[str] = None
+    max_length: int = 0
+
+    def add(self, value: str) -> None:
+        self.non_null += 1
+        if self.min_value is None or value < self.min_value:
+            self.min_value = value
+        if self.max_value is None or value > self.max_value:
+            self.max_value = value
+        if len(value) > self.max_length:
+            self.max_length = len(value)
+
+    def merge(self, other: "ColumnStats") -> None:
+        self.non_null += other.non_null
+        if other.min_value is not None and (self.min_value is None or other.min_value < self.min_value):
+            self.min_value = other.min_value
+        if other.max_value is not None and (self.max_value is None or other.max_value > self.max_value):
+            self.max_value = other.max_value
+        self.max_length = max(self.max_length, other.max_length)
+
+    def to_json(self) -> Dict:
+        return dataclasses.asdict(self)
+
+    @classmethod
+    def from_json(cls, data: Dict) -> "ColumnStats":
+        return cls(**data)
+
+
+@dataclasses.dataclass
+class CsvProfile:
+    file_size: int
+    file_mtime_ns: int
+    header: Optional[List[str]]
+    row_count: int
+    columns: Dict[str, ColumnStats]
+    # (row number, byte offset) pairs, marking where data rows start, for resuming or splitting a read
+    checkpoints: List[Tuple[int, int]]
+
+    def is_current(self, file_path: Union[str, pathlib.Path]) -> bool:
+        stat = os.stat(file_path)
+        return stat.st_size == self.file_size and stat.st_mtime_ns == self.file_mtime_ns
+
+    def min_date(self, column: str) -> Optional[datetime.datetime]:
+        min_value = self.columns[column].min_value
+        if min_value is None:
+            return None
+        return dateutil.parser.parse(min_value)
+
+    def max_date(self, column: str) -> Optional[datetime.datetime]:
+        max_value = self.columns[column].max_value
+        if max_value is None:
+            return None
+        return dateutil.parser.parse(max_value)
+
+    def to_json(self) -> Dict:
+        return {
+            "profile_version": PROFILE_VERSION,
+            "file_size": self.file_size,
+            "file_mtime_ns": self.file_mtime_ns,
+            "header": self.header,
+            "row_count": self.row_count,
+            "columns": {name: stats.to_json() for name, stats in self.columns.items()},
+            "checkpoints": self.checkpoints,
+        }
+
+    @classmethod
+    def from_json(cls, data: Dict) -> Optional["CsvProfile"]:
+        if data.get("profile_version") != PROFILE_VERSION:
+            return None
+        return cls(
+            data["file_size"],
+            data["file_mtime_ns"],
+            data["header"],
+            data["row_count"],
+            {name: ColumnStats.from_json(stats) for name, stats in data["columns"].items()},
+            [(row_num, offset) for row_num, offset in data["checkpoints"]],
+        )
+
+
+def column_names(header: Optional[List[str]], width: int) -> List[str]:
+    """Names columns by header, falling back to column index for headerless files or extra columns"""
+    header = header or []
+    return header + [str(num) for num in range(len(header), width)]
+
+
+def _profile_range(
+        file_path: Union[str, pathlib.Path],
+        start: int,
+        end: int,
+        header: Optional[List[str]],
+        null_values: Sequence[str],
+        checkpoint_every: int,
+        field_size_limit: int,
+        progress: Optional[Callable[[int], None]] = None,
+) -> Tuple[int, Dict[str, ColumnStats], List[Tuple[int, int]]]:
+    """Profiles the CSV records starting within a byte range. Row numbers in checkpoints are relative to the range"""
+    csv.field_size_limit(field_size_limit)
+    columns: Dict[str, ColumnStats] = {}
+    checkpoints = []
+    null_set = set(null_values)
+    names = header
+    row_count = 0
+    last_offset = start
+    with open(file_path, "rb") as file:
+        for offset, row in iterate_rows_with_offsets(file, start):
+            if offset >= end:
+                break
+            if not row:
+                continue
+            if row_count % checkpoint_every == 0:
+                checkpoints.append((row_count, offset))
+                if progress is not None:
+                    progress(offset - last_offset)
+                last_offset = offset
+            if names is None or len(names) < len(row):
+                names = column_names(header, len(row))
+            for name, value in zip(names, row):
+                if value in null_set:
+                    continue
+                stats = columns.get(name)
+                if stats is None:
+                    stats = columns[name] = ColumnStats()
+                stats.add(value)
+            row_count += 1
+    if progress is not None:
+        progress(end - last_offset)
+    return row_count, columns, checkpoints
+
+
+def profile_csv(
+        file_path: Union[str, pathlib.Path],
+        *,
+        has_header: bool = True,
+        null_values: Sequence[str] = ("",),
+        checkpoint_every: int = CHECKPOINT_EVERY,
+        workers: int = 1,
+) -> CsvProfile:
+    stat = os.stat(file_path)
+    header, data_start = read_header(file_path) if has_header else (None, 0)
+    args = (header, tuple(null_values), checkpoint_every, csv.field_size_limit())
+    row_count = 0
+    columns: Dict[str, ColumnStats] = {}
+    checkpoints = []
+    with tqdm.tqdm(
+            desc="Profiling data", total=stat.st_size, initial=data_start, unit="B", unit_scale=True
+    ) as progress:
+        if workers <= 1:
+            results = [_profile_range(file_path, data_start, stat.st_size, *args, progress=progress.update)]
+        else:
+            ranges = byte_ranges(file_path, data_start)
+            with ProcessPoolExecutor(workers) as executor:
+                futures = [executor.submit(_profile_range, file_path, start, end, *args) for start, end in ranges]
+                results = []
+                for (start, end), future in zip(ranges, futures):
+                    results.append(future.result())
+                    progress.update(end - start)
+        for range_rows, range_columns, range_checkpoints in results:
+            checkpoints.extend((row_count + row_num, offset) for row_num, offset in range_checkpoints)
+            for name, stats in range_columns.items():
+                columns.setdefault(name, ColumnStats()).merge(stats)
+            row_count += range_rows
+    return CsvProfile(stat.st_size, stat.st_mtime_ns, header, row_count, columns, checkpoints)
+
+
+def _manifest_key(file_path: Union[str, pathlib.Path]) -> str:
+    return str(pathlib.Path(file_path).resolve())
+
+
+def _read_manifest(manifest_path: Union[str, pathlib.Path]) -> Dict:
+    try:
+        with open(manifest_path, "r") as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return {}
+
+
+def load_profile(
+        manifest_path: Union[str, pathlib.Path],
+        file_path: Union[str, pathlib.Path],
+) -> Optional[CsvProfile]:
+    profile_data = _read_manifest(manifest_path).get(_manifest_key(file_path))
+    if profile_data is None:
+        return None
+    profile = CsvProfile.from_json(profile_data)
+    if profile is None or not profile.is_current(file_path):
+        return None
+    return profile
+
+
+def save_profile(
+        manifest_path: Union[str, pathlib.Path],
+        file_path: Union[str, pathlib.Path],
+        profile: CsvProfile,
+) -> None:
+    manifest = _read_manifest(manifest_path)
+    manifest[_manifest_key(file_path)] = profile.to_json()
+    # Write to a temporary file first, so an interrupted write does not leave a corrupt manifest
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(tmp_path, manifest_path)
+
+
+def cached_profile(
+        manifest_path: Union[str, pathlib.Path],
+        file_path: Union[str, pathlib.Path],
+        *,
+        has_header: bool = True,
+        null_values: Sequence[str] = ("",),
+        refresh: bool = False,
+        workers: int = 1,
+) -> CsvProfile:
+    if not refresh:
+        profile = load_profile(manifest_path, file_path)
+        if profile is not None:
+            return profile
+    profile = profile_csv(file_path, has_header=has_header, null_values=null_values, workers=workers)
+    save_profile(manifest_path, file_path, profile)
+    return profile
@@ -0,0 +1,212 @@
+import csv
+import os
+import pathlib
+from typing import Optional, List, Iterator, Tuple, Union, BinaryIO, Any, Callable, Sequence
+
+from scripts.ingest.parallel import ordered_map
+
+# Each range is parsed in a worker process and sent back as one batch of rows
+DEFAULT_SHARD_SIZE = 16 * 1024 * 1024
+_SCAN_BLOCK_SIZE = 64 * 1024 * 1024
+_QUOTE = ord('"')
+
+CsvRow = Union[List[str], dict]
+
+
+class _LineCounter:
+    """Feeds a binary file to csv.reader line by line, keeping track of how many bytes have been consumed"""
+
+    def __init__(self, file: BinaryIO, position: int = 0) -> None:
+        self.file = file
+        self.position = position
+
+    def __iter__(self) -> Iterator[str]:
+        for line in self.file:
+            self.position += len(line)
+            yield line.decode("utf-8")
+
+
+def iterate_rows_with_offsets(file: BinaryIO, start: int = 0) -> Iterator[Tuple[int, List[str]]]:
+    """
+    Yields each CSV record in a file opened in binary mode, along with the byte offset the record starts at.
+    csv.reader only pulls as many lines as it needs to complete a record, so multi-line quoted fields are handled.
+    """
+    file.seek(start)
+    lines = _LineCounter(file, start)
+    reader = csv.reader(lines)
+    offset = start
+    for row in reader:
+        yield offset, row
+        offset = lines.position
+
+
+def read_header(file_path: Union[str, pathlib.Path]) -> Tuple[List[str], int]:
+    """Returns the header row of a CSV file, and the byte offset that the data rows start at"""
+    with open(file_path, "rb") as file:
+        rows = iterate_rows_with_offsets(file)
+        _, header = next(rows, (0, []))
+        data_start, _ = next(rows, (os.fstat(file.fileno()).st_size, None))
+    return header, data_start
+
+
+def row_to_dict(header: List[str], row: List[str]) -> dict:
+    """Matches csv.DictReader, which fills missing fields with None and puts extra fields in a list under None"""
+    row_dict = dict(zip(header, row))
+    if len(row) < len(header):
+        for name in header[len(row):]:
+            row_dict[name] = None
+    elif len(row) > len(header):
+        row_dict[None] = row[len(header):]
+    return row_dict
+
+
+def find_record_starts(
+        file_path: Union[str, pathlib.Path],
+        targets: Sequence[int],
+        *,
+        block_size: int = _SCAN_BLOCK_SIZE,
+) -> List[int]:
+    """
+    Finds the first record boundary at or after each target byte offset.
+    A newline only ends a record if an even number of quote characters come before it in the file, as quotes inside
+    quoted fields are escaped by doubling them. This keeps multi-line quoted fields within one range. It relies on
+    fields containing quotes being quoted, as postgres and the csv module write them.
+    """
+    starts = []
+    pending = sorted(targets)
+    quote_count = 0
+    block_start = 0
+    with open(file_path, "rb") as file:
+        while pending:
+            block = file.read(block_size)
+            if not block:
+                break
+            block_end = block_start + len(block)
+            # Quote count is tracked incrementally up to count_pos, through the block
+            count_pos, block_quotes = 0, 0
+            while pending and pending[0] < block_end:
+                newline = block.find(b"\n", max(pending[0] - block_start, count_pos))
+                while newline != -1:
+                    block_quotes += block.count(_QUOTE, count_pos, newline)
+                    count_pos = newline
+                    if (quote_count + block_quotes) % 2 == 0:
+                        break
+                    newline = block.find(b"\n", newline + 1)
+                if newline == -1:
+                    # Boundary is in a later block
+                    pending[0] = block_end
+                    break
+                record_start = block_start + newline + 1
+                while pending and pending[0] < record_start:
+                    pending.pop(0)
+                    starts.append(record_start)
+            quote_count += block.count(_QUOTE)
+            block_start = block_end
+    # Targets past the last record boundary start at the end of the file
+    starts.extend(block_start for _ in pending)
+    return starts
+
+
+def byte_ranges(
+        file_path: Union[str, pathlib.Path],
+        data_start: int,
+        *,
+        shard_size: int = DEFAULT_SHARD_SIZE,
+        checkpoints: Optional[List[Tuple[int, int]]] = None,
+) -> List[Tuple[int, int]]:
+    """Splits the data rows of a CSV file into byte ranges which each start at a record boundary"""
+    file_size = os.stat(file_path).st_size
+    if checkpoints:
+        # Known row offsets, from a profile of the file, so no need to scan for boundaries
+        offsets = [offset for _, offset in checkpoints if offset > data_start]
+        starts = [data_start]
+        for offset in offsets:
+            if offset - starts[-1] >= shard_size:
+                starts.append(offset)
+    else:
+        targets = list(range(data_start + shard_size, file_size, shard_size))
+        starts = [data_start] + find_record_starts(file_path, targets)
+    starts = sorted(set(start for start in starts if start < file_size))
+    return list(zip(starts, starts[1:] + [file_size]))
+
+
+def read_range(
+        file_path: Union[str, pathlib.Path],
+        start: int,
+        end: int,
+        header: Optional[List[str]] = None,
+        transform: Optional[Callable[[CsvRow], Any]] = None,
+        field_size_limit: Optional[int] = None,
+) -> List[Any]:
+    """Parses the CSV records which start within a byte range. Run in worker processes, so must be picklable"""
+    if field_size_limit is not None:
+        csv.field_size_limit(field_size_limit)
+    rows = []
+    with open(file_path, "rb") as file:
+        for offset, row in iterate_rows_with_offsets(file, start):
+            if offset >= end:
+                break
+            if not row:
+                continue  # Blank lines are skipped, as by csv.DictReader, and not counted as rows
+            if header is not None:
+                row = row_to_dict(header, row)
+            if transform is not None:
+                row = transform(row)
+            rows.append(row)
+    return rows
+
+
+class ShardedCsvReader:
+    """
+    Reads a large CSV file by splitting it into byte ranges, and parsing each range in a pool of worker processes.
+    Rows are yielded in file order, with their row numbers, and only a few ranges are parsed ahead of the consumer.
+    """
+
+    def __init__(
+            self,
+            file_path: Union[str, pathlib.Path],
+            *,
+            has_header: bool = True,
+            as_dicts: bool = False,
+            workers: Optional[int] = None,
+            shard_size: int = DEFAULT_SHARD_SIZE,
+            checkpoints: Optional[List[Tuple[int, int]]] = None,
+            transform: Optional[Callable[[CsvRow], Any]] = None,
+    ) -> None:
+        self.file_path = file_path
+        self.has_header = has_header
+        self.as_dicts = as_dicts
+        self.workers = workers or os.cpu_count() or 1
+        self.shard_size = shard_size
+        self.checkpoints = checkpoints
+        self.transform = transform
+
+    def _start_point(self, data_start: int, start_row: int) -> Tuple[int, int]:
+        # Resume from the last known row offset before the start row, rather than parsing from the start
+        if not self.checkpoints:
+            return 0, data_start
+        row_num, offset = 0, data_start
+        for checkpoint_row, checkpoint_offset in self.checkpoints:
+            if checkpoint_row > start_row:
+                break
+            row_num, offset = checkpoint_row, checkpoint_offset
+        return row_num, offset
+
+    def iterate_numbered_rows(self, start_row: int = 0) -> Iterator[Tuple[int, Any]]:
+        header, data_start = read_header(self.file_path) if self.has_header else (None, 0)
+        row_num, start_offset = self._start_point(data_start, start_row)
+        checkpoints = [(num, offset) for num, offset in (self.checkpoints or []) if offset >= start_offset]
+        ranges = byte_ranges(self.file_path, start_offset, shard_size=self.shard_size, checkpoints=checkpoints)
+        range_args = [
+            (self.file_path, start, end, header if self.as_dicts else None, self.transform, csv.field_size_limit())
+            for start, end in ranges
+        ]
+        for batch in ordered_map(read_range, range_args, self.workers):
+            for row in batch:
+                if row_num >= start_row:
+                    yield row_num, row
+                row_num += 1
+
+    def __iter__(self) -> Iterator[Any]:
+        for _, row in self.iterate_numbered_rows():
+            yield row
@@ -1,3 +1,4 @@
+import argparse
 import base64
 import datetime
 import json
@@ -5,7 +6,7 @@ import csv
 import sys
 from collections import Counter
 from pathlib import Path
-from typing import Optional, List, Iterator
+from typing import Optional, List, Iterator, Tuple, Dict
 
 import dateutil.parser
 import psycopg2
@@ -13,18 +14,24 @@ import tqdm
 
 from faexport_db.ingest_formats.base import FormatResponse
 from faexport_db.models.archive_contributor import ArchiveContributor
+from faexport_db.models.change_marker import SubmissionChangeMarker
 from faexport_db.models.file import HashAlgo, File, FileHash
 from faexport_db.models.submission import SubmissionSnapshot
+from faexport_db.models.user import UserSnapshot
 
 from faexport_db.db import Database, parse_datetime
 from faexport_db.models.website import Website
-from scripts.ingest.ingestion_job import IngestionJob, RowType, cache_in_file, csv_count_rows
+from scripts.ingest.ingestion_job import IngestionJob, RowType
 
 CSV_LOCATION = "./dump/e621_db_export/posts-2022-07-13.csv"
 WEBSITE = Website("e621", "e621", "https://e621.net")
 DATA_DATE = datetime.datetime(2022, 7, 13, 0, 0, 0, tzinfo=datetime.timezone.utc)
 CONTRIBUTOR = ArchiveContributor("e621 db_export")
-MD5_HASH = HashAlgo("any", "md5")
+MD5_HASH = HashAlgo("any", "md5", hash_length=16)
+# Number of rows to look up change markers for at once, in delta mode
+DELTA_BATCH_ROWS = 5000
+POST_ID_COLUMN = 0
+CHANGE_SEQ_COLUMN = 13
 
 
 class E621IngestJob(IngestionJob):
@@ -32,7 +39,12 @@ class E621IngestJob(IngestionJob):
     def __init__(self, *, skip_rows: int = 0):
         super().__init__(skip_rows=skip_rows)
         self.csv_location = CSV_LOCATION
-        self.row_count_file = Path(__file__).parent / "cache_row_count.txt"
+        self.profile_manifest = Path(__file__).parent / "cache_profile.json"
+        self.delta = False
+        self.db: Optional[Database] = None
+        self.unchanged_rows = 0
+        # change_seq of converted posts, recorded as change markers once their snapshots are saved
+        self.pending_change_seqs: Dict[str, int] = {}
 
         # Set up field size limit to be able to handle e621 data dumps
         max_int = sys.maxsize
@@ -43,8 +55,21 @@ class E621IngestJob(IngestionJob):
             except OverflowError:
                 max_int = int(max_int / 10)
 
+    def argument_parser(self) -> argparse.ArgumentParser:
+        parser = super().argument_parser()
+        parser.add_argument(
+            "--delta",
+            action="store_true",
+            help="Skip posts whose change_seq has not increased since they were last ingested"
+        )
+        return parser
+
+    def apply_arguments(self, args: argparse.Namespace) -> None:
+        super().apply_arguments(args)
+        self.delta = args.delta
+
     def row_count(self) -> Optional[int]:
-        return int(cache_in_file(self.row_count_file, lambda: str(csv_count_rows(self.csv_location))))
+        return self.source_profile().row_count
 
     def convert_row(self, row: RowType) -> FormatResponse:
         post_id, uploader_id, created_at, md5, source, rating, image_width, image_height, tag_string, locked_tags, fav_count, file_ext, parent_id, change_seq, approver_id, file_size, comment_count, description, duration, updated_at, is_deleted, is_pending, is_flagged, score, up_score, down_score, is_rating_locked, is_status_locked, is_note_locked = row
@@ -96,6 +121,54 @@ class E621IngestJob(IngestionJob):
         )
         return FormatResponse([snapshot])
 
+    def ingest_data(self, db: Database) -> None:
+        self.db = db
+        self.unchanged_rows = 0
+        super().ingest_data(db)
+        if self.delta:
+            print(f"Skipped {self.unchanged_rows} unchanged posts")
+
+    def iterate_numbered_results(self) -> Iterator[Tuple[int, FormatResponse]]:
+        batch = []
+        for row_num, row in self.iterate_numbered_rows():
+            batch.append((row_num, row))
+            if len(batch) >= DELTA_BATCH_ROWS:
+                yield from self._convert_changed_rows(batch)
+                batch = []
+        yield from self._convert_changed_rows(batch)
+
+    def _convert_changed_rows(self, rows: List[Tuple[int, List[str]]]) -> Iterator[Tuple[int, FormatResponse]]:
+        known_change_seqs = {}
+        if self.delta:
+            post_ids = [row[POST_ID_COLUMN] for _, row in rows]
+            known_change_seqs = SubmissionChangeMarker.change_seqs(self.db, WEBSITE.website_id, post_ids)
+        for row_num, row in rows:
+            post_id, change_seq = row[POST_ID_COLUMN], row[CHANGE_SEQ_COLUMN]
+            if change_seq:
+                change_seq = int(change_seq)
+                known_change_seq = known_change_seqs.get(post_id)
+                if known_change_seq is not None and known_change_seq >= change_seq:
+                    # Unchanged, so skip building snapshots, but still count the row for progress
+                    self.unchanged_rows += 1
+                    yield row_num, FormatResponse()
+                    continue
+                self.pending_change_seqs[post_id] = change_seq
+            yield row_num, self.convert_row(row)
+
+    def after_batch_saved(
+            self,
+            db: Database,
+            submission_snapshots: List[SubmissionSnapshot],
+            user_snapshots: List[UserSnapshot],
+    ) -> None:
+        # Markers are only written once snapshots are committed, so an interrupted ingest never skips a post next time
+        saved_change_seqs = {}
+        for snapshot in submission_snapshots:
+            change_seq = self.pending_change_seqs.pop(snapshot.site_submission_id, None)
+            if change_seq is not None:
+                saved_change_seqs[snapshot.site_submission_id] = change_seq
+        SubmissionChangeMarker.save_batch(db, WEBSITE.website_id, saved_change_seqs)
+
     def validate_row(self, row: List[str]) -> None:
         post_id, uploader_id, created_at, md5, source, rating, image_width, image_height, tag_string, locked_tags, fav_count, file_ext, parent_id, change_seq, approver_id, file_size, comment_count, description, duration, updated_at, is_deleted, is_pending, is_flagged, score, up_score, down_score, is_rating_locked, is_status_locked, is_note_locked = row
         assert created_at
@@ -123,11 +196,10 @@ class E621IngestJob(IngestionJob):
         assert is_note_locked in "tf"
 
     def iterate_rows(self) -> Iterator[RowType]:
-        with open(CSV_LOCATION, "r", encoding="utf-8") as file:
-            reader = csv.reader(file)
-            next(reader, None)  # skip headers
-            for row in reader:
-                yield row
+        return iter(self.csv_reader())
+
+    def iterate_numbered_rows(self) -> Iterator[Tuple[int, RowType]]:
+        return self.csv_reader().iterate_numbered_rows(self.skip_rows)
 
     def investigate_data(self) -> None:
         twitter_usernames = []
@@ -198,4 +270,4 @@ if __name__ == "__main__":
     MD5_HASH.save(db_obj)
 
     ingestion_job = E621IngestJob()
-    ingestion_job.process(db_obj)
+    ingestion_job.process(db_obj, dsn=db_dsn)
@@ -1,12 +1,10 @@
+import collections
 import glob
 import json
-import time
 import datetime
-import multiprocessing
-import multiprocessing.pool
+import traceback
 from multiprocessing import Queue, Process
-from queue import Empty
-from typing import Dict, Iterator, Optional
+from typing import Dict, Iterator, Optional, List, Set, Deque, Tuple
 
 import psycopg2
 import dateutil.parser
@@ -20,7 +18,8 @@ from faexport_db.models.file import File
 from faexport_db.models.submission import SubmissionSnapshot
 from faexport_db.models.user import UserSnapshot
 from faexport_db.models.website import Website
-from scripts.ingest.ingestion_job import IngestionJob, RowType
+from scripts.ingest.ingestion_job import IngestionJob
+from scripts.ingest.json_stream import iterate_object_items
 
 DATA_DIR = "./dump/fa-indexer/"
 SITE_ID = "fa"
@@ -28,133 +27,144 @@ WEBSITE = Website(SITE_ID, "Fur Affinity", "https://furaffinity.net")
 DATA_DATE = datetime.datetime(2019, 12, 4, 0, 0, 0, tzinfo=datetime.timezone.utc)
 CONTRIBUTOR = ArchiveContributor("fa-indexer data ingest")
 
+# Submissions are sent from worker processes in chunks, and each worker only sends a few chunks ahead of ingestion
+CHUNK_SIZE = 1000
+QUEUED_CHUNKS = 4
 DONE_SIGNAL = "DONE"
 
 
-class Processor:
-    def __init__(
-            self,
-            dsn: str,
-            queue: Queue,
-            resp_queue: Queue,
-            num: int,
-            site_id: str,
-            contributor: ArchiveContributor,
-            scan_date: datetime.datetime
-    ):
-        self.dsn = dsn
-        self.queue = queue
-        self.resp_queue = resp_queue
-        self.num = num
-        self.site_id = site_id
-        self.contributor = contributor
-        self.scan_date = scan_date
-        self.seen_usernames = set()
-
-    def process_entries(
-            self,
-    ) -> None:
-        conn = psycopg2.connect(self.dsn)
-        db = Database(conn)
-        while True:
-            try:
-                submission_data = self.queue.get(False)
-            except Empty:
-                time.sleep(0.1)
+class FileLoadError(Exception):
+    pass
+
+
+def clean_submission_data(submission_data: Dict) -> Dict:
+    if submission_data["id"] == 641877:
+        # This submission has null characters, due to a mis-formatted date
+        submission_data["description"] = submission_data["description"].replace("\0", "/0")
+    if "\0" in submission_data["description"]:
+        # 18570215 has nul characters due to utf-16 encoding issues
+        # 24491325, and 24661614 have nul characters for no clear reason
+        # Given they seem to just be a mistake, lets just clean them out from any submission
+        submission_data["description"] = submission_data["description"].replace("\0", "")
+    return submission_data
+
+
+def iterate_file_submissions(file_path: str) -> Iterator[Dict]:
+    # Dump files are large {id: submission} objects, so are parsed incrementally rather than loaded whole
+    with open(file_path, "r") as f:
+        for _, submission_data in iterate_object_items(f):
+            if submission_data is None:
                 continue
-            # print(f"Importing submission: {submission_data['id']} in worker {self.num}")
-            if submission_data == DONE_SIGNAL:
-                break
-            snapshot = self.import_submission_data(db, submission_data)
-            self.resp_queue.put(snapshot.site_submission_id)
-
-    def import_submission_data(
-            self,
-            db: Database,
-            submission_data: Dict,
-    ) -> SubmissionSnapshot:
-        if submission_data["id"] == 641877:
-            # This submission has null characters, due to a mis-formatted date
-            submission_data["description"] = submission_data["description"].replace("\0", "/0")
-        if "\0" in submission_data["description"]:
-            # 18570215 has nul characters due to utf-16 encoding issues
-            # 24491325, and 24661614 have nul characters for no clear reason
-            # Given they seem to just be a mistake, lets just clean them out from any submission
-            submission_data["description"] = submission_data["description"].replace("\0", "")
-        uploader_username = submission_data["username"]
+            yield clean_submission_data(submission_data)
+
+
+def load_file(file_path: str, queue: Queue) -> None:
+    """Runs in a worker process, sending the submissions in a file to the queue in chunks, then DONE_SIGNAL"""
+    try:
+        chunk = []
+        for submission_data in iterate_file_submissions(file_path):
+            chunk.append(submission_data)
+            if len(chunk) >= CHUNK_SIZE:
+                queue.put(chunk)
+                chunk = []
+        if chunk:
+            queue.put(chunk)
+    except Exception:
+        queue.put(FileLoadError(f"Failed to load {file_path}:\n{traceback.format_exc()}"))
+        return
+    queue.put(DONE_SIGNAL)
+
+
+class FAIndexerIngestionJob(IngestionJob):
+    def __init__(self, data_dir: str, *, skip_rows: int = 0) -> None:
+        super().__init__(skip_rows=skip_rows)
+        self.data_dir = data_dir
+        # Users are only snapshotted the first time they are seen, and all conversion happens in this process
+        self.seen_usernames: Set[str] = set()
+
+    def data_files(self) -> List[str]:
+        return sorted(glob.glob(self.data_dir + "/**/*.json", recursive=True))
+
+    def row_count(self) -> Optional[int]:
+        return None  # Counting submissions would mean parsing every file an extra time
+
+    def convert_row(self, row: Dict) -> FormatResponse:
+        uploader_username = row["username"]
+        user_snapshots = []
         if uploader_username not in self.seen_usernames:
             self.seen_usernames.add(uploader_username)
-            user_snapshot = UserSnapshot(
-                self.site_id,
+            user_snapshots.append(UserSnapshot(
+                SITE_ID,
                 uploader_username,
-                self.contributor,
-                self.scan_date
-            )
-            user_snapshot.save(db)
+                CONTRIBUTOR,
+                DATA_DATE
+            ))
         snapshot = SubmissionSnapshot(
-            self.site_id,
-            str(submission_data["id"]),
-            self.contributor,
-            self.scan_date,
+            SITE_ID,
+            str(row["id"]),
+            CONTRIBUTOR,
+            DATA_DATE,
             uploader_site_user_id=uploader_username,
-            title=submission_data["title"],
-            description=submission_data["description"],
-            datetime_posted=dateutil.parser.parse(submission_data["date"]),
-            extra_data={"rating": submission_data["rating"]},
-            ordered_keywords=submission_data["keywords"],
+            title=row["title"],
+            description=row["description"],
+            datetime_posted=dateutil.parser.parse(row["date"]),
+            extra_data={"rating": row["rating"]},
+            ordered_keywords=row["keywords"],
             files=[
                 File(
                     None,
-                    file_url=submission_data["filename"],
+                    file_url=row["filename"],
                 )
             ]
         )
-        snapshot.save(db)
-        return snapshot
-
-
-def scan_directory(dsn: str, dir_path: str) -> None:
-    num_processes = 10
-    queue = multiprocessing.Queue()
-    resp_queue = multiprocessing.Queue()
-    processors = [
-        Processor(dsn, queue, resp_queue, num, SITE_ID, CONTRIBUTOR, DATA_DATE) for num in range(num_processes)
-    ]
-    processes = [Process(target=processor.process_entries) for processor in processors]
-    for process in processes:
-        process.start()
-    todo_ids = set()
-
-    for file in tqdm.tqdm(glob.glob(dir_path + "/**/*.json", recursive=True)):
-        print(f"Opening file {file}")
-        with open(file, "r") as f:
-            data = json.load(f)
-        for submission in data.values():
-            if submission is None:
-                continue
-            todo_ids.add(str(submission["id"]))
-            queue.put(submission)
-        while len(todo_ids) > 0:
-            # print(f"{len(todo_ids)} submissions to do")
-            resp_id = resp_queue.get()
-            todo_ids.remove(resp_id)
-    for _ in range(num_processes + 1):
-        queue.put(DONE_SIGNAL)
-    for process in processes:
-        process.join()
-
-
-class FAIndexerIngestionJob(IngestionJob):
-    def __init__(self):
-
-    def row_count(self) -> Optional[int]:
-        pass
-
-    def convert_row(self, row: RowType) -> FormatResponse:
-        pass
-
-    def iterate_rows(self) -> Iterator[RowType]:
-        pass
+        return FormatResponse([snapshot], user_snapshots)
+
+    def validate_row(self, row: Dict) -> None:
+        assert row["id"]
+        assert row["username"]
+        assert dateutil.parser.parse(row["date"]) is not None
+        assert isinstance(row["keywords"], list)
+        assert "\0" not in row["description"]
+
+    def iterate_rows(self) -> Iterator[Dict]:
+        data_files = tqdm.tqdm(self.data_files(), desc="Reading files", position=1)
+        if self.read_workers <= 1:
+            for file_path in data_files:
+                yield from iterate_file_submissions(file_path)
+            return
+        yield from self._iterate_rows_in_workers(iter(data_files))
+
+    def _iterate_rows_in_workers(self, data_files: Iterator[str]) -> Iterator[Dict]:
+        # Each file is loaded by its own worker process, and files are consumed in order
+        in_flight: Deque[Tuple[Process, Queue]] = collections.deque()
+
+        def start_next_file() -> None:
+            file_path = next(data_files, None)
+            if file_path is None:
+                return
+            queue = Queue(maxsize=QUEUED_CHUNKS)
+            process = Process(target=load_file, args=(file_path, queue), daemon=True)
+            process.start()
+            in_flight.append((process, queue))
+
+        for _ in range(self.read_workers):
+            start_next_file()
+        try:
+            while in_flight:
+                process, queue = in_flight[0]
+                while True:
+                    chunk = queue.get()
+                    if isinstance(chunk, FileLoadError):
+                        raise chunk
+                    if chunk == DONE_SIGNAL:
+                        break
+                    yield from chunk
+                process.join()
+                in_flight.popleft()
+                start_next_file()
+        finally:
+            for process, _ in in_flight:
+                process.terminate()
 
 
 if __name__ == "__main__":
@@ -168,5 +178,4 @@ if __name__ == "__main__":
     CONTRIBUTOR.save(db_obj)
 
     ingestion_job = FAIndexerIngestionJob(DATA_DIR)
-    ingestion_job.process(db_obj)
-    scan_directory(db_dsn, DATA_DIR)
+    ingestion_job.process(db_obj, dsn=db_dsn)
@@ -1,7 +1,7 @@
 import datetime
 import json
 import sqlite3
-from typing import Iterator, Optional
+from typing import Iterator, Optional, List, Tuple, Union, Dict
 
 import psycopg2
 
@@ -13,61 +13,115 @@ from faexport_db.models.file import FileHash, HashAlgo, File
 from faexport_db.models.submission import SubmissionSnapshot
 from faexport_db.models.website import Website
 from scripts.ingest.ingestion_job import IngestionJob
+from scripts.ingest.parallel import ordered_map
 
 DB_LOCATION = "./dump/findfurrypicbot/fa_bin/fa_bin.sqlite3"
 SITE_ID = "fa"
 WEBSITE = Website(SITE_ID, "Fur Affinity", "https://furaffinity.net")
 DATA_DATE = datetime.datetime(2020, 1, 9, 0, 0, 0, tzinfo=datetime.timezone.utc)
 CONTRIBUTOR = ArchiveContributor("FindFurryPicBot data ingest")
-AHASH = HashAlgo("python", "ahash")
-DHASH = HashAlgo("python", "dhash")
-PHASH = HashAlgo("python", "phash")
-WHASH = HashAlgo("python", "whash")
+AHASH = HashAlgo("python", "ahash", hash_length=8)
+DHASH = HashAlgo("python", "dhash", hash_length=8)
+PHASH = HashAlgo("python", "phash", hash_length=8)
+WHASH = HashAlgo("python", "whash", hash_length=8)
+
+
+# Rows are read in ranges of rowid, each range read and converted by one worker process
+SHARD_ROWS = 50_000
+MMAP_SIZE = 1024 * 1024 * 1024
+
+
+def open_read_only(db_path: str, *, mmap_size: int = 0) -> sqlite3.Connection:
+    sqlite_db = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    sqlite_db.row_factory = sqlite3.Row
+    if mmap_size:
+        sqlite_db.execute(f"PRAGMA mmap_size = {int(mmap_size)}")
+    return sqlite_db
+
+
+def convert_post(row: Union[sqlite3.Row, Dict]) -> FormatResponse:
+    snapshot = SubmissionSnapshot(
+        SITE_ID,
+        str(row["id"]),
+        CONTRIBUTOR,
+        DATA_DATE,
+        files=[
+            File(
+                None,
+                hashes=[
+                    FileHash(AHASH.algo_id, row["a_hash"]),
+                    FileHash(DHASH.algo_id, row["d_hash"]),
+                    FileHash(PHASH.algo_id, row["p_hash"]),
+                    FileHash(WHASH.algo_id, row["w_hash"]),
+                ]
+            )
+        ]
+    )
+    return FormatResponse(
+        [snapshot]
+    )
+
+
+# noinspection SqlResolve
+def read_shard(
+        db_path: str,
+        start_rowid: int,
+        end_rowid: int,
+        mmap_size: int,
+        convert: bool,
+) -> List[Tuple[int, Union[Dict, FormatResponse]]]:
+    """Reads the posts in a rowid range, in a worker process, converting them if requested"""
+    sqlite_db = open_read_only(db_path, mmap_size=mmap_size)
+    try:
+        cur = sqlite_db.execute(
+            "SELECT rowid, id, a_hash, p_hash, d_hash, w_hash FROM posts WHERE rowid >= ? AND rowid < ? ORDER BY rowid",
+            (start_rowid, end_rowid)
+        )
+        # sqlite3.Row cannot be pickled, so unconverted rows are sent back as dicts
+        return [(row["rowid"], convert_post(row) if convert else dict(row)) for row in cur]
+    finally:
+        sqlite_db.close()
 
 
 # noinspection SqlResolve
 class FindFurryPicBotIngestion(IngestionJob):
 
-    def __init__(self, sqlite_db: sqlite3.Connection, *, skip_rows: int = 0) -> None:
+    def __init__(self, db_path: str, *, skip_rows: int = 0, mmap_size: int = MMAP_SIZE) -> None:
         super().__init__(skip_rows=skip_rows)
-        self.sqlite_db = sqlite_db
+        self.db_path = db_path
+        self.mmap_size = mmap_size
+        self.sqlite_db = open_read_only(db_path, mmap_size=mmap_size)
+
+    def max_rowid(self) -> int:
+        return self.sqlite_db.execute("SELECT MAX(rowid) FROM posts").fetchone()[0] or 0
 
     def row_count(self) -> Optional[int]:
-        cur = self.sqlite_db.cursor()
-        result = cur.execute("SELECT COUNT(1) as count FROM posts")
-        row_count = next(result)["count"]
-        cur.close()
-        return row_count
-
-    def convert_row(self, row: sqlite3.Row) -> FormatResponse:
-        snapshot = SubmissionSnapshot(
-            SITE_ID,
-            str(row["id"]),
-            CONTRIBUTOR,
-            DATA_DATE,
-            files=[
-                File(
-                    None,
-                    hashes=[
-                        FileHash(AHASH.algo_id, row["a_hash"]),
-                        FileHash(DHASH.algo_id, row["d_hash"]),
-                        FileHash(PHASH.algo_id, row["p_hash"]),
-                        FileHash(WHASH.algo_id, row["w_hash"]),
-                    ]
-                )
-            ]
-        )
-        return FormatResponse(
-            [snapshot]
-        )
+        # MAX(rowid) is read from the end of the table's b-tree, where COUNT(1) scans the whole table.
+        # Rows may have been deleted, so this is an upper bound, which is good enough for progress and bulk loading
+        return self.max_rowid()
+
+    def convert_row(self, row: Dict) -> FormatResponse:
+        return convert_post(row)
+
+    def _shard_args(self, convert: bool) -> Iterator[Tuple]:
+        # Row numbers are rowid - 1, so skip_rows can skip straight to the right range
+        for start_rowid in range(self.skip_rows + 1, self.max_rowid() + 1, SHARD_ROWS):
+            yield self.db_path, start_rowid, start_rowid + SHARD_ROWS, self.mmap_size, convert
 
-    def iterate_rows(self) -> Iterator[sqlite3.Row]:
-        cur = self.sqlite_db.cursor()
-        result = cur.execute("SELECT id, a_hash, p_hash, d_hash, w_hash FROM posts")
-        for row in result:
+    def _iterate_shards(self, convert: bool) -> Iterator[Tuple[int, Union[Dict, FormatResponse]]]:
+        for shard in ordered_map(read_shard, self._shard_args(convert), self.read_workers):
+            for rowid, item in shard:
+                yield rowid - 1, item
+
+    def iterate_numbered_rows(self) -> Iterator[Tuple[int, Dict]]:
+        return self._iterate_shards(False)
+
+    def iterate_numbered_results(self) -> Iterator[Tuple[int, FormatResponse]]:
+        return self._iterate_shards(True)
+
+    def iterate_rows(self) -> Iterator[Dict]:
+        for _, row in self.iterate_numbered_rows():
             yield row
-        self.sqlite_db.commit()
-        cur.close()
 
 
 if __name__ == "__main__":
@@ -84,8 +138,5 @@ if __name__ == "__main__":
     PHASH.save(db_obj)
     WHASH.save(db_obj)
 
-    sqlite_conn = sqlite3.connect(DB_LOCATION)
-    sqlite_conn.row_factory = sqlite3.Row
-
-    ingestor = FindFurryPicBotIngestion(sqlite_conn)
-    ingestor.process(db_obj)
+    ingestor = FindFurryPicBotIngestion(DB_LOCATION)
+    ingestor.process(db_obj, dsn=db_dsn)
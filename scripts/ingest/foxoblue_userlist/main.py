@@ -1,12 +1,10 @@
 import datetime
 import json
-import csv
 from pathlib import Path
-from typing import Optional, Iterator
+from typing import Optional, Iterator, Tuple
 
 import dateutil.parser
 import psycopg2
-import tqdm
 
 from faexport_db.ingest_formats.base import FormatResponse
 from faexport_db.models.archive_contributor import ArchiveContributor
@@ -14,7 +12,7 @@ from faexport_db.models.user import UserSnapshot
 
 from faexport_db.db import Database
 from faexport_db.models.website import Website
-from scripts.ingest.ingestion_job import IngestionJob, RowType, cache_in_file, csv_count_rows
+from scripts.ingest.ingestion_job import IngestionJob, RowType
 
 CSV_LOCATION = "./dump/foxoblue_userlist/data-1642685938898.csv"
 SITE_ID = "fa"
@@ -24,32 +22,23 @@ CONTRIBUTOR = ArchiveContributor("Foxo//Blue FA user list export")
 
 
 class FoxoBlueUserListIngestionJob(IngestionJob):
+    PROFILE_NULL_VALUES = ("", "NULL")
 
     def __init__(self):
         super().__init__()
         self.csv_location = CSV_LOCATION
-        self.row_count_file = Path(__file__).parent / "cache_row_count.txt"
-        self.earliest_date_file = Path(__file__).parent / "cache_earliest_date.txt"
-
-    def _earliest_date_in_csv(self) -> datetime.datetime:
-        earliest = "zzz"
-        with open(self.csv_location, "r", encoding="utf-8") as file:
-            reader = csv.reader(file)
-            for line in tqdm.tqdm(reader, desc="Finding earliest date", total=self.row_count()):
-                if line[1]:
-                    earliest = min(earliest, line[1])
-        return dateutil.parser.parse(earliest)
+        self.profile_manifest = Path(__file__).parent / "cache_profile.json"
+        self._earliest_date = None
 
     def row_count(self) -> Optional[int]:
-        return int(cache_in_file(self.row_count_file, lambda: str(csv_count_rows(self.csv_location))))
+        return self.source_profile().row_count
 
     def earliest_date(self) -> datetime.datetime:
-        return dateutil.parser.parse(
-            cache_in_file(
-                self.earliest_date_file,
-                lambda: self._earliest_date_in_csv().isoformat()
-            )
-        )
+        if self._earliest_date is None:
+            profile = self.source_profile()
+            # Second column is the date each user was checked
+            self._earliest_date = profile.min_date(profile.header[1])
+        return self._earliest_date
 
     def convert_row(self, row: RowType) -> FormatResponse:
         username, updated_at, error = row.values()
@@ -75,10 +64,10 @@ class FoxoBlueUserListIngestionJob(IngestionJob):
         return FormatResponse(user_snapshots=[snapshot])
 
     def iterate_rows(self) -> Iterator[RowType]:
-        with open(self.csv_location, "r", encoding="utf-8") as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                yield row
+        return iter(self.csv_reader(as_dicts=True))
+
+    def iterate_numbered_rows(self) -> Iterator[Tuple[int, RowType]]:
+        return self.csv_reader(as_dicts=True).iterate_numbered_rows(self.skip_rows)
 
 
 if __name__ == "__main__":
@@ -92,4 +81,4 @@ if __name__ == "__main__":
     CONTRIBUTOR.save(db_obj)
 
     ingestion_job = FoxoBlueUserListIngestionJob()
-    ingestion_job.process(db_obj)
+    ingestion_job.process(db_obj, dsn=db_dsn)
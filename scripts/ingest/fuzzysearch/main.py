@@ -7,7 +7,7 @@ import string
 import struct
 from collections import Counter
 from pathlib import Path
-from typing import Dict, Optional, Iterator
+from typing import Dict, Optional, Iterator, Tuple, List
 
 import dateutil.parser
 import psycopg2
@@ -20,14 +20,15 @@ import tqdm
 from faexport_db.models.file import FileHash, HashAlgo, File
 from faexport_db.models.submission import SubmissionSnapshot
 from faexport_db.models.website import Website
-from scripts.ingest.fuzzysearch.user_lookup import WeasylLookup, UserLookup, FALookup, WEASYL_ID, FA_ID
-from scripts.ingest.ingestion_job import IngestionJob, RowType, cache_in_file, csv_count_rows
+from scripts.ingest.fuzzysearch.user_lookup import WeasylLookup, UserLookup, FALookup, WEASYL_ID, FA_ID, WEASYL_API
+from scripts.ingest.fuzzysearch.user_resolver import UserResolver
+from scripts.ingest.ingestion_job import IngestionJob, RowType
 
 FUZZYSEARCH_FILE = "./dump/fuzzysearch/fuzzysearch-dump-20220620.csv"
 DATA_DATE = datetime.datetime(2022, 6, 22, 0, 0, 0, 0, datetime.timezone.utc)
 CONTRIBUTOR = ArchiveContributor("FuzzySearch data ingest")
-SHA_HASH = HashAlgo("any", "sha256")
-DHASH = HashAlgo("rust", "dhash")
+SHA_HASH = HashAlgo("any", "sha256", hash_length=32)
+DHASH = HashAlgo("rust", "dhash", hash_length=8)
 
 
 @dataclasses.dataclass
@@ -35,6 +36,8 @@ class SiteConfig:
     website: Website
     ingest_artist: bool
     user_lookup: UserLookup = None
+    # Whether to resolve all artists up front, in a pool of threads. Worthwhile for lookups which call an API
+    prefetch_users: bool = False
 
 
 fa_allowed_chars = set(string.ascii_letters + string.digits + "-_.~[]^`")
@@ -47,32 +50,21 @@ class FuzzysearchIngestionJob(IngestionJob):
         super().__init__(skip_rows=skip_rows)
         self.site_configs = site_configs
         self.csv_location = FUZZYSEARCH_FILE
-        self.row_count_file = Path(__file__).parent / "cache_row_count.txt"
-        self.earliest_date_file = Path(__file__).parent / "cache_earliest_date.txt"
+        self.profile_manifest = Path(__file__).parent / "cache_profile.json"
         self._earliest_date = None
-        self._earliest_date = self.earliest_date()
+        self.resolvers = {
+            site: UserResolver(site_config.user_lookup)
+            for site, site_config in site_configs.items()
+            if site_config.ingest_artist and site_config.user_lookup is not None and site_config.prefetch_users
+        }
 
     def row_count(self) -> Optional[int]:
-        return int(cache_in_file(self.row_count_file, lambda: str(csv_count_rows(self.csv_location))))
-
-    def _csv_earliest_date(self) -> datetime.datetime:
-        earliest = "zzz"
-        with open(self.csv_location, "r", encoding="utf-8") as file:
-            reader = csv.reader(file)
-            for line in tqdm.tqdm(reader, desc="Finding earliest date", total=self.row_count()):
-                if line[5]:
-                    earliest = min(earliest, line[5])
-        return dateutil.parser.parse(earliest)
+        return self.source_profile().row_count
 
     def earliest_date(self) -> datetime.datetime:
-        if self._earliest_date is not None:
-            return self._earliest_date
-        earliest_date = dateutil.parser.parse(cache_in_file(
-            self.earliest_date_file,
-            lambda: self._csv_earliest_date().isoformat()
-        ))
-        self._earliest_date = earliest_date
-        return earliest_date
+        if self._earliest_date is None:
+            self._earliest_date = self.source_profile().min_date("updated_at")
+        return self._earliest_date
 
     def convert_row(self, row: Dict[str, str]) -> FormatResponse:
         site, submission_id, artists, hash_value, posted_at, updated_at, sha256, deleted, content_url = row.values()
@@ -86,7 +78,14 @@ class FuzzysearchIngestionJob(IngestionJob):
 
         uploader_username = None
         user_snapshots = []
-        if site_config.ingest_artist and site_config.user_lookup is not None:
+        if site in self.resolvers:
+            uploader_username, user_snapshots = self.resolvers[site].resolve(
+                artists,
+                submission_id,
+                CONTRIBUTOR,
+                scan_date
+            )
+        elif site_config.ingest_artist and site_config.user_lookup is not None:
             uploader_username, user_snapshots = site_config.user_lookup.lookup_user(
                 artists,
                 submission_id,
@@ -155,15 +154,11 @@ class FuzzysearchIngestionJob(IngestionJob):
         odd_weasyl_usernames = set()
         row_count = self.row_count()
         print(f"CSV has {row_count} rows")
-        earliest_date = "zzz"
         site_list = []
         with open(FUZZYSEARCH_FILE, 'r', encoding='utf-8') as file:
             reader = csv.DictReader(file)
             for row in tqdm.tqdm(reader, total=row_count):
                 drow = dict(row)
-                if drow["updated_at"]:
-                    updated_at = drow["updated_at"]
-                    earliest_date = min(earliest_date, updated_at)
                 site = drow["site"]
                 site_list.append(site)
                 if site == "e621":
@@ -177,7 +172,7 @@ class FuzzysearchIngestionJob(IngestionJob):
                 if site == "furaffinity":
                     if not set(username.lower()).issubset(fa_allowed_chars):
                         print(f"Found an odd FA username character: {username}")
-        print(f"Earliest date: {dateutil.parser.parse(earliest_date)}")
+        print(f"Earliest date: {self.earliest_date()}")
         site_counter = Counter(site_list)
         sites = set(site_counter.keys())
         print(f"Site list: {sites}")
@@ -185,11 +180,45 @@ class FuzzysearchIngestionJob(IngestionJob):
         print(f"There's a total of {len(weasyl_usernames)} unique weasyl usernames")
         print(f"Confusing weasyl display names: {odd_weasyl_usernames}")
 
+    def _user_lookup_requests(self, site: str) -> Iterator[Tuple[str, str, ArchiveContributor, datetime.datetime]]:
+        progress = tqdm.tqdm(self.iterate_numbered_rows(), desc="Queueing user lookups", total=self.row_count())
+        for row_num, row in progress:
+            if row_num < self.skip_rows:
+                continue
+            row_site, submission_id, artists, hash_value, posted_at, updated_at, *_ = row.values()
+            if row_site != site or hash_value == "":
+                continue
+            scan_date = self.earliest_date()
+            if updated_at:
+                scan_date = dateutil.parser.parse(updated_at)
+            yield artists, submission_id, CONTRIBUTOR, scan_date
+
+    def prefetch_users(self) -> None:
+        for site, resolver in self.resolvers.items():
+            queued = resolver.prefetch(self._user_lookup_requests(site))
+            print(f"Queued {queued} user lookups for {site}")
+
+    def user_lookups(self) -> List[UserLookup]:
+        return [site_config.user_lookup for site_config in self.site_configs.values() if site_config.user_lookup]
+
+    def ingest_data(self, db: Database) -> None:
+        for lookup in self.user_lookups():
+            # Display name lookups would scan every user snapshot without their indexes
+            lookup.use_database = lookup.use_database and not self.indexes_deferred
+        try:
+            self.prefetch_users()
+            super().ingest_data(db)
+        finally:
+            for resolver in self.resolvers.values():
+                resolver.shutdown()
+            for lookup in self.user_lookups():
+                lookup.close()
+
     def iterate_rows(self) -> Iterator[Dict]:
-        with open(FUZZYSEARCH_FILE, "r", encoding="utf-8") as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                yield dict(row)
+        return iter(self.csv_reader(as_dicts=True))
+
+    def iterate_numbered_rows(self) -> Iterator[Tuple[int, Dict]]:
+        return self.csv_reader(as_dicts=True).iterate_numbered_rows(self.skip_rows)
 
 
 if __name__ == "__main__":
@@ -205,7 +234,7 @@ if __name__ == "__main__":
         "furaffinity": SiteConfig(
             Website(FA_ID, "Fur Affinity", "https://furaffinity.net"),
             True,
-            FALookup(db_obj)
+            FALookup(db_dsn)
         ),
         "e621": SiteConfig(
             Website("e621", "e621", "https://e621.net"),
@@ -214,7 +243,13 @@ if __name__ == "__main__":
         "weasyl": SiteConfig(
             Website(WEASYL_ID, "Weasyl", "https://weasyl.com"),
             True,
-            WeasylLookup(db_obj, config.get("weasyl_api_key"))
+            WeasylLookup(
+                db_dsn,
+                config.get("weasyl_api_key"),
+                api_base=config.get("weasyl_api_base", WEASYL_API),
+                requests_per_second=config.get("weasyl_requests_per_second", 1),
+            ),
+            prefetch_users=True,
         )
     }
     # Create websites from SITE_MAP
@@ -226,4 +261,4 @@ if __name__ == "__main__":
     DHASH.save(db_obj)
     # Import data
     ingestion_job = FuzzysearchIngestionJob(site_confs)
-    ingestion_job.process(db_obj)
+    ingestion_job.process(db_obj, dsn=db_dsn)
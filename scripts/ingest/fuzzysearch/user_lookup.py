@@ -1,21 +1,47 @@
 import dataclasses
 import datetime
 import json
+import sqlite3
 import string
 import time
 from abc import ABC, abstractmethod
-from threading import Lock
+from threading import Lock, local
 from typing import Dict, List, Optional, Tuple
 
 import dateutil.parser
+import psycopg2
 import requests
 
-from faexport_db.db import CustomJSONEncoder, Database
+from faexport_db.db import Database
 from faexport_db.models.archive_contributor import ArchiveContributor
-from faexport_db.models.user import UserSnapshot
+from faexport_db.models.user import UserSnapshot, DisplayNameMatch
 
 WEASYL_ID = "weasyl"
 FA_ID = "fa"
+WEASYL_API = "https://weasyl.com/api"
+
+
+class TokenBucket:
+    """Thread safe rate limiter, allowing bursts of up to `capacity` calls, refilled at `rate` calls per second"""
+
+    def __init__(self, rate: float, capacity: float = 1) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
 
 
 @dataclasses.dataclass
@@ -34,37 +60,105 @@ class CacheEntry:
         )
 
 
-class UserLookup(ABC):
-    FILENAME: str = None
+class LookupCache:
+    """
+    Display name to username cache, stored in SQLite so that each new entry is a single committed insert, and entries
+    are only read when they are looked up. Caches from the older JSON file format are imported on first use.
+    """
 
-    def __init__(self, site_id: str, db: Database):
-        self.cache: Dict[str, CacheEntry] = self.load_cache()
-        self.site_id = site_id
-        self.db = db
-        self.save_calls = 0
+    def __init__(self, file_path: str, legacy_json_path: Optional[str] = None) -> None:
+        self.file_path = file_path
+        # Entries read or written this run, so repeated lookups of common names do not query SQLite
+        self._memo: Dict[str, CacheEntry] = {}
+        self._lock = Lock()
+        self.conn = sqlite3.connect(file_path, check_same_thread=False)
+        # Write ahead logging keeps each commit cheap, and the cache intact if the ingest is killed
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS users (display_name TEXT PRIMARY KEY, username TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS imports (file_path TEXT PRIMARY KEY)")
+        self.conn.commit()
+        if legacy_json_path is not None:
+            self._import_legacy_json(legacy_json_path)
 
-    def save_cache(self) -> None:
-        self.save_calls += 1
-        if self.save_calls < 50:
+    def _import_legacy_json(self, json_path: str) -> None:
+        if self.conn.execute("SELECT 1 FROM imports WHERE file_path = ?", (json_path,)).fetchone():
             return
-        self.save_calls = 0
-        data = {
-            key: entry.to_json() for key, entry in self.cache.items()
-        }
-        with open(self.FILENAME, "w") as f:
-            json.dump(data, f, cls=CustomJSONEncoder)
-
-    @classmethod
-    def load_cache(cls) -> Dict[str, CacheEntry]:
         try:
-            with open(cls.FILENAME, "r") as f:
+            with open(json_path, "r") as f:
                 data = json.load(f)
         except FileNotFoundError:
-            return {}
-        cache = {
-            key: CacheEntry.from_json(cache_data) for key, cache_data in data.items()
-        }
-        return cache
+            return
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO users (display_name, username) VALUES (?, ?)",
+                [(display_name, CacheEntry.from_json(entry).username) for display_name, entry in data.items()]
+            )
+            self.conn.execute("INSERT INTO imports (file_path) VALUES (?)", (json_path,))
+        print(f"Imported {len(data)} cached users from {json_path}")
+
+    def get(self, display_name: str) -> Optional[CacheEntry]:
+        entry = self._memo.get(display_name)
+        if entry is not None:
+            return entry
+        with self._lock:
+            row = self.conn.execute("SELECT username FROM users WHERE display_name = ?", (display_name,)).fetchone()
+        if row is None:
+            return None
+        entry = CacheEntry(row[0])
+        self._memo[display_name] = entry
+        return entry
+
+    def __contains__(self, display_name: str) -> bool:
+        return self.get(display_name) is not None
+
+    def set_many(self, display_names: List[str], entry: CacheEntry) -> None:
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO users (display_name, username) VALUES (?, ?)",
+                [(display_name, entry.username) for display_name in display_names]
+            )
+        for display_name in display_names:
+            self._memo[display_name] = entry
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+class UserLookup(ABC):
+    FILENAME: str = None
+    LEGACY_JSON_FILENAME: Optional[str] = None
+
+    def __init__(self, site_id: str, dsn: Optional[str]):
+        self.cache = LookupCache(self.FILENAME, self.LEGACY_JSON_FILENAME)
+        self.site_id = site_id
+        self.dsn = dsn
+        # Whether to check stored user snapshots. Turned off while a bulk load has the display name indexes dropped
+        self.use_database = dsn is not None
+        # Lookups run on resolver threads alongside the ingest's saves, so each thread has its own connection
+        self._thread_local = local()
+        self._connections = []
+        self._connections_lock = Lock()
+
+    def thread_db(self) -> Database:
+        db = getattr(self._thread_local, "db", None)
+        if db is None:
+            conn = psycopg2.connect(self.dsn)
+            with self._connections_lock:
+                self._connections.append(conn)
+            db = Database(conn)
+            self._thread_local.db = db
+        return db
+
+    def close(self) -> None:
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
 
     @abstractmethod
     def create_user_snapshots(
@@ -76,6 +170,20 @@ class UserLookup(ABC):
     ) -> List[UserSnapshot]:
         pass
 
+    def lookup_database(self, display_name: str) -> Optional[str]:
+        """
+        Finds the user who has had a display name from stored user snapshots, before resorting to guesses or the
+        network. Names only count if they match a single user, preferring a match of the exact case.
+        """
+        if not self.use_database:
+            return None
+        matches = DisplayNameMatch.search(self.thread_db(), self.site_id, display_name)
+        exact_matches = [match for match in matches if match.display_name == display_name]
+        user_ids = {match.site_user_id for match in exact_matches or matches}
+        if len(user_ids) != 1:
+            return None
+        return user_ids.pop()
+
     def lookup_user(
             self,
             display_name: str,
@@ -86,6 +194,10 @@ class UserLookup(ABC):
         cache_entry = self.cache.get(display_name)
         if cache_entry is not None:
             return cache_entry.username, []
+        username = self.lookup_database(display_name)
+        if username is not None:
+            self.cache.set_many([display_name], CacheEntry(username))
+            return username, []
         snapshots = self.create_user_snapshots(display_name, submission_id, contributor, scan_date)
         if not snapshots:
             return None, []
@@ -93,37 +205,41 @@ class UserLookup(ABC):
         cache_entry = CacheEntry(
             snapshots[0].site_user_id,
         )
-        for snapshot in snapshots:
-            self.cache[snapshot.display_name] = cache_entry
-        self.save_cache()
+        self.cache.set_many([snapshot.display_name for snapshot in snapshots], cache_entry)
         return cache_entry.username, snapshots
 
 
 class WeasylLookup(UserLookup):
     username_chars = string.ascii_letters + string.digits
-    FILENAME = "./cache_weasyl_lookup.json"
+    FILENAME = "./cache_weasyl_lookup.sqlite"
+    LEGACY_JSON_FILENAME = "./cache_weasyl_lookup.json"
 
-    def __init__(self, db: Database, api_key: Optional[str] = None) -> None:
-        super().__init__(WEASYL_ID, db)
+    def __init__(
+            self,
+            dsn: Optional[str],
+            api_key: Optional[str] = None,
+            *,
+            api_base: str = WEASYL_API,
+            requests_per_second: float = 1,
+    ) -> None:
+        super().__init__(WEASYL_ID, dsn)
         self.api_key = api_key
-        self.last_request = datetime.datetime.now()
-        self._lock = Lock()
+        self.api_base = api_base.rstrip("/")
+        self.rate_limiter = TokenBucket(requests_per_second)
+        self.session = requests.Session()
 
     def fetch_api(self, path: str) -> Dict:
-        with self._lock:
-            while self.last_request + datetime.timedelta(seconds=1) > datetime.datetime.now():
-                time.sleep(0.1)
-            headers = {
-                "User-Agent": "Spangle's faexport_db ingest thingy",
-            }
-            if self.api_key:
-                headers["X-Weasyl-API-Key"] = self.api_key
-            resp = requests.get(
-                f"https://weasyl.com/api/{path}",
-                headers=headers
-            ).json()
-            self.last_request = datetime.datetime.now()
-            return resp
+        # Only waiting for the rate limit is serialised, so slow responses do not hold up other requests
+        self.rate_limiter.acquire()
+        headers = {
+            "User-Agent": "Spangle's faexport_db ingest thingy",
+        }
+        if self.api_key:
+            headers["X-Weasyl-API-Key"] = self.api_key
+        return self.session.get(
+            f"{self.api_base}/{path.lstrip('/')}",
+            headers=headers
+        ).json()
 
     def create_user_snapshots(
             self,
@@ -207,10 +323,11 @@ class WeasylLookup(UserLookup):
 
 
 class FALookup(UserLookup):
-    FILENAME = "./cache_fa_users.json"
+    FILENAME = "./cache_fa_users.sqlite"
+    LEGACY_JSON_FILENAME = "./cache_fa_users.json"
 
-    def __init__(self, db: Database):
-        super().__init__(FA_ID, db)
+    def __init__(self, dsn: Optional[str]):
+        super().__init__(FA_ID, dsn)
 
     def create_user_snapshots(
             self,
@@ -0,0 +1,89 @@
+import datetime
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Lock
+from typing import Dict, List, Optional, Tuple, Iterable, Set
+
+from faexport_db.models.archive_contributor import ArchiveContributor
+from faexport_db.models.user import UserSnapshot
+from scripts.ingest.fuzzysearch.user_lookup import UserLookup
+
+LookupResult = Tuple[Optional[str], List[UserSnapshot]]
+
+
+class UserResolver:
+    """
+    Resolves display names through a UserLookup on a pool of worker threads, so that an ingestion job can queue up
+    every name in a prefetch pass, and then convert rows without waiting on names which have already been resolved.
+    Each display name is only looked up once, however many times it is queued or requested.
+    """
+
+    def __init__(self, lookup: UserLookup, *, workers: int = 4) -> None:
+        self.lookup = lookup
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{lookup.site_id}_lookup")
+        # Lookups which have been queued, and not yet claimed by a row. Once claimed, names are in the lookup's cache
+        self._in_flight: Dict[str, "Future[LookupResult]"] = {}
+        # Names which could not be resolved are remembered, rather than looked up again for every row
+        self._not_found: Set[str] = set()
+        self._lock = Lock()
+
+    def _submit(
+            self,
+            display_name: str,
+            submission_id: str,
+            contributor: ArchiveContributor,
+            scan_date: datetime.datetime
+    ) -> "Future[LookupResult]":
+        with self._lock:
+            future = self._in_flight.get(display_name)
+            if future is None:
+                future = self.executor.submit(
+                    self.lookup.lookup_user, display_name, submission_id, contributor, scan_date
+                )
+                self._in_flight[display_name] = future
+            return future
+
+    def prefetch(self, requests: Iterable[Tuple[str, str, ArchiveContributor, datetime.datetime]]) -> int:
+        """Queues lookups for display names which are not already cached. Returns how many were queued"""
+        queued = 0
+        for display_name, submission_id, contributor, scan_date in requests:
+            if display_name in self._in_flight or display_name in self._not_found or display_name in self.lookup.cache:
+                continue
+            self._submit(display_name, submission_id, contributor, scan_date)
+            queued += 1
+        return queued
+
+    def resolve(
+            self,
+            display_name: str,
+            submission_id: str,
+            contributor: ArchiveContributor,
+            scan_date: datetime.datetime
+    ) -> LookupResult:
+        if display_name in self._not_found:
+            return None, []
+        future = self._in_flight.get(display_name)
+        if future is None:
+            cache_entry = self.lookup.cache.get(display_name)
+            if cache_entry is not None:
+                return cache_entry.username, []
+            future = self._submit(display_name, submission_id, contributor, scan_date)
+        username, snapshots = future.result()
+        # The new user snapshots are only handed out to the first row to claim the lookup
+        with self._lock:
+            claimed = self._in_flight.get(display_name) is future
+            if claimed:
+                del self._in_flight[display_name]
+                if username is None:
+                    self._not_found.add(display_name)
+        if not claimed:
+            return username, []
+        return username, snapshots
+
+    def pending_count(self) -> int:
+        return sum(1 for future in list(self._in_flight.values()) if not future.done())
+
+    def shutdown(self) -> None:
+        with self._lock:
+            for future in self._in_flight.values():
+                future.cancel()
+        self.executor.shutdown(wait=True)
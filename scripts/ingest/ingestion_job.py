@@ -1,39 +1,30 @@
 import argparse
-import csv
 import datetime
 import pathlib
 from abc import ABC, abstractmethod
 from contextlib import contextmanager
-from typing import TypeVar, Optional, Iterator, List, Tuple, Callable, Union
+from typing import TypeVar, Optional, Iterator, List, Tuple
 
 import tqdm
 
 from faexport_db.db import Database
 from faexport_db.ingest_formats.base import FormatResponse
+from faexport_db.metrics import (
+    INGEST_ROWS,
+    INGEST_ROWS_PER_SECOND,
+    INGEST_BATCH_SAVE_LATENCY,
+    INGEST_PENDING_SNAPSHOTS,
+    write_metrics_file,
+)
 from faexport_db.models.submission import SubmissionSnapshot
 from faexport_db.models.user import UserSnapshot
+from scripts.ingest.bulk_load import BulkLoader, BulkLoadRefused
+from scripts.ingest.csv_profile import CsvProfile, cached_profile
+from scripts.ingest.csv_shards import ShardedCsvReader
 
 RowType = TypeVar("RowType")
 
 
-def csv_count_rows(file_path: Union[str, pathlib.Path]) -> int:
-    with open(file_path, "r", encoding="utf-8") as file:
-        reader = csv.reader(file)
-        return sum(1 for _ in tqdm.tqdm(reader, desc="Counting rows"))
-
-
-def cache_in_file(file_path: Union[str, pathlib.Path], generator: Callable[[], str]) -> str:
-    try:
-        with open(file_path, "r") as cache_file:
-            return cache_file.read()
-    except FileNotFoundError:
-        pass
-    result = generator()
-    with open(file_path, "w") as cache_file:
-        cache_file.write(result)
-    return result
-
-
 def _current_time() -> datetime.datetime:
     return datetime.datetime.now(datetime.timezone.utc)
 
@@ -41,10 +32,26 @@ def _current_time() -> datetime.datetime:
 class IngestionJob(ABC):
     SAVE_AFTER = 1000
     SAVE_AFTER_SECONDS = 60
+    # Values which profiling should treat as empty, when finding column stats of a CSV data source
+    PROFILE_NULL_VALUES = ("",)
 
     def __init__(self, *, skip_rows: int = 0) -> None:
         self.skip_rows = skip_rows
         self.last_save = _current_time()
+        self.metrics_file: Optional[str] = None
+        # CSV based jobs set these, to profile their data source in a single cached pass
+        self.csv_location: Optional[str] = None
+        self.profile_manifest: Optional[pathlib.Path] = None
+        self._profile: Optional[CsvProfile] = None
+        self.read_workers = 1
+        # Whether to check saved snapshots against the latest stored ones, to skip repeats
+        self.skip_repeats = True
+        # Whether secondary indexes are dropped for a bulk load, so that lookups needing them should be skipped
+        self.indexes_deferred = False
+
+    @property
+    def job_name(self) -> str:
+        return self.__class__.__name__
 
     def argument_parser(self) -> argparse.ArgumentParser:
         parser = argparse.ArgumentParser(
@@ -58,8 +65,57 @@ class IngestionJob(ABC):
             help="Run investigation scripts over the data source"
         )
         parser_func.add_argument("--ingest", action="store_true", help="Ingest data into the faexport_db database")
+        parser_func.add_argument(
+            "--profile",
+            action="store_true",
+            help="Re-profile the data source, updating the cached row count, column stats and byte offsets"
+        )
+        parser_func.add_argument(
+            "--rebuild-indexes",
+            action="store_true",
+            help="Rebuild any indexes left dropped by an interrupted bulk load"
+        )
+        parser.add_argument(
+            "--bulk-load",
+            choices=["auto", "always", "never"],
+            default="auto",
+            help="Whether to drop secondary indexes during ingestion and rebuild them afterwards. "
+                 "By default this is done for large loads, when the API is not running"
+        )
+        parser.add_argument(
+            "--read-workers",
+            type=int,
+            default=1,
+            help="Number of worker processes to read and parse the data source with, for jobs which support it"
+        )
+        parser.add_argument(
+            "--metrics-file",
+            help="Path to write prometheus metrics to, in textfile collector format, after every saved batch"
+        )
         return parser
 
+    def source_profile(self, *, refresh: bool = False) -> CsvProfile:
+        if self.csv_location is None or self.profile_manifest is None:
+            raise NotImplementedError(f"{self.job_name} does not have a CSV data source to profile")
+        if refresh or self._profile is None:
+            self._profile = cached_profile(
+                self.profile_manifest,
+                self.csv_location,
+                null_values=self.PROFILE_NULL_VALUES,
+                refresh=refresh,
+                workers=self.read_workers,
+            )
+        return self._profile
+
+    def print_profile(self, profile: CsvProfile) -> None:
+        print(f"{profile.row_count} rows, {profile.file_size} bytes, {len(profile.checkpoints)} checkpoints")
+        for name, stats in profile.columns.items():
+            print(f"  {name}: {stats.non_null} values, min {stats.min_value!r:.40}, max {stats.max_value!r:.40}")
+
+    def apply_arguments(self, args: argparse.Namespace) -> None:
+        self.metrics_file = args.metrics_file
+        self.read_workers = args.read_workers
+
     @abstractmethod
     def row_count(self) -> Optional[int]:
         pass
@@ -75,15 +131,80 @@ class IngestionJob(ABC):
     def iterate_rows(self) -> Iterator[RowType]:
         pass
 
+    def iterate_numbered_rows(self) -> Iterator[Tuple[int, RowType]]:
+        """Yields rows with their row number. Jobs which can seek to skip_rows should override this to do so"""
+        return enumerate(self.iterate_rows())
+
+    def iterate_numbered_results(self) -> Iterator[Tuple[int, FormatResponse]]:
+        """Yields converted rows from skip_rows onwards. Jobs may override this to convert rows in worker processes"""
+        for row_num, row in self.iterate_numbered_rows():
+            if row_num < self.skip_rows:
+                continue
+            yield row_num, self.convert_row(row)
+
+    def csv_reader(self, *, as_dicts: bool = False) -> ShardedCsvReader:
+        return ShardedCsvReader(
+            self.csv_location,
+            as_dicts=as_dicts,
+            workers=self.read_workers,
+            checkpoints=self.source_profile().checkpoints,
+        )
+
+    def _save_batch(
+            self,
+            db: Database,
+            submissions_by_row: List[Tuple[int, SubmissionSnapshot]],
+            users_by_row: List[Tuple[int, UserSnapshot]],
+            rows_since_save: int,
+    ) -> None:
+        # Pending snapshot gauges are only updated as batches are queued and saved, rather than for every row scanned
+        self._update_pending_metrics(submissions_by_row, users_by_row)
+        with INGEST_BATCH_SAVE_LATENCY.labels(self.job_name).time():
+            SubmissionSnapshot.save_batch(
+                db, [snapshot for _, snapshot in submissions_by_row], skip_repeats=self.skip_repeats
+            )
+            UserSnapshot.save_batch(db, [snapshot for _, snapshot in users_by_row], skip_repeats=self.skip_repeats)
+        self.after_batch_saved(
+            db,
+            [snapshot for _, snapshot in submissions_by_row],
+            [snapshot for _, snapshot in users_by_row],
+        )
+        submissions_by_row.clear()
+        users_by_row.clear()
+        seconds_since_save = (_current_time() - self.last_save).total_seconds()
+        if seconds_since_save > 0:
+            INGEST_ROWS_PER_SECOND.labels(self.job_name).set(rows_since_save / seconds_since_save)
+        self.last_save = _current_time()
+        self._update_pending_metrics(submissions_by_row, users_by_row)
+        if self.metrics_file:
+            write_metrics_file(self.metrics_file)
+
+    def after_batch_saved(
+            self,
+            db: Database,
+            submission_snapshots: List[SubmissionSnapshot],
+            user_snapshots: List[UserSnapshot],
+    ) -> None:
+        pass  # By default, do nothing. Allow ingestion jobs to record progress once snapshots are committed.
+
+    def _update_pending_metrics(
+            self,
+            submissions_by_row: List[Tuple[int, SubmissionSnapshot]],
+            users_by_row: List[Tuple[int, UserSnapshot]],
+    ) -> None:
+        INGEST_PENDING_SNAPSHOTS.labels(self.job_name, "submission").set(len(submissions_by_row))
+        INGEST_PENDING_SNAPSHOTS.labels(self.job_name, "user").set(len(users_by_row))
+
     def ingest_data(self, db: Database) -> None:
         submissions_by_row: List[Tuple[int, SubmissionSnapshot]] = []
         users_by_row: List[Tuple[int, UserSnapshot]] = []
+        rows_since_save = 0
+        rows_counter = INGEST_ROWS.labels(self.job_name)
 
-        progress = tqdm.tqdm(self.iterate_rows(), desc="Scanning data", total=self.row_count())
-        for row_num, row in enumerate(progress):
-            if row_num < self.skip_rows:
-                continue
-            result = self.convert_row(row)
+        progress = tqdm.tqdm(self.iterate_numbered_results(), desc="Scanning data", total=self.row_count())
+        for row_num, result in progress:
+            rows_counter.inc()
+            rows_since_save += 1
             # Add result to cached rows
             for snapshot in result.submission_snapshots:
                 submissions_by_row.append((row_num, snapshot))
@@ -98,11 +219,8 @@ class IngestionJob(ABC):
                 progress.set_description(
                     f"Saving snapshots for {len(submissions_by_row)} submissions and {len(users_by_row)} users"
                 )
-                SubmissionSnapshot.save_batch(db, [snapshot for _, snapshot in submissions_by_row])
-                submissions_by_row.clear()
-                UserSnapshot.save_batch(db, [snapshot for _, snapshot in users_by_row])
-                users_by_row.clear()
-                self.last_save = _current_time()
+                self._save_batch(db, submissions_by_row, users_by_row, rows_since_save)
+                rows_since_save = 0
             # Update description
             row_nums = [num for num, _ in submissions_by_row] + [num for num, _ in users_by_row]
             lowest_row_num = row_num
@@ -111,12 +229,11 @@ class IngestionJob(ABC):
             progress.set_description(
                 f"Collecting snapshots ({len(submissions_by_row)}s, {len(users_by_row)}u, >{lowest_row_num}"
             )
-        SubmissionSnapshot.save_batch(db, [snapshot for _, snapshot in submissions_by_row])
-        UserSnapshot.save_batch(db, [snapshot for _, snapshot in users_by_row])
+        self._save_batch(db, submissions_by_row, users_by_row, rows_since_save)
 
     def validate_data(self) -> None:
-        progress = tqdm.tqdm(self.iterate_rows(), desc="Validating data", total=self.row_count())
-        for row_num, row in enumerate(progress):
+        progress = tqdm.tqdm(self.iterate_numbered_rows(), desc="Validating data", total=self.row_count())
+        for row_num, row in progress:
             if row_num < self.skip_rows:
                 continue
             self.validate_row(row)
@@ -124,14 +241,47 @@ class IngestionJob(ABC):
     def investigate_data(self) -> None:
         print(f"No investigation configured for {self.__class__.__name__}")
 
-    def process(self, db: Database) -> None:
+    def use_bulk_load(self, loader: BulkLoader, bulk_load: str) -> bool:
+        if bulk_load == "never":
+            return False
+        if bulk_load == "always":
+            loader.check_api_idle()
+            return True
+        if not loader.is_large_load(self.row_count()):
+            return False
+        try:
+            loader.check_api_idle()
+        except BulkLoadRefused as e:
+            print(f"Not using bulk load mode: {e}")
+            return False
+        return True
+
+    def process(self, db: Database, *, dsn: Optional[str] = None) -> None:
         parser = self.argument_parser()
         args = parser.parse_args()
+        loader = BulkLoader(db, dsn)
+        self.apply_arguments(args)
+        if args.profile:
+            print("Profiling data")
+            self.print_profile(self.source_profile(refresh=True))
+            return
         if args.investigate:
             print("Investigating data")
             self.investigate_data()
             return
+        if args.rebuild_indexes:
+            print("Rebuilding indexes")
+            loader.rebuild_indexes()
+            return
         if args.ingest:
+            if self.use_bulk_load(loader, args.bulk_load):
+                print("Ingesting data in bulk load mode")
+                # Repeats are not checked for, as looking up the latest snapshots needs the dropped lookup indexes
+                self.skip_repeats = False
+                self.indexes_deferred = True
+                with loader.deferred_indexes():
+                    self.ingest_data(db)
+                return
             print("Ingesting data")
             self.ingest_data(db)
             return
@@ -0,0 +1,84 @@
+import json
+import re
+from typing import Iterator, Tuple, Any, TextIO
+
+READ_SIZE = 1024 * 1024
+
+_whitespace = re.compile(r"\s*")
+_delimiters = frozenset(" \t\n\r,:]}")
+
+
+class _StreamBuffer:
+    def __init__(self, file: TextIO, read_size: int) -> None:
+        self.file = file
+        self.read_size = read_size
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, min_size: int) -> bool:
+        """Reads more of the file into the buffer, dropping consumed text. Returns False at end of file"""
+        if self.eof:
+            return False
+        if self.pos:
+            self.text = self.text[self.pos:]
+            self.pos = 0
+        data = self.file.read(max(self.read_size, min_size))
+        if not data:
+            self.eof = True
+            return False
+        self.text += data
+        return True
+
+    def skip_whitespace(self) -> None:
+        while True:
+            self.pos = _whitespace.match(self.text, self.pos).end()
+            if self.pos < len(self.text) or not self.fill(0):
+                return
+
+    def expect(self, chars: str) -> str:
+        self.skip_whitespace()
+        if self.pos >= len(self.text) or self.text[self.pos] not in chars:
+            found = self.text[self.pos:self.pos + 20] if self.pos < len(self.text) else "end of file"
+            raise json.JSONDecodeError(f"Expected one of {chars!r}, found {found!r}", self.text, self.pos)
+        char = self.text[self.pos]
+        self.pos += 1
+        return char
+
+    def decode_value(self, decoder: json.JSONDecoder) -> Any:
+        self.skip_whitespace()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                # Value is incomplete, read more. Read sizes double with the value, to avoid re-parsing it many times
+                if not self.fill(len(self.text) - self.pos):
+                    raise
+                continue
+            # A complete value is followed by a delimiter, otherwise it may be a number which continues in the next read
+            if (end == len(self.text) or self.text[end] not in _delimiters) and self.fill(0):
+                continue
+            self.pos = end
+            return value
+
+
+def iterate_object_items(file: TextIO, *, read_size: int = READ_SIZE) -> Iterator[Tuple[str, Any]]:
+    """
+    Yields the key and value pairs of a top level JSON object as each value is parsed, so that memory use depends on
+    the size of the largest value, rather than the whole file.
+    """
+    decoder = json.JSONDecoder()
+    buffer = _StreamBuffer(file, read_size)
+    buffer.expect("{")
+    buffer.skip_whitespace()
+    if buffer.text.startswith("}", buffer.pos):
+        buffer.pos += 1
+        return
+    while True:
+        key = buffer.decode_value(decoder)
+        if not isinstance(key, str):
+            raise json.JSONDecodeError("Expected a string object key", buffer.text, buffer.pos)
+        buffer.expect(":")
+        yield key, buffer.decode_value(decoder)
+        if buffer.expect(",}") == "}":
+            return
@@ -0,0 +1,34 @@
+import collections
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import Callable, Iterable, Iterator, Tuple, Deque, TypeVar
+
+ResultType = TypeVar("ResultType")
+
+
+def ordered_map(
+        func: Callable[..., ResultType],
+        args_list: Iterable[Tuple],
+        workers: int,
+) -> Iterator[ResultType]:
+    """
+    Calls func with each set of args in a pool of worker processes, yielding results in order. Only a couple of tasks
+    per worker are submitted ahead of the consumer, so results do not pile up in memory while the consumer is busy.
+    With one worker, func is just called in this process.
+    """
+    if workers <= 1:
+        for args in args_list:
+            yield func(*args)
+        return
+    max_in_flight = workers * 2
+    with ProcessPoolExecutor(workers) as executor:
+        in_flight: Deque[Future] = collections.deque()
+        try:
+            for args in args_list:
+                in_flight.append(executor.submit(func, *args))
+                if len(in_flight) >= max_in_flight:
+                    yield in_flight.popleft().result()
+            while in_flight:
+                yield in_flight.popleft().result()
+        finally:
+            for future in in_flight:
+                future.cancel()